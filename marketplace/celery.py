@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from kombu import Queue
 from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'marketplace.settings')
@@ -8,6 +9,34 @@ app = Celery('marketplace')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
+# Colas dedicadas para que el fan-out masivo no retrase las tareas cortas
+app.conf.task_default_queue = 'default'
+app.conf.task_queues = (
+    Queue('default'),
+    Queue('fanout'),
+    Queue('sqs'),
+    Queue('maintenance'),
+)
+
+# Con el broker Redis un número menor indica mayor prioridad (0-9)
+app.conf.task_routes = {
+    'promotions.tasks.check_active_promos': {'queue': 'default', 'priority': 0},
+    'promotions.tasks.adjust_fanout_pacing': {'queue': 'default', 'priority': 1},
+    'promotions.tasks.send_promo_notification': {'queue': 'default', 'priority': 2},
+    'promotions.tasks.record_fanout_totals': {'queue': 'default', 'priority': 2},
+    'promotions.tasks.send_active_promos_notification': {'queue': 'default', 'priority': 2},
+    'promotions.tasks.record_multi_promo_totals': {'queue': 'default', 'priority': 2},
+    # El precálculo debe terminar antes del inicio de la promo: no puede
+    # quedar detrás de los shards de un fan-out en curso
+    'promotions.tasks.prewarm_promo_audiences': {'queue': 'default', 'priority': 3},
+    'promotions.tasks.send_active_promos_shard': {'queue': 'fanout', 'priority': 6},
+    'promotions.tasks.send_promo_notification_shard': {'queue': 'fanout', 'priority': 6},
+    'promotions.tasks.relay_notification_outbox': {'queue': 'fanout', 'priority': 4},
+    'promotions.tasks.retry_failed_notifications': {'queue': 'fanout', 'priority': 5},
+    'promotions.tasks.process_notification_queue': {'queue': 'sqs', 'priority': 4},
+    'promotions.tasks.cleanup_expired_promos': {'queue': 'maintenance', 'priority': 8},
+}
+
 app.conf.beat_schedule = {
     'check-flash-promos-every-minute': {
         'task': 'promotions.tasks.check_active_promos',
@@ -21,4 +50,20 @@ app.conf.beat_schedule = {
         'task': 'promotions.tasks.process_notification_queue',
         'schedule': 30.0,
     },
+    'relay-notification-outbox-every-5s': {
+        'task': 'promotions.tasks.relay_notification_outbox',
+        'schedule': 5.0,
+    },
+    'adjust-fanout-pacing-every-10s': {
+        'task': 'promotions.tasks.adjust_fanout_pacing',
+        'schedule': 10.0,
+    },
+    'retry-failed-notifications-every-30s': {
+        'task': 'promotions.tasks.retry_failed_notifications',
+        'schedule': 30.0,
+    },
+    'prewarm-promo-audiences-every-minute': {
+        'task': 'promotions.tasks.prewarm_promo_audiences',
+        'schedule': 60.0,
+    },
 }
\ No newline at end of file
@@ -0,0 +1,206 @@
+from django.db import models
+from django.db.models import Q
+from django.dispatch import Signal
+
+# Alfabeto base32 de geohash (sin a, i, l, o)
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Precisión guardada en las columnas: celdas de unos 4 cm
+GEOHASH_PRECISION = 12
+# Celdas máximas de un cubrimiento: cada una es un rango del índice
+MAX_COVERING_CELLS = 16
+# Filas por lote al recalcular geohashes
+REFRESH_BATCH_SIZE = 1000
+
+# Enviada por las operaciones masivas que cambian coordenadas (sin
+# post_save por fila) con sender=modelo y pks=lista de ids afectados
+coordinates_updated = Signal()
+
+
+def grid_size(precision):
+    """Filas (latitud) y columnas (longitud) de la rejilla de geohash de esa precisión"""
+    bits = 5 * precision
+    return 2 ** (bits // 2), 2 ** ((bits + 1) // 2)
+
+
+def cell_hash(row, col, precision):
+    """Geohash de la celda (row, col): los bits de longitud y latitud intercalados"""
+    bits = 5 * precision
+    lat_bits, lon_bits = bits // 2, (bits + 1) // 2
+    value = 0
+    for index in range(bits):
+        if index % 2 == 0:
+            lon_bits -= 1
+            value = (value << 1) | ((col >> lon_bits) & 1)
+        else:
+            lat_bits -= 1
+            value = (value << 1) | ((row >> lat_bits) & 1)
+    return ''.join(BASE32[(value >> shift) & 31] for shift in range(bits - 5, -1, -5))
+
+
+def grid_row(lat, rows):
+    return min(int((lat + 90) / 180 * rows), rows - 1)
+
+
+def grid_col(lon, cols):
+    return min(int((lon + 180) / 360 * cols), cols - 1)
+
+
+def encode(lat, lon, precision=GEOHASH_PRECISION):
+    """Geohash del punto, o cadena vacía si no tiene coordenadas"""
+    if lat is None or lon is None:
+        return ''
+    rows, cols = grid_size(precision)
+    return cell_hash(grid_row(lat, rows), grid_col(lon, cols), precision)
+
+
+def covering_cells(min_lat, max_lat, min_lon, max_lon, max_cells=MAX_COVERING_CELLS):
+    """
+    Geohashes de la mayor precisión cuyo cubrimiento del bounding box
+    tiene como mucho max_cells celdas. min_lon > max_lon indica que el
+    box cruza el antimeridiano y None que abarca todas las longitudes.
+    Devuelve una lista vacía si ni con un carácter se puede acotar.
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        rows, cols = grid_size(precision)
+        row_range = range(grid_row(min_lat, rows), grid_row(max_lat, rows) + 1)
+        if min_lon is None:
+            first, last = 0, cols - 1
+        else:
+            first, last = grid_col(min_lon, cols), grid_col(max_lon, cols)
+        col_count = last - first + 1 if first <= last else cols - first + last + 1
+        if len(row_range) * col_count <= max_cells:
+            col_list = [(first + offset) % cols for offset in range(col_count)]
+            return sorted(cell_hash(row, col, precision) for row in row_range for col in col_list)
+    return []
+
+
+def prefix_successor(prefix):
+    """Menor cadena mayor que todas las que empiezan por prefix, o None si no existe"""
+    prefix = prefix.rstrip(BASE32[-1])
+    if not prefix:
+        return None
+    return prefix[:-1] + BASE32[BASE32.index(prefix[-1]) + 1]
+
+
+def geohash_filter(cells, field='geohash'):
+    """
+    Q con un rango [celda, sucesor) por celda: cada rango se resuelve
+    con una lectura del índice B-tree de la columna, sin depender de
+    la collation como LIKE 'prefijo%'.
+    """
+    query = Q()
+    for cell in cells:
+        bounds = {f'{field}__gte': cell}
+        successor = prefix_successor(cell)
+        if successor is not None:
+            bounds[f'{field}__lt'] = successor
+        query |= Q(**bounds)
+    return query
+
+
+def has_plain_value(value):
+    return value is None or isinstance(value, (int, float))
+
+
+class GeohashQuerySet(models.QuerySet):
+    """
+    QuerySet que mantiene la columna geohash en las operaciones masivas
+    que no pasan por save(): bulk_create, bulk_update y update.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.geohash = encode(obj.latitude, obj.longitude)
+        created = super().bulk_create(objs, *args, **kwargs)
+        self._send_coordinates_updated([obj.pk for obj in created if obj.pk is not None])
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        fields = list(fields)
+        if {'latitude', 'longitude'} & set(fields) and 'geohash' not in fields:
+            objs = list(objs)
+            for obj in objs:
+                obj.geohash = encode(obj.latitude, obj.longitude)
+            fields.append('geohash')
+            updated = super().bulk_update(objs, fields, *args, **kwargs)
+            self._send_coordinates_updated([obj.pk for obj in objs])
+            return updated
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def update(self, **kwargs):
+        if not {'latitude', 'longitude'} & set(kwargs) or 'geohash' in kwargs:
+            return super().update(**kwargs)
+        
+        pks = list(self.values_list('pk', flat=True))
+        if {'latitude', 'longitude'} <= set(kwargs) and all(
+            has_plain_value(kwargs[name]) for name in ('latitude', 'longitude')
+        ):
+            updated = super().update(geohash=encode(kwargs['latitude'], kwargs['longitude']), **kwargs)
+        else:
+            # Solo cambia una coordenada o se usan expresiones: recalcular por fila
+            updated = super().update(**kwargs)
+            manager = self.model._default_manager.db_manager(self.db)
+            for start in range(0, len(pks), REFRESH_BATCH_SIZE):
+                manager.filter(pk__in=pks[start:start + REFRESH_BATCH_SIZE]).refresh_geohashes()
+        self._send_coordinates_updated(pks)
+        return updated
+
+    def _send_coordinates_updated(self, pks):
+        if pks:
+            coordinates_updated.send(sender=self.model, pks=pks)
+
+    def refresh_geohashes(self, batch_size=REFRESH_BATCH_SIZE):
+        """
+        Recalcula el geohash de las filas del queryset en lotes por pk
+        (keyset) y guarda solo los que cambian; devuelve cuántos cambian.
+        """
+        updated = 0
+        last_pk = None
+        while True:
+            batch = self.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            rows = list(batch.values_list('pk', 'latitude', 'longitude', 'geohash')[:batch_size])
+            if not rows:
+                return updated
+            last_pk = rows[-1][0]
+            changed = [
+                self.model(pk=pk, geohash=encode(lat, lon))
+                for pk, lat, lon, current in rows
+                if encode(lat, lon) != current
+            ]
+            if changed:
+                updated += super().bulk_update(changed, ['geohash'])
+
+
+class GeohashModel(models.Model):
+    """
+    Modelo con latitude/longitude y una columna geohash indexada que se
+    recalcula en cada save() y en las operaciones masivas de
+    GeohashQuerySet.
+    """
+    geohash = models.CharField(max_length=GEOHASH_PRECISION, blank=True, default='', db_index=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_geohash = instance.__dict__.get('geohash')
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.geohash = encode(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'geohash'}
+        # Los receptores de post_save consultan coordinates_changed para
+        # saber si la ubicación cambió con este save
+        self.coordinates_changed = self._state.adding or (
+            (update_fields is None or 'geohash' in kwargs['update_fields'])
+            and self.geohash != getattr(self, '_saved_geohash', None)
+        )
+        super().save(*args, **kwargs)
+        self._saved_geohash = self.geohash
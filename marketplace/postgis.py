@@ -0,0 +1,73 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+# Columna geography(Point) generada a partir de latitude/longitude
+LOCATION_COLUMN = 'location'
+
+
+def is_postgis(connection):
+    return connection.vendor == 'postgresql' and 'postgis' in connection.settings_dict['ENGINE']
+
+
+def add_location_column(schema_editor, table):
+    """
+    En PostGIS añade a table una columna geography(Point, 4326) generada
+    (STORED) a partir de latitude/longitude y su índice GiST. Al ser una
+    columna generada la base de datos la mantiene sincronizada en save,
+    operaciones masivas y SQL directo. En otros backends no hace nada.
+    """
+    if not is_postgis(schema_editor.connection):
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+    schema_editor.execute(
+        f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {LOCATION_COLUMN} geography(Point, 4326) '
+        f'GENERATED ALWAYS AS (CASE WHEN latitude IS NOT NULL AND longitude IS NOT NULL '
+        f'THEN ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography END) STORED'
+    )
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {table}_{LOCATION_COLUMN}_gist ON {table} USING GIST ({LOCATION_COLUMN})'
+    )
+
+
+def drop_location_column(schema_editor, table):
+    if not is_postgis(schema_editor.connection):
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {table}_{LOCATION_COLUMN}_gist')
+    schema_editor.execute(f'ALTER TABLE {table} DROP COLUMN IF EXISTS {LOCATION_COLUMN}')
+
+
+@lru_cache(maxsize=None)
+def has_location_column(table, using=DEFAULT_DB_ALIAS):
+    """Si la columna existe (la migración se aplicó sobre PostGIS); se consulta una vez por proceso"""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        columns = connection.introspection.get_table_description(cursor, table)
+    return any(column.name == LOCATION_COLUMN for column in columns)
+
+
+def uses_postgis(model, using=DEFAULT_DB_ALIAS):
+    """Si las consultas de radio sobre model pueden resolverse con ST_DWithin"""
+    return (
+        settings.GEO_POSTGIS_ENABLED
+        and is_postgis(connections[using])
+        and has_location_column(model._meta.db_table, using)
+    )
+
+
+def dwithin_filter(model, lat, lon, distance_km):
+    """
+    Q de las filas a distance_km o menos del punto con ST_DWithin sobre
+    la columna geography, resuelta con el índice GiST. Se usa la esfera
+    (use_spheroid = false) para coincidir con haversine.
+    """
+    table = model._meta.db_table
+    pk = model._meta.pk.column
+    return Q(pk__in=RawSQL(
+        f'SELECT {pk} FROM {table} WHERE ST_DWithin({LOCATION_COLUMN}, '
+        f'ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s, false)',
+        (lon, lat, distance_km * 1000)
+    ))
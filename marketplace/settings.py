@@ -166,6 +166,14 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+# Las colas y rutas se definen en marketplace/celery.py
+CELERY_WORKER_PREFETCH_MULTIPLIER = config('CELERY_WORKER_PREFETCH_MULTIPLIER', default=1, cast=int)
+CELERY_TASK_DEFAULT_PRIORITY = config('CELERY_TASK_DEFAULT_PRIORITY', default=5, cast=int)
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
 
 # AWS LocalStack configuration
 AWS_ACCESS_KEY_ID = config('AWS_ACCESS_KEY_ID', default='test')
@@ -174,12 +182,55 @@ AWS_DEFAULT_REGION = config('AWS_DEFAULT_REGION', default='us-east-1')
 AWS_SNS_ENDPOINT_URL = config('AWS_SNS_ENDPOINT_URL', default='http://localhost:4566')
 AWS_SQS_ENDPOINT_URL = config('AWS_SQS_ENDPOINT_URL', default='http://localhost:4566')
 FLASH_PROMO_TOPIC_ARN = config('FLASH_PROMO_TOPIC_ARN', default='arn:aws:sns:us-east-1:000000000000:flash-promo-topic')
+SNS_MAX_POOL_CONNECTIONS = config('SNS_MAX_POOL_CONNECTIONS', default=10, cast=int)
+SNS_PUBLISH_CONCURRENCY = config('SNS_PUBLISH_CONCURRENCY', default=8, cast=int)
+SNS_PUBLISH_RATE_LIMIT = config('SNS_PUBLISH_RATE_LIMIT', default=0, cast=int)  # mensajes/s en todo el cluster, 0 = sin límite
+SNS_PUBLISH_BURST = config('SNS_PUBLISH_BURST', default=0, cast=int)  # 0 = igual a SNS_PUBLISH_RATE_LIMIT
+
+# Notification fan-out configuration
+NOTIFICATION_FANOUT_BATCH_SIZE = config('NOTIFICATION_FANOUT_BATCH_SIZE', default=500, cast=int)
+NOTIFICATION_STREAM_CHUNK_SIZE = config('NOTIFICATION_STREAM_CHUNK_SIZE', default=5000, cast=int)
+NOTIFICATION_LOG_BUFFER_SIZE = config('NOTIFICATION_LOG_BUFFER_SIZE', default=1000, cast=int)
+NOTIFICATION_SHARD_SIZE = config('NOTIFICATION_SHARD_SIZE', default=10000, cast=int)
+NOTIFICATION_FANOUT_ENGINE = config('NOTIFICATION_FANOUT_ENGINE', default='single_pass')
+NOTIFICATION_DIGEST_MODE = config('NOTIFICATION_DIGEST_MODE', default=False, cast=bool)
+NOTIFICATION_FANOUT_LOCK_TIMEOUT = config('NOTIFICATION_FANOUT_LOCK_TIMEOUT', default=900, cast=int)
+NOTIFICATION_AUDIENCE_PREWARM_MINUTES = config('NOTIFICATION_AUDIENCE_PREWARM_MINUTES', default=10, cast=int)
+NOTIFICATION_AUDIENCE_TTL = config('NOTIFICATION_AUDIENCE_TTL', default=86400, cast=int)
+NOTIFICATION_PROXIMITY_TABLE_ENABLED = config('NOTIFICATION_PROXIMITY_TABLE_ENABLED', default=False, cast=bool)
+NOTIFICATION_PROXIMITY_RADIUS_KM = config('NOTIFICATION_PROXIMITY_RADIUS_KM', default=2.0, cast=float)
+NOTIFICATION_AUDIENCE_SOURCE = config('NOTIFICATION_AUDIENCE_SOURCE', default='geo')  # geo | proximity
+NOTIFICATION_DEDUPE_BACKEND = config('NOTIFICATION_DEDUPE_BACKEND', default='redis')  # redis | database
+NOTIFICATION_DEDUPE_TTL = config('NOTIFICATION_DEDUPE_TTL', default=172800, cast=int)
+NOTIFICATION_DELIVERY_MODE = config('NOTIFICATION_DELIVERY_MODE', default='outbox')  # outbox | inline
+NOTIFICATION_OUTBOX_BATCH_SIZE = config('NOTIFICATION_OUTBOX_BATCH_SIZE', default=500, cast=int)
+NOTIFICATION_OUTBOX_MAX_BATCHES = config('NOTIFICATION_OUTBOX_MAX_BATCHES', default=100, cast=int)
+NOTIFICATION_OUTBOX_LEASE_SECONDS = config('NOTIFICATION_OUTBOX_LEASE_SECONDS', default=300, cast=int)
+NOTIFICATION_RETRY_MAX_ATTEMPTS = config('NOTIFICATION_RETRY_MAX_ATTEMPTS', default=5, cast=int)
+NOTIFICATION_RETRY_BASE_DELAY = config('NOTIFICATION_RETRY_BASE_DELAY', default=30, cast=int)
+NOTIFICATION_RETRY_MAX_DELAY = config('NOTIFICATION_RETRY_MAX_DELAY', default=3600, cast=int)
+NOTIFICATION_PACING_ENABLED = config('NOTIFICATION_PACING_ENABLED', default=False, cast=bool)
+NOTIFICATION_PACING_MIN_RATE = config('NOTIFICATION_PACING_MIN_RATE', default=50, cast=float)
+NOTIFICATION_PACING_MAX_RATE = config('NOTIFICATION_PACING_MAX_RATE', default=3000, cast=float)
+NOTIFICATION_PACING_RATE_STEP = config('NOTIFICATION_PACING_RATE_STEP', default=100, cast=float)
+NOTIFICATION_PACING_MIN_BATCH_SIZE = config('NOTIFICATION_PACING_MIN_BATCH_SIZE', default=50, cast=int)
+NOTIFICATION_PACING_BATCH_STEP = config('NOTIFICATION_PACING_BATCH_STEP', default=50, cast=int)
+NOTIFICATION_PACING_DECREASE_FACTOR = config('NOTIFICATION_PACING_DECREASE_FACTOR', default=0.5, cast=float)
+NOTIFICATION_PACING_ERROR_THRESHOLD = config('NOTIFICATION_PACING_ERROR_THRESHOLD', default=0.05, cast=float)
+NOTIFICATION_PACING_QUEUE_THRESHOLD = config('NOTIFICATION_PACING_QUEUE_THRESHOLD', default=10000, cast=int)
+
+# Store spatial index configuration
+STORE_INDEX_CELL_DEGREES = config('STORE_INDEX_CELL_DEGREES', default=0.02, cast=float)
+STORE_INDEX_MAX_AGE = config('STORE_INDEX_MAX_AGE', default=300, cast=int)
 
 # GeoDjango configuration
 if 'postgis' in DATABASES['default']['ENGINE']:
     GDAL_LIBRARY_PATH = config('GDAL_LIBRARY_PATH', default='')
     GEOS_LIBRARY_PATH = config('GEOS_LIBRARY_PATH', default='')
 
+# Consultas de radio con ST_DWithin sobre la columna geography cuando el backend es PostGIS
+GEO_POSTGIS_ENABLED = config('GEO_POSTGIS_ENABLED', default=True, cast=bool)
+
 
 
 # Logging configuration
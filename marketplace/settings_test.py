@@ -87,6 +87,9 @@ CACHES = {
     }
 }
 
+# Daily notification dedupe on the users table (no Redis in tests)
+NOTIFICATION_DEDUPE_BACKEND = 'database'
+
 # Email backend for tests
 EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
 
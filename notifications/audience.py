@@ -0,0 +1,106 @@
+import numpy as np
+from django.conf import settings
+from .proximity import iter_users_within_radius
+from .redis_client import get_redis
+from .store_proximity import uses_proximity_table
+from .utils import MAX_DISTANCE_KM, get_eligible_users_for_promo
+
+
+def audience_key(promo_id, day):
+    return f"audience:promo:{promo_id}:{day:%Y%m%d}"
+
+
+def compute_audience(promo):
+    """
+    Ids ordenados de los usuarios elegibles y dentro del radio de la
+    tienda, como array int64. Usa el mismo recorrido en streaming que el
+    fan-out.
+    """
+    store = promo.product.store
+    chunk_size = settings.NOTIFICATION_STREAM_CHUNK_SIZE
+    if uses_proximity_table(MAX_DISTANCE_KM):
+        return np.fromiter(
+            get_eligible_users_for_promo(promo).order_by('id')
+            .values_list('id', flat=True).iterator(chunk_size=chunk_size),
+            dtype=np.int64
+        )
+    rows = (
+        get_eligible_users_for_promo(promo).order_by('id')
+        .values_list('id', 'latitude', 'longitude')
+        .iterator(chunk_size=chunk_size)
+    )
+    chunks = [
+        np.asarray(chunk_ids, dtype=np.int64)
+        for chunk_ids in iter_users_within_radius(
+            rows, [(store.latitude, store.longitude)], MAX_DISTANCE_KM, chunk_size
+        )
+    ]
+    if not chunks:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(chunks)
+
+
+def store_audience(promo_id, day, user_ids):
+    """
+    Guarda la audiencia en Redis como un blob binario de int64 little
+    endian (8 bytes por usuario) con expiración. Devuelve False si Redis
+    no está disponible.
+    """
+    connection = get_redis()
+    if connection is None:
+        return False
+    blob = np.asarray(user_ids, dtype='<i8').tobytes()
+    connection.set(audience_key(promo_id, day), blob, ex=settings.NOTIFICATION_AUDIENCE_TTL)
+    return True
+
+
+def has_audience(promo_id, day):
+    connection = get_redis()
+    if connection is None:
+        return False
+    return bool(connection.exists(audience_key(promo_id, day)))
+
+
+def discard_audience(promo_id, day):
+    connection = get_redis()
+    if connection is not None:
+        connection.delete(audience_key(promo_id, day))
+
+
+def load_audience(promo_id, day, after_id=None, until_id=None):
+    """
+    Audiencia precalculada de la promo, opcionalmente limitada al rango
+    (after_id, until_id], o None si no hay una guardada.
+    """
+    connection = get_redis()
+    if connection is None:
+        return None
+    blob = connection.get(audience_key(promo_id, day))
+    if blob is None:
+        return None
+    user_ids = np.frombuffer(blob, dtype='<i8')
+    start = 0 if after_id is None else np.searchsorted(user_ids, after_id, side='right')
+    end = len(user_ids) if until_id is None else np.searchsorted(user_ids, until_id, side='right')
+    return user_ids[start:end]
+
+
+def audience_shards(user_ids, shard_size, after_id=None):
+    """
+    Rangos (after_id, until_id] de hasta shard_size ids de una audiencia
+    ordenada cuyos ids son todos mayores que after_id.
+    """
+    shards = []
+    for start in range(0, len(user_ids), shard_size):
+        end = start + shard_size
+        until_id = int(user_ids[end - 1]) if end < len(user_ids) else None
+        shards.append((after_id, until_id))
+        after_id = until_id
+    return shards
+
+
+def prewarm_audience(promo, day):
+    """Calcula y guarda la audiencia de la promo; devuelve su tamaño o None sin Redis"""
+    user_ids = compute_audience(promo)
+    if not store_audience(promo.id, day, user_ids):
+        return None
+    return len(user_ids)
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.db import transaction
+from .models import NotificationLog, NotificationOutbox
+
+
+class NotificationLogBuffer:
+    """
+    Acumula filas de NotificationLog durante un fan-out y las inserta
+    con bulk_create en bloques de chunk_size. Usado como context manager
+    garantiza un flush final también cuando el envío termina con error.
+
+    Las filas añadidas con outbox_payload generan además su entrada en
+    NotificationOutbox dentro de la misma transacción (con los campos
+    adicionales de outbox_fields, p. ej. un reintento programado).
+    """
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or settings.NOTIFICATION_LOG_BUFFER_SIZE
+        self.rows = []
+        self.payloads = []
+        self.written = 0
+
+    def add(self, outbox_payload=None, outbox_fields=None, **fields):
+        self.rows.append(NotificationLog(**fields))
+        self.payloads.append((outbox_payload, outbox_fields or {}))
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        with transaction.atomic():
+            logs = NotificationLog.objects.bulk_create(self.rows, batch_size=self.chunk_size)
+            outbox_entries = [
+                NotificationOutbox(notification_log=log, payload=payload, **outbox_fields)
+                for log, (payload, outbox_fields) in zip(logs, self.payloads)
+                if payload is not None
+            ]
+            if outbox_entries:
+                NotificationOutbox.objects.bulk_create(outbox_entries, batch_size=self.chunk_size)
+        self.written += len(self.rows)
+        self.rows = []
+        self.payloads = []
+
+    def discard(self):
+        """Descarta las filas pendientes sin escribirlas"""
+        self.rows = []
+        self.payloads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
@@ -0,0 +1,149 @@
+from django.conf import settings
+from users.models import User
+from .models import NotificationLog
+from .redis_client import get_redis
+
+
+def logged_user_ids(user_ids, promo_id, day):
+    """Ids del lote que ya tienen un NotificationLog de la promo en el día"""
+    return set(
+        NotificationLog.objects.filter(
+            flash_promo_id=promo_id, user_id__in=user_ids, sent_at__date=day
+        ).values_list('user_id', flat=True)
+    )
+
+
+class RedisDailyDedupe:
+    """
+    Registro diario de usuarios notificados en un bitmap de Redis
+    indexado por id de usuario (un bit por usuario y una clave por día
+    con TTL). Las consultas y marcas de un lote se envían en un único
+    pipeline.
+    """
+
+    def __init__(self, connection, day):
+        self.connection = connection
+        self.day = day
+        self.key = f"notifications:sent:{day:%Y%m%d}"
+
+    def exclude_notified(self, user_ids):
+        """Devuelve los ids que aún no han sido notificados en el día"""
+        if not user_ids:
+            return []
+        pipeline = self.connection.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.getbit(self.key, user_id)
+        flags = pipeline.execute()
+        return [user_id for user_id, flag in zip(user_ids, flags) if not flag]
+
+    def mark_notified(self, user_ids):
+        if not user_ids:
+            return
+        pipeline = self.connection.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.setbit(self.key, user_id, 1)
+        pipeline.expire(self.key, settings.NOTIFICATION_DEDUPE_TTL)
+        pipeline.execute()
+
+    def promo_key(self, promo_id):
+        return f"notifications:promo:{promo_id}:{self.day:%Y%m%d}"
+
+    def claim(self, user_ids, promo_id, recover=False):
+        """
+        Reclama de forma atómica la clave de idempotencia (promo, usuario,
+        día) de cada id. SETBIT devuelve el valor anterior, así que si dos
+        ejecuciones concurrentes procesan al mismo usuario solo una lo
+        obtiene. Devuelve los ids reclamados por esta ejecución.
+
+        Con recover=True (reanudación de un envío interrumpido) también se
+        devuelven los ids ya reclamados que no tienen NotificationLog de
+        la promo en el día: la ejecución anterior murió entre la
+        reclamación y la escritura de sus logs.
+        """
+        if not user_ids:
+            return []
+        key = self.promo_key(promo_id)
+        pipeline = self.connection.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.setbit(key, user_id, 1)
+        pipeline.expire(key, settings.NOTIFICATION_DEDUPE_TTL)
+        previous = pipeline.execute()[:len(user_ids)]
+        taken = {user_id for user_id, flag in zip(user_ids, previous) if flag}
+        if recover and taken:
+            taken &= logged_user_ids(taken, promo_id, self.day)
+        return [user_id for user_id in user_ids if user_id not in taken]
+
+    def unclaimed(self, user_ids, promo_id):
+        """Ids que claim reclamaría, sin reclamarlos (para el dry-run)"""
+        if not user_ids:
+            return []
+        pipeline = self.connection.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.getbit(self.promo_key(promo_id), user_id)
+        flags = pipeline.execute()
+        return [user_id for user_id, flag in zip(user_ids, flags) if not flag]
+
+    def release(self, user_ids, promo_id):
+        """Libera las claves de ids reclamados cuyo envío no llegó a registrarse"""
+        if not user_ids:
+            return
+        key = self.promo_key(promo_id)
+        pipeline = self.connection.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.setbit(key, user_id, 0)
+        pipeline.execute()
+
+
+class DatabaseDailyDedupe:
+    """
+    Registro diario basado en la columna User.last_notification_sent.
+    Se usa cuando Redis no está disponible.
+    """
+
+    def __init__(self, day):
+        self.day = day
+
+    def exclude_notified(self, user_ids):
+        if not user_ids:
+            return []
+        notified = set(
+            User.objects.filter(id__in=user_ids, last_notification_sent=self.day)
+            .values_list('id', flat=True)
+        )
+        return [user_id for user_id in user_ids if user_id not in notified]
+
+    def mark_notified(self, user_ids):
+        # Un único UPDATE por lote que solo toca la columna del frequency cap
+        User.objects.filter(id__in=user_ids).update(last_notification_sent=self.day)
+
+    def claim(self, user_ids, promo_id, recover=False):
+        """
+        Descarta los usuarios que ya tienen un NotificationLog de la promo
+        en el día. No es atómico; la exclusión entre ejecuciones la da el
+        lock del fan-out.
+        """
+        if not user_ids:
+            return []
+        logged = logged_user_ids(user_ids, promo_id, self.day)
+        return [user_id for user_id in user_ids if user_id not in logged]
+
+    def unclaimed(self, user_ids, promo_id):
+        # La reclamación ya es de solo lectura
+        return self.claim(user_ids, promo_id)
+
+    def release(self, user_ids, promo_id):
+        # La reclamación se deriva de los logs: no hay nada que liberar
+        pass
+
+
+def get_daily_dedupe(day):
+    """
+    Devuelve el registro de notificaciones diarias configurado en
+    NOTIFICATION_DEDUPE_BACKEND ('redis' o 'database'). Si Redis no está
+    disponible se usa la columna de la base de datos.
+    """
+    if settings.NOTIFICATION_DEDUPE_BACKEND == 'redis':
+        connection = get_redis()
+        if connection is not None:
+            return RedisDailyDedupe(connection, day)
+    return DatabaseDailyDedupe(day)
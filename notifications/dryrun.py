@@ -0,0 +1,152 @@
+import time
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from promotions.models import FlashPromo
+from .buffers import NotificationLogBuffer
+from .dedupe import get_daily_dedupe
+from .engine import send_multi_promo_notification, uses_single_pass
+from .publisher import NoOpPublisher
+from .ratelimit import get_sns_publish_rate
+from .timing import StageTimer
+from .utils import send_flash_promo_notification
+
+
+class QueryCounter:
+    """Wrapper de ejecución que cuenta las consultas, también con DEBUG=False"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class ReadOnlyDedupe:
+    """
+    Dedupe del dry-run: consulta el registro real pero no reclama, marca
+    ni libera usuarios.
+    """
+
+    def __init__(self, dedupe, timer):
+        self.dedupe = dedupe
+        self.timer = timer
+        self.batches = 0
+
+    def exclude_notified(self, user_ids):
+        self.batches += 1
+        with self.timer.stage('dedupe'):
+            return self.dedupe.exclude_notified(user_ids)
+
+    def claim(self, user_ids, promo_id, recover=False):
+        with self.timer.stage('dedupe'):
+            return self.dedupe.unclaimed(user_ids, promo_id)
+
+    def mark_notified(self, user_ids):
+        pass
+
+    def release(self, user_ids, promo_id):
+        pass
+
+
+class TimedPublisher:
+    """Imputa a la etapa 'publish' el tiempo del publisher envuelto"""
+
+    def __init__(self, publisher, timer):
+        self.publisher = publisher
+        self.timer = timer
+
+    def publish(self, messages):
+        with self.timer.stage('publish'):
+            return self.publisher.publish(messages)
+
+
+class DiscardingLogBuffer(NotificationLogBuffer):
+    """
+    Buffer de logs que cuenta las filas de cada flush sin escribirlas.
+    Los mensajes que irían al outbox se pasan al publisher, igual que
+    los publicaría el relay en lotes de PublishBatch.
+    """
+
+    def __init__(self, publisher, chunk_size=None):
+        super().__init__(chunk_size)
+        self.publisher = publisher
+
+    def flush(self):
+        messages = [
+            (row.user_id, payload)
+            for row, (payload, outbox_fields) in zip(self.rows, self.payloads)
+            if payload is not None
+        ]
+        if messages:
+            self.publisher.publish(messages)
+        self.written += len(self.rows)
+        self.discard()
+
+
+def dry_run_flash_promo_notification(promo_id, after_id=None, until_id=None, rates=None):
+    """
+    Ejecuta el fan-out real de la promo, por el mismo motor que usaría
+    check_active_promos, con un NoOpPublisher, un dedupe de solo lectura
+    y un buffer que descarta los logs: no se envía ni se escriben logs,
+    outbox, checkpoints ni marcas de dedupe. En modo outbox los mensajes
+    encolados pasan igualmente por el NoOpPublisher para medir los lotes
+    de PublishBatch que haría el relay. Devuelve un informe con el
+    tamaño de la audiencia, el tiempo por etapa (eligibility, scan, geo,
+    dedupe, publish), las consultas ejecutadas y el tiempo total
+    proyectado para cada tasa de publicación.
+    """
+    timer = StageTimer()
+    queries = QueryCounter()
+    publisher = NoOpPublisher()
+    report = {'promo_id': promo_id, 'dry_run': True, 'delivery_mode': settings.NOTIFICATION_DELIVERY_MODE}
+
+    started = time.perf_counter()
+    with connection.execute_wrapper(queries):
+        if not FlashPromo.objects.filter(id=promo_id).exists():
+            report['error'] = f"Promo with id {promo_id} does not exist"
+            return report
+
+        today = timezone.now().date()
+        dedupe = ReadOnlyDedupe(get_daily_dedupe(today), timer)
+        timed_publisher = TimedPublisher(publisher, timer)
+        options = {
+            'publisher': timed_publisher,
+            'dedupe': dedupe,
+            'log_buffer': DiscardingLogBuffer(timed_publisher),
+            'record_progress': False,
+            'timer': timer,
+        }
+        if uses_single_pass(promo_id, today):
+            report['engine'] = 'single_pass'
+            stats = send_multi_promo_notification([promo_id], after_id, until_id, **options).get(promo_id)
+        else:
+            report['engine'] = 'per_promo'
+            stats = send_flash_promo_notification(promo_id, after_id, until_id, **options)
+    pipeline_seconds = time.perf_counter() - started
+
+    stats = stats or {'sent': 0, 'failed': 0, 'queued': 0, 'skipped': 0}
+    would_send = stats['sent'] + stats['failed'] + stats['queued']
+    report.update({
+        'audience': would_send + stats['skipped'],
+        'already_notified': stats['skipped'],
+        'would_send': would_send,
+        'batches': dedupe.batches,
+        'publish_calls': publisher.calls,
+        'queries': queries.count,
+    })
+    report['timings'] = {name: round(seconds, 4) for name, seconds in timer.timings.items()}
+    report['timings']['total'] = round(pipeline_seconds, 4)
+
+    # El envío real queda limitado por la tasa de publicación: el tiempo
+    # proyectado es el del pipeline o el de publicar a esa tasa, el mayor
+    rates = rates or [get_sns_publish_rate() or None]
+    report['projections'] = [
+        {
+            'rate': rate,
+            'seconds': round(max(pipeline_seconds, would_send / rate) if rate else pipeline_seconds, 2),
+        }
+        for rate in rates
+    ]
+    return report
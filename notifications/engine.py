@@ -0,0 +1,284 @@
+from functools import reduce
+from operator import or_
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from users.models import User
+from promotions.models import FlashPromo
+from .audience import has_audience
+from .buffers import NotificationLogBuffer
+from .dedupe import get_daily_dedupe
+from .pacing import get_fanout_batch_size
+from .proximity import chunked, haversine_matrix
+from .publisher import SNSBatchPublisher
+from .timing import NULL_TIMER
+from .utils import (
+    MAX_DISTANCE_KM,
+    finish_fanout_checkpoint,
+    get_fanout_frontier,
+    get_id_shards,
+    notify_claimed_batch,
+    promo_audience_filter,
+    promo_segment_user_types,
+    save_fanout_checkpoint,
+    start_fanout_checkpoint,
+)
+
+
+class ActivePromoSet:
+    """
+    Promos activas cargadas una sola vez como arrays: coordenadas de sus
+    tiendas, elegibilidad por tipo de usuario y descuento. Permite
+    evaluar todas las promos para un bloque de usuarios en una sola
+    operación vectorizada.
+    """
+
+    def __init__(self, promos, max_distance_km=MAX_DISTANCE_KM):
+        self.max_distance_km = max_distance_km
+        self.promos = [
+            promo for promo in promos
+            if promo.product.store.latitude is not None and promo.product.store.longitude is not None
+        ]
+        self.store_lats = np.array([promo.product.store.latitude for promo in self.promos], dtype=float)
+        self.store_lons = np.array([promo.product.store.longitude for promo in self.promos], dtype=float)
+        self.discounts = np.array([
+            float(1 - promo.promo_price / promo.product.original_price) if promo.product.original_price else 0.0
+            for promo in self.promos
+        ])
+        # Una promo sin segmentos no filtra por tipo de usuario
+        self.segment_types = [set(promo_segment_user_types(promo)) for promo in self.promos]
+        # Último id ya procesado por cada promo (se reanuda a partir de él)
+        self.after_ids = np.full(len(self.promos), -1, dtype=np.int64)
+        self._eligibility = {}
+
+    def __len__(self):
+        return len(self.promos)
+
+    def audience_filter(self):
+        """Unión de los filtros de segmento y bounding box de todas las promos"""
+        return reduce(or_, (promo_audience_filter(promo, self.max_distance_km) for promo in self.promos))
+
+    def eligibility(self, user_type):
+        """Vector booleano de promos elegibles para un tipo de usuario"""
+        if user_type not in self._eligibility:
+            self._eligibility[user_type] = np.array([
+                not types or user_type in types for types in self.segment_types
+            ], dtype=bool)
+        return self._eligibility[user_type]
+
+    def resume_after(self, last_user_ids):
+        """Fija el último id procesado de cada promo ({promo_id: id o None})"""
+        for index, promo in enumerate(self.promos):
+            last_user_id = last_user_ids.get(promo.id)
+            self.after_ids[index] = -1 if last_user_id is None else last_user_id
+
+    def matches(self, lats, lons, user_types, user_ids=None):
+        """
+        Matriz booleana (usuarios x promos) de promos elegibles por
+        segmento y distancia. Las coordenadas nulas (NaN) nunca coinciden.
+        Con user_ids se descartan los pares que la promo ya procesó.
+        """
+        distances = haversine_matrix(lats, lons, self.store_lats, self.store_lons)
+        eligible = np.vstack([self.eligibility(user_type) for user_type in user_types])
+        matches = (distances <= self.max_distance_km) & eligible
+        if user_ids is not None:
+            matches &= np.asarray(user_ids, dtype=np.int64)[:, np.newaxis] > self.after_ids[np.newaxis, :]
+        return matches
+
+    def best_promo_indexes(self, lats, lons, user_types, user_ids=None):
+        """
+        Para cada usuario devuelve el índice de la promo con mayor
+        descuento entre las elegibles, o -1 si ninguna aplica.
+        """
+        if len(lats) == 0:
+            return np.empty(0, dtype=np.int64)
+        matches = self.matches(lats, lons, user_types, user_ids)
+        scores = np.where(matches, self.discounts[np.newaxis, :], -np.inf)
+        best = scores.argmax(axis=1)
+        best[~matches.any(axis=1)] = -1
+        return best
+
+    def digest_groups(self, lats, lons, user_types, user_ids=None):
+        """
+        Para cada usuario devuelve la tupla de índices de todas sus promos
+        elegibles ordenadas por descuento (la principal primero); tupla
+        vacía si ninguna aplica.
+        """
+        if len(lats) == 0:
+            return []
+        matches = self.matches(lats, lons, user_types, user_ids)
+        order = np.argsort(-self.discounts, kind='stable')
+        ranked = matches[:, order]
+        return [tuple(order[row].tolist()) for row in ranked]
+
+
+def load_active_promo_set(promo_ids):
+    promos = FlashPromo.objects.select_related('product__store').filter(id__in=promo_ids).order_by('id')
+    return ActivePromoSet(list(promos))
+
+
+def get_multi_promo_shards(promo_ids, shard_size, after_id=None):
+    """Rangos de ids posteriores a after_id sobre la audiencia conjunta de varias promos"""
+    promo_set = load_active_promo_set(promo_ids)
+    if not len(promo_set):
+        return []
+    return get_id_shards(User.objects.filter(promo_set.audience_filter()), shard_size, after_id)
+
+
+def get_multi_promo_frontier(promo_ids, run_date):
+    """
+    Último id cubierto por todas las promos en el día, o None si alguna
+    no terminó su fan-out (el fan-out conjunto debe empezar desde el
+    principio y cada promo retoma desde su propio checkpoint).
+    """
+    frontiers = [
+        get_fanout_frontier(promo, run_date)
+        for promo in FlashPromo.objects.filter(id__in=promo_ids)
+    ]
+    if not frontiers or None in frontiers:
+        return None
+    return min(frontiers)
+
+
+def uses_single_pass(promo_id, run_date):
+    """
+    Si el fan-out de la promo va por el motor de una sola pasada. Con
+    single_pass las promos con audiencia precalculada solo tienen que
+    publicar y van por separado, salvo en modo digest, que necesita ver
+    todas las promos de cada usuario a la vez.
+    """
+    if settings.NOTIFICATION_FANOUT_ENGINE != 'single_pass':
+        return False
+    return settings.NOTIFICATION_DIGEST_MODE or not has_audience(promo_id, run_date)
+
+
+def send_multi_promo_notification(promo_ids, after_id=None, until_id=None,
+                                  publisher=None, dedupe=None, log_buffer=None, record_progress=True,
+                                  lock_tokens=None, timer=None):
+    """
+    Fan-out de varias promos en una sola pasada: carga las promos una
+    vez, recorre en streaming a los usuarios candidatos de todas ellas
+    y asigna a cada usuario la mejor promo aplicable, de modo que la
+    tabla de usuarios se lee una vez en lugar de una vez por promo. Con
+    after_id/until_id se limita a un shard de ids (after_id, until_id].
+
+    Cada promo guarda su FanoutCheckpoint del shard: tras cada bloque
+    del cursor se escriben los logs pendientes y se avanza last_user_id
+    con los contadores de la promo. Al reanudar, cada promo solo evalúa
+    los usuarios posteriores a su checkpoint.
+
+    En modo digest (NOTIFICATION_DIGEST_MODE) cada usuario recibe en un
+    único mensaje todas las promos que le aplican; los contadores se
+    imputan a la promo principal del digest.
+
+    publisher, dedupe, log_buffer, record_progress y timer se comportan
+    como en send_flash_promo_notification; lock_tokens ({promo_id: token}) son los
+    locks que renueva cada avance. Las promos cuyo checkpoint del shard
+    sigue vivo en otro worker se omiten.
+
+    Devuelve un diccionario {promo_id: contadores}.
+    """
+    timer = timer or NULL_TIMER
+    with timer.stage('eligibility'):
+        promo_set = load_active_promo_set(promo_ids)
+        stats = {
+            promo.id: {'sent': 0, 'failed': 0, 'queued': 0, 'skipped': 0}
+            for promo in promo_set.promos
+        }
+        if not len(promo_set):
+            return stats
+
+        today = timezone.now().date()
+        lock_tokens = lock_tokens or {}
+        checkpoints = {
+            promo.id: start_fanout_checkpoint(
+                promo, today, after_id, until_id, record_progress, lock_tokens.get(promo.id)
+            )
+            for promo in promo_set.promos
+        }
+    checkpoints = {promo_id: checkpoint for promo_id, checkpoint in checkpoints.items() if checkpoint}
+    if len(checkpoints) < len(promo_set):
+        promo_set = ActivePromoSet([promo for promo in promo_set.promos if promo.id in checkpoints])
+        if not len(promo_set):
+            return stats
+    last_user_ids = {promo_id: checkpoint.last_user_id for promo_id, checkpoint in checkpoints.items()}
+    promo_set.resume_after(last_user_ids)
+    # El recorrido empieza en la promo más atrasada
+    start_after = after_id
+    if None not in last_user_ids.values():
+        start_after = min(last_user_ids.values())
+
+    users = User.objects.filter(promo_set.audience_filter())
+    if start_after is not None:
+        users = users.filter(id__gt=start_after)
+    if until_id is not None:
+        users = users.filter(id__lte=until_id)
+
+    chunk_size = settings.NOTIFICATION_STREAM_CHUNK_SIZE
+    rows = (
+        users.order_by('id')
+        .values_list('id', 'latitude', 'longitude', 'user_type')
+        .iterator(chunk_size=chunk_size)
+    )
+
+    dedupe = dedupe or get_daily_dedupe(today)
+    if publisher is None and settings.NOTIFICATION_DELIVERY_MODE == 'inline':
+        publisher = SNSBatchPublisher()
+    batch_size = get_fanout_batch_size()
+    digest_mode = settings.NOTIFICATION_DIGEST_MODE
+    # Usuarios pendientes por grupo: tupla de índices de promos (la
+    # principal primero); sin digest cada grupo es una única promo
+    pending = {}
+    # Contadores de cada promo desde el último avance de su checkpoint
+    chunk_stats = {}
+
+    def notify(group):
+        promo = promo_set.promos[group[0]]
+        digest_promos = [promo_set.promos[index] for index in group]
+        batch = pending.pop(group)
+        user_ids = dedupe.claim(
+            dedupe.exclude_notified(batch), promo.id, recover=checkpoints[promo.id].resumed
+        )
+        promo_stats = chunk_stats.setdefault(promo.id, {'skipped': 0})
+        promo_stats['skipped'] += len(batch) - len(user_ids)
+        if user_ids:
+            batch_stats = notify_claimed_batch(
+                user_ids, promo, publisher, log_buffer, dedupe, digest_promos=digest_promos
+            )
+            for key, value in batch_stats.items():
+                promo_stats[key] = promo_stats.get(key, 0) + value
+
+    with log_buffer or NotificationLogBuffer() as log_buffer:
+        for chunk in timer.timed_iter('scan', chunked(rows, chunk_size)):
+            ids = [row[0] for row in chunk]
+            with timer.stage('geo'):
+                coords = np.array([row[1:3] for row in chunk], dtype=float)
+                user_types = [row[3] for row in chunk]
+                if digest_mode:
+                    groups = promo_set.digest_groups(coords[:, 0], coords[:, 1], user_types, ids)
+                else:
+                    best = promo_set.best_promo_indexes(coords[:, 0], coords[:, 1], user_types, ids)
+                    groups = [(index,) if index >= 0 else () for index in best.tolist()]
+            for user_id, group in zip(ids, groups):
+                if not group:
+                    continue
+                pending.setdefault(group, []).append(user_id)
+                if len(pending[group]) >= batch_size:
+                    notify(group)
+
+            # Todo el bloque queda escrito antes de avanzar los checkpoints
+            for group in list(pending):
+                notify(group)
+            for promo_id, checkpoint in checkpoints.items():
+                if checkpoint.last_user_id is not None and checkpoint.last_user_id >= ids[-1]:
+                    continue
+                batch_stats = chunk_stats.pop(promo_id, {})
+                save_fanout_checkpoint(checkpoint, ids[-1], batch_stats)
+                for key, value in batch_stats.items():
+                    stats[promo_id][key] += value
+
+    for checkpoint in checkpoints.values():
+        finish_fanout_checkpoint(checkpoint)
+
+    return stats
@@ -0,0 +1,70 @@
+import uuid
+from django.conf import settings
+from .redis_client import get_redis
+
+# Libera el lock solo si sigue perteneciendo a quien lo tomó
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Renueva la expiración solo si el lock sigue perteneciendo al token
+EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Token usado cuando no hay Redis: el fan-out continúa sin exclusión
+UNLOCKED_TOKEN = 'unlocked'
+
+
+def fanout_lock_key(promo_id):
+    return f"locks:fanout:promo:{promo_id}"
+
+
+def acquire_fanout_lock(promo_id, timeout=None):
+    """
+    Toma el lock distribuido del fan-out de una promo (SET NX con
+    expiración). Devuelve el token del lock o None si otro proceso ya lo
+    tiene. Sin Redis disponible devuelve UNLOCKED_TOKEN.
+    """
+    connection = get_redis()
+    if connection is None:
+        return UNLOCKED_TOKEN
+
+    token = uuid.uuid4().hex
+    timeout = timeout or settings.NOTIFICATION_FANOUT_LOCK_TIMEOUT
+    if connection.set(fanout_lock_key(promo_id), token, nx=True, ex=timeout):
+        return token
+    return None
+
+
+def extend_fanout_lock(promo_id, token, timeout=None):
+    """
+    Renueva el lock del fan-out mientras sus shards avanzan: un envío que
+    dura más que NOTIFICATION_FANOUT_LOCK_TIMEOUT no debe dejar que el
+    siguiente tick despache otra vez los mismos shards.
+    """
+    if not token or token == UNLOCKED_TOKEN:
+        return False
+    connection = get_redis()
+    if connection is None:
+        return False
+    timeout = timeout or settings.NOTIFICATION_FANOUT_LOCK_TIMEOUT
+    extend = connection.register_script(EXTEND_LOCK_SCRIPT)
+    return bool(extend(keys=[fanout_lock_key(promo_id)], args=[token, timeout]))
+
+
+def release_fanout_lock(promo_id, token):
+    """Libera el lock del fan-out si el token sigue siendo el propietario"""
+    if not token or token == UNLOCKED_TOKEN:
+        return False
+    connection = get_redis()
+    if connection is None:
+        return False
+    release = connection.register_script(RELEASE_LOCK_SCRIPT)
+    return bool(release(keys=[fanout_lock_key(promo_id)], args=[token]))
@@ -0,0 +1,115 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from decimal import Decimal
+from datetime import time as dtime
+from stores.models import Store, Product
+from promotions.models import FlashPromo
+from notifications.utils import MAX_DISTANCE_KM, get_eligible_users_for_promo, is_user_near_store
+from notifications.proximity import iter_users_within_radius
+import random
+import time
+import tracemalloc
+
+User = get_user_model()
+
+BENCH_PREFIX = 'bench_fanout'
+
+
+class Command(BaseCommand):
+    help = 'Measure peak memory of the promo fan-out audience scan (full models vs streamed columns)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000, help='Number of users to seed')
+        parser.add_argument('--chunk-size', type=int, default=None, help='Rows per streamed chunk')
+        parser.add_argument('--skip-seed', action='store_true', help='Reuse previously seeded benchmark users')
+        parser.add_argument('--skip-legacy', action='store_true', help='Only measure the streaming scan')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the benchmark data at the end')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size'] or settings.NOTIFICATION_STREAM_CHUNK_SIZE
+        promo = self.get_or_create_promo()
+        store = promo.product.store
+
+        if not options['skip_seed']:
+            self.seed_users(store, options['users'])
+
+        audience = get_eligible_users_for_promo(promo)
+        self.stdout.write(f'Candidates in bounding box: {audience.count()}')
+
+        if not options['skip_legacy']:
+            # Enfoque anterior: instancias completas de User en memoria
+            def legacy_scan():
+                return sum(1 for user in list(audience.order_by('id')) if is_user_near_store(user, store))
+            self.report('Full User models', legacy_scan)
+
+        # Enfoque en streaming: solo id y coordenadas, por bloques
+        def streaming_scan():
+            rows = (
+                audience.order_by('id')
+                .values_list('id', 'latitude', 'longitude')
+                .iterator(chunk_size=chunk_size)
+            )
+            return sum(
+                len(chunk_ids)
+                for chunk_ids in iter_users_within_radius(
+                    rows, [(store.latitude, store.longitude)], MAX_DISTANCE_KM, chunk_size
+                )
+            )
+        self.report(f'Streamed columns (chunk_size={chunk_size})', streaming_scan)
+
+        if options['cleanup']:
+            User.objects.filter(username__startswith=BENCH_PREFIX).delete()
+            self.stdout.write('Benchmark data deleted')
+
+    def get_or_create_promo(self):
+        owner, _ = User.objects.get_or_create(
+            username=f'{BENCH_PREFIX}_owner', defaults={'email': f'{BENCH_PREFIX}_owner@example.com'}
+        )
+        store, _ = Store.objects.get_or_create(
+            name='Benchmark Store', owner=owner,
+            defaults={'address': 'Carrera 50 # 53-45, Medellín', 'latitude': 6.2442, 'longitude': -75.5812}
+        )
+        product, _ = Product.objects.get_or_create(
+            name='Benchmark Product', store=store, defaults={'original_price': Decimal('100.00')}
+        )
+        promo, _ = FlashPromo.objects.get_or_create(
+            product=product,
+            defaults={
+                'promo_price': Decimal('50.00'), 'start_time': dtime(0, 0), 'end_time': dtime(23, 59),
+                'eligible_segments': ['new_users', 'frequent_buyers'], 'is_active': True
+            }
+        )
+        return promo
+
+    def seed_users(self, store, count):
+        self.stdout.write(f'Seeding {count} users around {store.name}...')
+        timestamp = int(time.time())
+        batch_size = 5000
+        for start in range(0, count, batch_size):
+            # Usuarios en un radio de ~3km para que el filtro exacto descarte una parte
+            User.objects.bulk_create([
+                User(
+                    username=f'{BENCH_PREFIX}_{timestamp}_{i}',
+                    email=f'{BENCH_PREFIX}_{timestamp}_{i}@example.com',
+                    password='!',
+                    user_type=random.choice(['new', 'frequent']),
+                    latitude=store.latitude + random.uniform(-0.027, 0.027),
+                    longitude=store.longitude + random.uniform(-0.027, 0.027),
+                    notification_preferences={'categories': ['tech'], 'push': True}
+                )
+                for i in range(start, min(start + batch_size, count))
+            ], batch_size)
+            if (start // batch_size) % 20 == 0:
+                self.stdout.write(f'Created {min(start + batch_size, count)} users...')
+
+    def report(self, label, scan):
+        tracemalloc.start()
+        started = time.perf_counter()
+        nearby = scan()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(self.style.SUCCESS(
+            f'{label}: {nearby} nearby users, peak {peak / 1024 / 1024:.1f} MB, {elapsed:.1f}s'
+        ))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from notifications.dryrun import dry_run_flash_promo_notification
+import json
+
+
+class Command(BaseCommand):
+    help = 'Run a promo fan-out without sending anything and report audience, timings and projected duration'
+
+    def add_arguments(self, parser):
+        parser.add_argument('promo_id', type=int, help='FlashPromo id')
+        parser.add_argument('--after-id', type=int, default=None, help='Only users with id greater than this')
+        parser.add_argument('--until-id', type=int, default=None, help='Only users with id up to this')
+        parser.add_argument('--rates', type=float, nargs='+', default=None,
+                            help='Publish rates (messages/s) to project; defaults to the configured rate')
+        parser.add_argument('--json', action='store_true', help='Print the raw report as JSON')
+
+    def handle(self, *args, **options):
+        report = dry_run_flash_promo_notification(
+            options['promo_id'], options['after_id'], options['until_id'], options['rates']
+        )
+        if 'error' in report:
+            raise CommandError(report['error'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(f"Dry-run fan-out for promo {report['promo_id']} ({report['engine']} engine)")
+        self.stdout.write(f"  Audience: {report['audience']}")
+        self.stdout.write(f"  Already notified today: {report['already_notified']}")
+        self.stdout.write(f"  Would send: {report['would_send']} messages in {report['publish_calls']} PublishBatch calls")
+        self.stdout.write(f"  Queries executed: {report['queries']}")
+        self.stdout.write('  Stage timings:')
+        for stage, seconds in report['timings'].items():
+            self.stdout.write(f"    {stage}: {seconds:.3f}s")
+        self.stdout.write('  Projected wall-clock:')
+        for projection in report['projections']:
+            rate = f"{projection['rate']:.0f} msg/s" if projection['rate'] else 'unlimited'
+            self.stdout.write(f"    at {rate}: {projection['seconds']:.1f}s")
+        self.stdout.write(self.style.SUCCESS('Dry-run completed, nothing was sent'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from notifications.models import UserStoreProximity
+from notifications.store_proximity import rebuild_proximity, refresh_store_proximity
+import time
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialized user-store proximity table (all stores or the given ones)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store', type=int, nargs='+', default=None, help='Only rebuild these store ids')
+        parser.add_argument('--batch-size', type=int, default=500, help='Stores per batch')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['store']:
+            created = refresh_store_proximity(options['store'])
+        else:
+            created = rebuild_proximity(options['batch_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {created} user-store pairs in {elapsed:.1f}s "
+            f"({UserStoreProximity.objects.count()} rows in the table)"
+        ))
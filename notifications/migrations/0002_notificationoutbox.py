@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-16 23:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('published', 'Published'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('published_at', models.DateTimeField(blank=True, null=True)),
+                ('notification_log', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='notifications.notificationlog')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='notificatio_status_ea8ecc_idx')],
+            },
+        ),
+    ]
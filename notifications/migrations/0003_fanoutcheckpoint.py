@@ -0,0 +1,38 @@
+# Generated by Django 5.2.6 on 2026-10-16 23:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0002_notificationoutbox'),
+        ('promotions', '0003_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FanoutCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_date', models.DateField()),
+                ('shard_key', models.CharField(max_length=50)),
+                ('after_id', models.BigIntegerField(blank=True, null=True)),
+                ('until_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_user_id', models.BigIntegerField(blank=True, null=True)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('queued', models.PositiveIntegerField(default=0)),
+                ('skipped', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed')], default='running', max_length=20)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('flash_promo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fanout_checkpoints', to='promotions.flashpromo')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('flash_promo', 'run_date', 'shard_key'), name='unique_fanout_checkpoint')],
+            },
+        ),
+    ]
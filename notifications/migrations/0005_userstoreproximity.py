@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-17 00:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0004_outbox_retry_schedule'),
+        ('stores', '0003_geohash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStoreProximity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('distance_km', models.FloatField()),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_proximities', to='stores.store')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='store_proximities', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('store', 'user'), name='unique_user_store_proximity')],
+            },
+        ),
+    ]
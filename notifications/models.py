@@ -31,4 +31,102 @@ class NotificationLog(models.Model):
         ]
     
     def __str__(self):
-        return f"Notification to {self.user.username} for {self.store.name} at {self.sent_at}"
\ No newline at end of file
+        return f"Notification to {self.user.username} for {self.store.name} at {self.sent_at}"
+
+class NotificationOutbox(models.Model):
+    """
+    Mensajes pendientes de publicar en SNS (transactional outbox). Se
+    escriben en la misma transacción que su NotificationLog y un relay
+    los publica en lotes. Las entregas fallidas se reintentan a partir
+    de next_attempt_at y tras el último intento quedan como 'dead'.
+    Mientras un relay publica una entrada está en 'processing' y
+    next_attempt_at marca el fin de su lease.
+    """
+    notification_log = models.OneToOneField(
+        NotificationLog, on_delete=models.CASCADE, related_name='outbox'
+    )
+    payload = models.JSONField()
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            ('pending', 'Pending'),
+            ('processing', 'Processing'),
+            ('published', 'Published'),
+            ('failed', 'Failed'),
+            ('dead', 'Dead letter')
+        ],
+        default='pending'
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    published_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+    
+    def __str__(self):
+        return f"Outbox entry {self.id} ({self.status}) for notification {self.notification_log_id}"
+
+
+class FanoutCheckpoint(models.Model):
+    """
+    Progreso de un fan-out (o de uno de sus shards) durante un día.
+    Guarda el último id de usuario procesado para poder reanudar el
+    envío tras un reinicio sin reprocesar usuarios.
+    """
+    flash_promo = models.ForeignKey(FlashPromo, on_delete=models.CASCADE, related_name='fanout_checkpoints')
+    run_date = models.DateField()
+    shard_key = models.CharField(max_length=50)
+    after_id = models.BigIntegerField(null=True, blank=True)
+    until_id = models.BigIntegerField(null=True, blank=True)
+    last_user_id = models.BigIntegerField(null=True, blank=True)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    queued = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            ('running', 'Running'),
+            ('completed', 'Completed')
+        ],
+        default='running'
+    )
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['flash_promo', 'run_date', 'shard_key'],
+                name='unique_fanout_checkpoint'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"Fan-out {self.shard_key} of promo {self.flash_promo_id} on {self.run_date} ({self.status})"
+
+
+class UserStoreProximity(models.Model):
+    """
+    Relación materializada de usuarios y tiendas activas a menos de
+    NOTIFICATION_PROXIMITY_RADIUS_KM. Se recalcula solo para los usuarios
+    o tiendas cuyas coordenadas cambian, de modo que la audiencia de una
+    promo es una lectura del índice (store, user).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='store_proximities')
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, related_name='user_proximities')
+    distance_km = models.FloatField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['store', 'user'], name='unique_user_store_proximity'),
+        ]
+    
+    def __str__(self):
+        return f"User {self.user_id} is {self.distance_km:.2f} km from store {self.store_id}"
@@ -0,0 +1,101 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import NotificationLog, NotificationOutbox
+from .publisher import SNSBatchPublisher
+from .retry import failed_delivery_fields
+
+
+def claim_outbox_batch(batch_size, lease_seconds=None):
+    """
+    Reserva un lote de entradas pendientes (o con el lease vencido de un
+    relay que murió) pasándolas a 'processing' con un lease. Las filas se
+    bloquean con SKIP LOCKED solo durante esta transacción corta, para
+    que varios relays puedan trabajar en paralelo.
+    """
+    now = timezone.now()
+    lease_seconds = lease_seconds or settings.NOTIFICATION_OUTBOX_LEASE_SECONDS
+    with transaction.atomic():
+        entries = list(
+            NotificationOutbox.objects.select_for_update(skip_locked=True)
+            .filter(Q(status='pending') | Q(status='processing', next_attempt_at__lte=now))
+            .order_by('id')[:batch_size]
+        )
+        if entries:
+            NotificationOutbox.objects.filter(id__in=[entry.id for entry in entries]).update(
+                status='processing', next_attempt_at=now + timedelta(seconds=lease_seconds)
+            )
+    return entries
+
+
+def relay_outbox_batch(publisher, batch_size):
+    """
+    Publica un lote de entradas del outbox y actualiza su estado y el de
+    sus NotificationLog. La publicación (que puede esperar al rate
+    limiter o al pacing) se hace fuera de transacción: las entradas se
+    reservan antes con claim_outbox_batch y los resultados se escriben
+    después en otra transacción corta. Devuelve el PublishResult del
+    lote, con las entradas enviadas al dead letter en result.dead, o
+    None si no había pendientes.
+    """
+    entries = claim_outbox_batch(batch_size)
+    if not entries:
+        return None
+
+    result = publisher.publish([(entry.id, entry.payload) for entry in entries])
+    result.dead = []
+
+    with transaction.atomic():
+        if result.delivered:
+            NotificationOutbox.objects.filter(id__in=result.delivered, status='processing').update(
+                status='published', published_at=timezone.now(), next_attempt_at=None,
+                attempts=F('attempts') + 1
+            )
+            NotificationLog.objects.filter(outbox__id__in=result.delivered).update(
+                delivery_status='delivered'
+            )
+        if result.failed:
+            # Cada entrada fallida recibe su propio reintento con jitter o
+            # pasa al dead letter si agotó los intentos
+            # Solo las que siguen reservadas: si el lease venció y otro
+            # relay ya las publicó no se reprograman
+            failed_ids = set(
+                NotificationOutbox.objects.select_for_update()
+                .filter(id__in=result.failed, status='processing')
+                .values_list('id', flat=True)
+            )
+            now = timezone.now()
+            failed_entries = [entry for entry in entries if entry.id in failed_ids]
+            for entry in failed_entries:
+                for field, value in failed_delivery_fields(entry.attempts + 1, now).items():
+                    setattr(entry, field, value)
+            NotificationOutbox.objects.bulk_update(
+                failed_entries, ['status', 'attempts', 'next_attempt_at']
+            )
+            NotificationLog.objects.filter(outbox__id__in=result.failed).update(
+                delivery_status='failed'
+            )
+            result.dead = [entry.id for entry in failed_entries if entry.status == 'dead']
+    return result
+
+
+def relay_outbox(publisher=None, batch_size=None, max_batches=None):
+    """
+    Drena el outbox en lotes hasta vaciarlo o alcanzar max_batches.
+    Devuelve un diccionario con los contadores de entregas.
+    """
+    publisher = publisher or SNSBatchPublisher()
+    batch_size = batch_size or settings.NOTIFICATION_OUTBOX_BATCH_SIZE
+    max_batches = max_batches or settings.NOTIFICATION_OUTBOX_MAX_BATCHES
+
+    stats = {'sent': 0, 'failed': 0, 'dead': 0}
+    for _ in range(max_batches):
+        result = relay_outbox_batch(publisher, batch_size)
+        if result is None:
+            break
+        stats['sent'] += len(result.delivered)
+        stats['failed'] += len(result.failed)
+        stats['dead'] += len(result.dead)
+    return stats
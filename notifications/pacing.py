@@ -0,0 +1,110 @@
+from django.conf import settings
+from .redis_client import get_redis
+
+# Estado compartido del controlador: valores actuales y contadores de la ventana
+PACING_KEY = 'pacing:fanout'
+
+
+def aimd(value, healthy, step, factor, minimum, maximum):
+    """
+    Additive increase / multiplicative decrease: suma step si el sistema
+    está sano y multiplica por factor si está bajo presión, siempre
+    dentro de [minimum, maximum].
+    """
+    value = value + step if healthy else value * factor
+    return max(minimum, min(maximum, value))
+
+
+class AdaptivePacer:
+    """
+    Controlador AIMD del fan-out. Los publicadores registran entregas y
+    fallos en Redis; una tarea periódica combina la tasa de error de la
+    ventana con la tendencia de la cola SQS y ajusta la tasa de
+    publicación (mensajes/s) y el tamaño de lote que usan todos los
+    workers. La cola solo cuenta como presión mientras supera el umbral
+    y sigue creciendo: un consumidor lento que no la vacía no deja el
+    fan-out frenado para siempre.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def state(self):
+        """Tasa y tamaño de lote vigentes (los máximos hasta el primer ajuste)"""
+        rate, batch_size = self.connection.hmget(PACING_KEY, 'rate', 'batch_size')
+        return {
+            'rate': float(rate) if rate is not None else settings.NOTIFICATION_PACING_MAX_RATE,
+            'batch_size': int(float(batch_size)) if batch_size is not None else settings.NOTIFICATION_FANOUT_BATCH_SIZE,
+        }
+
+    def record_publish(self, delivered, failed):
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.hincrby(PACING_KEY, 'delivered', delivered)
+        pipeline.hincrby(PACING_KEY, 'failed', failed)
+        pipeline.execute()
+
+    def adjust(self, queue_depth):
+        """
+        Cierra la ventana actual y calcula los nuevos valores. Devuelve
+        un diccionario con el estado aplicado y las señales usadas.
+        """
+        # Leer y reiniciar los contadores de forma atómica, junto con la
+        # profundidad de la cola en el ajuste anterior
+        pipeline = self.connection.pipeline(transaction=True)
+        pipeline.hmget(PACING_KEY, 'delivered', 'failed', 'queue_depth')
+        pipeline.hdel(PACING_KEY, 'delivered', 'failed')
+        (delivered, failed, previous_depth), _ = pipeline.execute()
+        delivered = int(delivered or 0)
+        failed = int(failed or 0)
+
+        attempts = delivered + failed
+        error_rate = failed / attempts if attempts else 0.0
+        queue_growing = queue_depth is not None and (
+            previous_depth is None or queue_depth > int(previous_depth)
+        )
+        healthy = (
+            error_rate <= settings.NOTIFICATION_PACING_ERROR_THRESHOLD
+            and not (queue_growing and queue_depth > settings.NOTIFICATION_PACING_QUEUE_THRESHOLD)
+        )
+
+        current = self.state()
+        factor = settings.NOTIFICATION_PACING_DECREASE_FACTOR
+        rate = aimd(
+            current['rate'], healthy, settings.NOTIFICATION_PACING_RATE_STEP, factor,
+            settings.NOTIFICATION_PACING_MIN_RATE, settings.NOTIFICATION_PACING_MAX_RATE
+        )
+        batch_size = int(aimd(
+            current['batch_size'], healthy, settings.NOTIFICATION_PACING_BATCH_STEP, factor,
+            settings.NOTIFICATION_PACING_MIN_BATCH_SIZE, settings.NOTIFICATION_FANOUT_BATCH_SIZE
+        ))
+        mapping = {'rate': rate, 'batch_size': batch_size}
+        if queue_depth is not None:
+            mapping['queue_depth'] = queue_depth
+        self.connection.hset(PACING_KEY, mapping=mapping)
+
+        return {
+            'rate': rate,
+            'batch_size': batch_size,
+            'error_rate': error_rate,
+            'queue_depth': queue_depth,
+            'queue_growing': queue_growing,
+            'healthy': healthy,
+        }
+
+
+def get_pacer():
+    """Controlador compartido o None si está desactivado o no hay Redis"""
+    if not settings.NOTIFICATION_PACING_ENABLED:
+        return None
+    connection = get_redis()
+    if connection is None:
+        return None
+    return AdaptivePacer(connection)
+
+
+def get_fanout_batch_size():
+    """Tamaño de lote del fan-out: el del controlador o el configurado"""
+    pacer = get_pacer()
+    if pacer is None:
+        return settings.NOTIFICATION_FANOUT_BATCH_SIZE
+    return pacer.state()['batch_size']
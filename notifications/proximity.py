@@ -0,0 +1,78 @@
+from itertools import islice
+
+import numpy as np
+
+# Radio de la tierra en kilómetros
+EARTH_RADIUS_KM = 6371
+
+
+def haversine_matrix(lats, lons, ref_lats, ref_lons):
+    """
+    Distancias haversine en kilómetros entre N puntos y M puntos de
+    referencia, calculadas en una sola pasada vectorizada.
+    Devuelve una matriz de forma (N, M).
+    """
+    lat1 = np.radians(np.asarray(lats, dtype=float))[:, np.newaxis]
+    lon1 = np.radians(np.asarray(lons, dtype=float))[:, np.newaxis]
+    lat2 = np.radians(np.asarray(ref_lats, dtype=float))[np.newaxis, :]
+    lon2 = np.radians(np.asarray(ref_lons, dtype=float))[np.newaxis, :]
+
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def user_coordinate_arrays(rows):
+    """
+    Convierte filas (id, latitude, longitude), por ejemplo de
+    values_list('id', 'latitude', 'longitude'), en arrays de NumPy.
+    Las coordenadas nulas se representan como NaN.
+    """
+    rows = list(rows)
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    coords = np.array([row[1:3] for row in rows], dtype=float).reshape(len(rows), 2)
+    return ids, coords[:, 0], coords[:, 1]
+
+
+def ids_within_radius(ids, lats, lons, stores, max_distance_km):
+    """
+    Devuelve los ids (en el orden recibido) cuya distancia a al menos
+    una de las tiendas (lista de tuplas (lat, lon)) es menor o igual a
+    max_distance_km.
+    """
+    if len(ids) == 0 or not stores:
+        return []
+
+    store_lats, store_lons = zip(*stores)
+    distances = haversine_matrix(lats, lons, store_lats, store_lons)
+    # Las comparaciones con NaN son falsas: usuarios sin coordenadas quedan fuera
+    within = (distances <= max_distance_km).any(axis=1)
+    return np.asarray(ids)[within].tolist()
+
+
+def users_within_radius(rows, stores, max_distance_km):
+    """Filtra filas (id, latitude, longitude) cercanas a alguna de las tiendas"""
+    ids, lats, lons = user_coordinate_arrays(rows)
+    return ids_within_radius(ids, lats, lons, stores, max_distance_km)
+
+
+def chunked(iterable, size):
+    """Agrupa un iterable en listas de hasta size elementos sin materializarlo"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_users_within_radius(rows, stores, max_distance_km, chunk_size):
+    """
+    Versión en streaming de users_within_radius: consume las filas en
+    bloques de chunk_size y devuelve los ids cercanos de cada bloque, de
+    modo que la memoria depende del tamaño del bloque y no del total.
+    """
+    for chunk in chunked(rows, chunk_size):
+        yield users_within_radius(chunk, stores, max_distance_km)
@@ -0,0 +1,202 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import boto3
+from botocore.config import Config
+from celery.signals import worker_process_init
+from django.conf import settings
+from .pacing import get_pacer
+from .ratelimit import get_sns_rate_limiter
+
+# Límite de mensajes por llamada a PublishBatch impuesto por SNS
+SNS_MAX_BATCH_SIZE = 10
+
+
+@lru_cache(maxsize=None)
+def get_sns_client():
+    """
+    Cliente SNS compartido por proceso. Reutiliza el pool de conexiones
+    HTTP en lugar de construir un cliente nuevo por cada mensaje. Los
+    clientes boto3 son thread-safe, así que los hilos del publicador
+    concurrente comparten este mismo cliente.
+    """
+    pool_size = max(settings.SNS_MAX_POOL_CONNECTIONS, settings.SNS_PUBLISH_CONCURRENCY)
+    return boto3.client(
+        'sns',
+        endpoint_url=settings.AWS_SNS_ENDPOINT_URL,
+        region_name=settings.AWS_DEFAULT_REGION,
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        config=Config(max_pool_connections=pool_size)
+    )
+
+
+@lru_cache(maxsize=None)
+def get_publish_executor(max_workers):
+    """
+    Pool de hilos del proceso para publicar lotes en paralelo. Se crea
+    en el primer uso y lo comparten todas las publicaciones del proceso,
+    en lugar de crear y destruir hilos en cada lote del fan-out.
+    """
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sns-publish')
+
+
+@worker_process_init.connect
+def reset_sns_client(**kwargs):
+    """Ni los clientes boto3 ni los hilos del pool sobreviven al fork de los workers prefork"""
+    get_sns_client.cache_clear()
+    get_publish_executor.cache_clear()
+
+
+def build_promo_message(user_id, promo):
+    """Construye el texto y el payload JSON de la notificación de una promo"""
+    message_text = f"Flash Promo available: {promo.product.name} at {promo.promo_price}"
+    message = {
+        'user_id': user_id,
+        'promo_id': promo.id,
+        'message': message_text
+    }
+    return message_text, message
+
+
+def build_digest_message(user_id, promos):
+    """
+    Construye un único mensaje con varias promos simultáneas. La primera
+    promo de la lista es la principal y se usa como promo_id.
+    """
+    offers = ', '.join(f"{promo.product.name} at {promo.promo_price}" for promo in promos)
+    message_text = f"{len(promos)} Flash Promos available: {offers}"
+    message = {
+        'user_id': user_id,
+        'promo_id': promos[0].id,
+        'promo_ids': [promo.id for promo in promos],
+        'message': message_text
+    }
+    return message_text, message
+
+
+class PublishResult:
+    """Resultado de una publicación: claves entregadas y fallidas"""
+
+    def __init__(self):
+        self.delivered = []
+        self.failed = []
+
+
+class SNSBatchPublisher:
+    """
+    Publica mensajes en el tópico de flash promos usando PublishBatch,
+    hasta SNS_MAX_BATCH_SIZE mensajes por llamada, con manejo de fallos
+    por entrada. Con max_workers > 1 las llamadas se reparten en el pool
+    de hilos del proceso para mantener varias peticiones en vuelo.
+    """
+
+    def __init__(self, client=None, topic_arn=None, batch_size=SNS_MAX_BATCH_SIZE, rate_limiter=None,
+                 max_workers=None):
+        self.client = client or get_sns_client()
+        self.topic_arn = topic_arn or settings.FLASH_PROMO_TOPIC_ARN
+        self.batch_size = min(batch_size, SNS_MAX_BATCH_SIZE)
+        # Token bucket compartido entre workers para no superar el límite de SNS
+        self.rate_limiter = rate_limiter or get_sns_rate_limiter()
+        self.max_workers = max_workers or settings.SNS_PUBLISH_CONCURRENCY
+        # Controlador adaptativo que recibe las entregas y fallos
+        self.pacer = get_pacer()
+
+    def publish(self, messages):
+        """
+        Publica una lista de tuplas (key, message) y devuelve un
+        PublishResult con las claves entregadas y fallidas.
+        """
+        chunks = [
+            messages[start:start + self.batch_size]
+            for start in range(0, len(messages), self.batch_size)
+        ]
+        if self.max_workers > 1 and len(chunks) > 1:
+            result = self._publish_concurrently(chunks)
+        else:
+            result = PublishResult()
+            for chunk in chunks:
+                self._publish_chunk(chunk, result)
+
+        if self.pacer is not None and messages:
+            self.pacer.record_publish(len(result.delivered), len(result.failed))
+        return result
+
+    def _publish_concurrently(self, chunks):
+        # Contrapresión: como máximo dos lotes pendientes por hilo; el envío
+        # de nuevos lotes se bloquea mientras el pool está saturado
+        slots = threading.BoundedSemaphore(self.max_workers * 2)
+        executor = get_publish_executor(self.max_workers)
+        futures = []
+        for chunk in chunks:
+            slots.acquire()
+            future = executor.submit(self._publish_chunk_result, chunk)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+        # Se combinan en el orden original de los lotes
+        result = PublishResult()
+        for future in futures:
+            chunk_result = future.result()
+            result.delivered.extend(chunk_result.delivered)
+            result.failed.extend(chunk_result.failed)
+        return result
+
+    def _publish_chunk_result(self, chunk):
+        result = PublishResult()
+        self._publish_chunk(chunk, result)
+        return result
+
+    def _publish_chunk(self, chunk, result):
+        entries = [
+            {'Id': str(index), 'Message': json.dumps(message)}
+            for index, (key, message) in enumerate(chunk)
+        ]
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(len(entries))
+        try:
+            response = self.client.publish_batch(
+                TopicArn=self.topic_arn,
+                PublishBatchRequestEntries=entries
+            )
+        except Exception as e:
+            print(f"Error publishing SNS batch: {e}")
+            result.failed.extend(key for key, message in chunk)
+            return
+
+        for failure in response.get('Failed', []):
+            print(f"Error sending notification {failure['Id']}: {failure.get('Message', failure.get('Code'))}")
+
+        # Solo se consideran entregadas las entradas confirmadas por SNS
+        successful_ids = {entry['Id'] for entry in response.get('Successful', [])}
+        for index, (key, message) in enumerate(chunk):
+            if str(index) in successful_ids:
+                result.delivered.append(key)
+            else:
+                result.failed.append(key)
+
+
+class NoOpPublisher:
+    """
+    Publicador para dry-run: agrupa y serializa los mensajes igual que
+    SNSBatchPublisher pero no llama a SNS ni consume tokens del rate
+    limiter. Todas las entradas se consideran entregadas.
+    """
+
+    def __init__(self, batch_size=SNS_MAX_BATCH_SIZE):
+        self.batch_size = min(batch_size, SNS_MAX_BATCH_SIZE)
+        self.calls = 0
+        self.messages = 0
+
+    def publish(self, messages):
+        result = PublishResult()
+        for start in range(0, len(messages), self.batch_size):
+            chunk = messages[start:start + self.batch_size]
+            for key, message in chunk:
+                json.dumps(message)
+                result.delivered.append(key)
+            self.calls += 1
+        self.messages += len(messages)
+        return result
@@ -0,0 +1,98 @@
+import time
+from django.conf import settings
+from .pacing import get_pacer
+from .redis_client import get_redis
+
+# Token bucket atómico. Usa el reloj de Redis para que todos los workers
+# compartan la misma referencia de tiempo. Devuelve {concedidos, espera_ms}.
+TOKEN_BUCKET_SCRIPT = """
+local key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local bucket = redis.call('HMGET', key, 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1])
+local timestamp = tonumber(bucket[2])
+if tokens == nil or timestamp == nil then
+    tokens = capacity
+    timestamp = now
+end
+
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+
+redis.call('HSET', key, 'tokens', tokens, 'timestamp', now)
+redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+
+local wait_ms = 0
+if granted < requested then
+    local missing = math.min(requested - granted, capacity) - tokens
+    wait_ms = math.max(1, math.ceil(missing / rate * 1000))
+end
+return {granted, wait_ms}
+"""
+
+
+class TokenBucket:
+    """
+    Limitador de tasa compartido por todos los procesos a través de
+    Redis. rate es el número de tokens por segundo y capacity el máximo
+    acumulable (tamaño de ráfaga).
+    """
+
+    def __init__(self, connection, key, rate, capacity=None):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.script = connection.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, tokens):
+        """Intenta tomar hasta tokens; devuelve (concedidos, espera_en_segundos)"""
+        granted, wait_ms = self.script(keys=[self.key], args=[self.rate, self.capacity, tokens])
+        return int(granted), int(wait_ms) / 1000
+
+    def acquire(self, tokens):
+        """Bloquea hasta obtener todos los tokens solicitados"""
+        remaining = tokens
+        while remaining > 0:
+            granted, wait = self.try_acquire(remaining)
+            remaining -= granted
+            if remaining > 0:
+                time.sleep(wait)
+
+
+def get_sns_publish_rate():
+    """Tasa de publicación vigente en mensajes/s (0 sin límite)"""
+    rate = settings.SNS_PUBLISH_RATE_LIMIT
+    pacer = get_pacer()
+    if pacer is not None:
+        paced_rate = pacer.state()['rate']
+        rate = min(rate, paced_rate) if rate else paced_rate
+    return rate
+
+
+def get_sns_rate_limiter():
+    """
+    Token bucket para las publicaciones en SNS según
+    SNS_PUBLISH_RATE_LIMIT (mensajes por segundo, 0 lo desactiva). Con
+    el pacing adaptativo activo se usa la tasa del controlador, acotada
+    por SNS_PUBLISH_RATE_LIMIT si está definido. Sin Redis disponible no
+    se aplica límite.
+    """
+    rate = get_sns_publish_rate()
+    if not rate:
+        return None
+    connection = get_redis()
+    if connection is None:
+        return None
+    return TokenBucket(
+        connection,
+        'ratelimit:sns:publish',
+        rate,
+        settings.SNS_PUBLISH_BURST or rate
+    )
@@ -0,0 +1,22 @@
+from django.conf import settings
+from redis.exceptions import RedisError
+
+
+def get_redis(alias='default'):
+    """
+    Conexión Redis nativa de la cache indicada, o None si la cache no
+    está respaldada por django-redis (por ejemplo en la configuración
+    de tests) o si Redis no responde.
+    """
+    if not settings.CACHES[alias]['BACKEND'].startswith('django_redis'):
+        return None
+
+    from django_redis import get_redis_connection
+
+    try:
+        connection = get_redis_connection(alias)
+        connection.ping()
+    except RedisError as e:
+        print(f"Redis not available: {e}")
+        return None
+    return connection
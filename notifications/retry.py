@@ -0,0 +1,61 @@
+import random
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import NotificationOutbox
+
+
+def backoff_delay(attempts):
+    """
+    Espera en segundos antes del siguiente intento: backoff exponencial
+    con "full jitter" (aleatoria entre 0 y base * 2^(intentos - 1), con
+    tope NOTIFICATION_RETRY_MAX_DELAY) para que los reintentos de muchas
+    entradas no lleguen a SNS sincronizados.
+    """
+    ceiling = min(
+        settings.NOTIFICATION_RETRY_MAX_DELAY,
+        settings.NOTIFICATION_RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0)
+    )
+    return random.uniform(0, ceiling)
+
+
+def failed_delivery_fields(attempts, now=None):
+    """
+    Estado de una entrada del outbox tras su intento fallido número
+    attempts: se programa un reintento o, al alcanzar
+    NOTIFICATION_RETRY_MAX_ATTEMPTS, pasa al dead letter.
+    """
+    now = now or timezone.now()
+    if attempts >= settings.NOTIFICATION_RETRY_MAX_ATTEMPTS:
+        return {'status': 'dead', 'attempts': attempts, 'next_attempt_at': None}
+    return {
+        'status': 'failed',
+        'attempts': attempts,
+        'next_attempt_at': now + timedelta(seconds=backoff_delay(attempts))
+    }
+
+
+def requeue_due_retries(batch_size=None, max_batches=None):
+    """
+    Devuelve a 'pending' las entradas fallidas cuyo reintento ya venció,
+    en lotes de batch_size, para que las publique el relay. Devuelve el
+    número de entradas reencoladas.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_OUTBOX_BATCH_SIZE
+    max_batches = max_batches or settings.NOTIFICATION_OUTBOX_MAX_BATCHES
+    now = timezone.now()
+
+    requeued = 0
+    for _ in range(max_batches):
+        due_ids = list(
+            NotificationOutbox.objects.filter(status='failed', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not due_ids:
+            break
+        # El filtro por estado evita reencolar entradas que otro proceso ya movió
+        requeued += NotificationOutbox.objects.filter(id__in=due_ids, status='failed').update(
+            status='pending', next_attempt_at=None
+        )
+    return requeued
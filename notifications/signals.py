@@ -0,0 +1,33 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from marketplace.geohash import coordinates_updated
+from stores.models import Store
+from users.models import User
+from .store_proximity import maintains_proximity_table, refresh_store_proximity, refresh_user_proximity
+
+
+@receiver(post_save, sender=User)
+def update_user_proximity(sender, instance, **kwargs):
+    """Recalcula las tiendas cercanas de un usuario solo si su ubicación cambió"""
+    if maintains_proximity_table() and getattr(instance, 'coordinates_changed', False):
+        refresh_user_proximity([instance.id])
+
+
+@receiver(post_save, sender=Store)
+def update_store_proximity(sender, instance, **kwargs):
+    """Recalcula los usuarios cercanos de una tienda solo si se creó, movió o (des)activó"""
+    changed = getattr(instance, 'coordinates_changed', False) or getattr(instance, 'is_active_changed', False)
+    if maintains_proximity_table() and changed:
+        refresh_store_proximity([instance.id])
+
+
+@receiver(coordinates_updated, sender=User)
+def update_bulk_user_proximity(sender, pks, **kwargs):
+    if maintains_proximity_table():
+        refresh_user_proximity(pks)
+
+
+@receiver(coordinates_updated, sender=Store)
+def update_bulk_store_proximity(sender, pks, **kwargs):
+    if maintains_proximity_table():
+        refresh_store_proximity(pks)
@@ -0,0 +1,131 @@
+import math
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from stores.models import Store
+from users.models import User
+from .models import UserStoreProximity
+from .proximity import EARTH_RADIUS_KM, chunked, haversine_matrix
+
+
+def proximity_radius_km():
+    return settings.NOTIFICATION_PROXIMITY_RADIUS_KM
+
+
+def maintains_proximity_table():
+    return settings.NOTIFICATION_PROXIMITY_TABLE_ENABLED
+
+
+def uses_proximity_table(max_distance_km):
+    """La tabla solo responde radios que no superan el usado al materializarla"""
+    return (
+        maintains_proximity_table()
+        and settings.NOTIFICATION_AUDIENCE_SOURCE == 'proximity'
+        and max_distance_km <= proximity_radius_km()
+    )
+
+
+def near_store_filter(store, max_distance_km):
+    """Q de usuarios materializados a max_distance_km o menos de la tienda"""
+    return Q(id__in=UserStoreProximity.objects.filter(
+        store=store, distance_km__lte=max_distance_km
+    ).values('user_id'))
+
+
+def refresh_store_proximity(store_ids):
+    """
+    Recalcula las filas de las tiendas indicadas: se borran las actuales
+    y se insertan los usuarios dentro del radio, leyendo solo las celdas
+    de geohash alrededor de cada tienda. Una tienda inactiva o sin
+    coordenadas se queda sin filas.
+    """
+    from .utils import area_filter
+
+    radius_km = proximity_radius_km()
+    batch_size = settings.NOTIFICATION_STREAM_CHUNK_SIZE
+    created = 0
+    for store in Store.objects.filter(id__in=store_ids):
+        with transaction.atomic():
+            UserStoreProximity.objects.filter(store=store).delete()
+            if not store.is_active or store.latitude is None or store.longitude is None:
+                continue
+            rows = (
+                User.objects.filter(area_filter(store.latitude, store.longitude, radius_km))
+                .order_by('id').values_list('id', 'latitude', 'longitude')
+                .iterator(chunk_size=batch_size)
+            )
+            for chunk in chunked(rows, batch_size):
+                coords = np.array([row[1:] for row in chunk], dtype=float)
+                distances = haversine_matrix(coords[:, 0], coords[:, 1], [store.latitude], [store.longitude])[:, 0]
+                entries = [
+                    UserStoreProximity(user_id=row[0], store_id=store.id, distance_km=float(distance))
+                    for row, distance in zip(chunk, distances)
+                    if distance <= radius_km
+                ]
+                UserStoreProximity.objects.bulk_create(entries, batch_size=batch_size)
+                created += len(entries)
+    return created
+
+
+def refresh_user_proximity(user_ids):
+    """
+    Recalcula las filas de los usuarios indicados. Los usuarios se
+    agrupan en celdas de una rejilla con el tamaño del radio: cada celda
+    carga una sola vez las tiendas activas que pueden quedar dentro del
+    radio de alguno de sus usuarios y calcula todas las distancias como
+    una matriz. Un alta o actualización masiva hace una consulta de
+    tiendas por celda ocupada, no por usuario.
+    """
+    from .utils import area_filter
+
+    radius_km = proximity_radius_km()
+    cell_degrees = math.degrees(radius_km / EARTH_RADIUS_KM)
+    # Desde el centro de la celda: el radio más la media diagonal de la
+    # celda (como mucho radius_km / √2), con margen
+    search_km = radius_km * 1.75
+    created = 0
+    for batch in chunked(user_ids, settings.NOTIFICATION_STREAM_CHUNK_SIZE):
+        cells = {}
+        for user_id, lat, lon in User.objects.filter(id__in=batch).values_list('id', 'latitude', 'longitude'):
+            if lat is None or lon is None:
+                continue
+            cell = (math.floor(lat / cell_degrees), math.floor(lon / cell_degrees))
+            cells.setdefault(cell, []).append((user_id, lat, lon))
+
+        entries = []
+        for (row, col), users in cells.items():
+            center_lat = min(max((row + 0.5) * cell_degrees, -90.0), 90.0)
+            center_lon = (col + 0.5) * cell_degrees
+            stores = list(
+                Store.objects.filter(area_filter(center_lat, center_lon, search_km, model=Store), is_active=True)
+                .values_list('id', 'latitude', 'longitude')
+            )
+            if not stores:
+                continue
+            user_coords = np.array([user[1:] for user in users], dtype=float)
+            store_coords = np.array([store[1:] for store in stores], dtype=float)
+            distances = haversine_matrix(
+                user_coords[:, 0], user_coords[:, 1], store_coords[:, 0], store_coords[:, 1]
+            )
+            for user_index, store_index in zip(*np.nonzero(distances <= radius_km)):
+                entries.append(UserStoreProximity(
+                    user_id=users[user_index][0],
+                    store_id=stores[store_index][0],
+                    distance_km=float(distances[user_index, store_index])
+                ))
+        with transaction.atomic():
+            UserStoreProximity.objects.filter(user_id__in=batch).delete()
+            UserStoreProximity.objects.bulk_create(entries)
+        created += len(entries)
+    return created
+
+
+def rebuild_proximity(batch_size=500):
+    """Reconstruye la tabla completa recorriendo las tiendas por lotes"""
+    store_ids = list(Store.objects.order_by('id').values_list('id', flat=True))
+    created = 0
+    for batch in chunked(store_ids, batch_size):
+        created += refresh_store_proximity(batch)
+    return created
@@ -1,23 +1,54 @@
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.core.management import call_command
 from django.utils import timezone
+from unittest import skipUnless
 from unittest.mock import patch, MagicMock
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from decimal import Decimal
-from datetime import date, time
+from datetime import date, time, timedelta
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 import json
+import random
+from io import StringIO
+import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from users.models import User
 from stores.models import Store, Product
 from promotions.models import FlashPromo
-from notifications.models import NotificationLog
+from notifications.models import FanoutCheckpoint, NotificationLog, NotificationOutbox, UserStoreProximity
 from notifications.utils import (
     haversine_distance,
+    bounding_box,
     send_flash_promo_notification,
     get_eligible_users_for_promo,
     is_user_near_store,
     send_sns_notification,
-    process_sqs_messages
+    process_sqs_messages,
+    get_notification_queue_depth
+)
+from notifications.publisher import SNSBatchPublisher, get_publish_executor, get_sns_client, reset_sns_client
+from notifications.buffers import NotificationLogBuffer
+from notifications.proximity import chunked, haversine_matrix, iter_users_within_radius, users_within_radius
+from notifications.dedupe import RedisDailyDedupe, DatabaseDailyDedupe, get_daily_dedupe
+from notifications.outbox import relay_outbox
+from notifications.dryrun import dry_run_flash_promo_notification
+from notifications.audience import (
+    audience_key, audience_shards, compute_audience, has_audience, load_audience, prewarm_audience
+)
+from notifications.engine import ActivePromoSet, get_multi_promo_shards, send_multi_promo_notification
+from notifications.retry import backoff_delay, failed_delivery_fields, requeue_due_retries
+from notifications.ratelimit import TokenBucket, get_sns_rate_limiter
+from notifications.pacing import AdaptivePacer, aimd
+from notifications.locks import UNLOCKED_TOKEN, acquire_fanout_lock, extend_fanout_lock, release_fanout_lock
+from notifications.store_proximity import rebuild_proximity, refresh_store_proximity, refresh_user_proximity
+from notifications.utils import area_filter, get_fanout_frontier, get_fanout_progress, get_fanout_shards
+from marketplace.postgis import (
+    add_location_column, drop_location_column, has_location_column, is_postgis, uses_postgis
 )
 
 
@@ -51,6 +82,88 @@ class HaversineDistanceTest(TestCase):
         self.assertGreater(distance, 15000)
 
 
+class VectorizedProximityTest(TestCase):
+    """Tests para el cálculo vectorizado de proximidad"""
+    
+    def test_haversine_matrix_matches_scalar(self):
+        """Test la matriz coincide con la función escalar"""
+        lats, lons = [40.7580, 40.7831], [-73.9855, -73.9712]
+        ref_lats, ref_lons = [40.7829, -33.8688], [-73.9654, 151.2093]
+        
+        distances = haversine_matrix(lats, lons, ref_lats, ref_lons)
+        
+        self.assertEqual(distances.shape, (2, 2))
+        for i in range(2):
+            for j in range(2):
+                self.assertAlmostEqual(
+                    distances[i, j],
+                    haversine_distance(lats[i], lons[i], ref_lats[j], ref_lons[j]),
+                    places=6
+                )
+    
+    def test_users_within_radius_multiple_stores(self):
+        """Test devuelve los ids cercanos a cualquiera de las tiendas"""
+        rows = [
+            (1, 40.7831, -73.9712),   # Junto a la primera tienda
+            (2, 6.2442, -75.5812),    # Junto a la segunda tienda
+            (3, 41.0000, -74.0000),   # Lejos de ambas
+            (4, None, None),          # Sin coordenadas
+        ]
+        stores = [(40.7831, -73.9712), (6.2442, -75.5812)]
+        
+        self.assertEqual(users_within_radius(rows, stores, 2), [1, 2])
+    
+    def test_users_within_radius_empty(self):
+        """Test sin usuarios no hay resultados"""
+        self.assertEqual(users_within_radius([], [(40.7831, -73.9712)], 2), [])
+    
+    def test_iter_users_within_radius_streams_chunks(self):
+        """Test el filtro en streaming consume las filas por bloques"""
+        rows = iter([
+            (1, 40.7831, -73.9712),
+            (2, 41.0000, -74.0000),
+            (3, 40.7832, -73.9713),
+            (4, None, None),
+            (5, 40.7830, -73.9711),
+        ])
+        
+        chunks = list(iter_users_within_radius(rows, [(40.7831, -73.9712)], 2, 2))
+        
+        self.assertEqual(chunks, [[1], [3], [5]])
+    
+    def test_chunked(self):
+        """Test agrupa un iterable sin conocer su longitud"""
+        self.assertEqual(list(chunked(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+
+class BoundingBoxTest(TestCase):
+    """Tests para el cálculo del bounding box de proximidad"""
+    
+    def test_bounding_box_contains_radius(self):
+        """Test los puntos a la distancia límite quedan dentro del box"""
+        lat, lon = 40.7831, -73.9712
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, 2)
+        
+        self.assertAlmostEqual(haversine_distance(lat, lon, max_lat, lon), 2, places=3)
+        self.assertLess(min_lon, lon)
+        self.assertGreater(max_lon, lon)
+        self.assertGreaterEqual(haversine_distance(lat, lon, lat, max_lon), 2 - 1e-6)
+    
+    def test_bounding_box_antimeridian(self):
+        """Test bounding box que cruza el antimeridiano"""
+        min_lat, max_lat, min_lon, max_lon = bounding_box(0, 179.99, 5)
+        
+        self.assertGreater(min_lon, max_lon)
+    
+    def test_bounding_box_near_pole(self):
+        """Test cerca del polo no se acota la longitud"""
+        min_lat, max_lat, min_lon, max_lon = bounding_box(89.99, 0, 5)
+        
+        self.assertEqual(max_lat, 90.0)
+        self.assertIsNone(min_lon)
+        self.assertIsNone(max_lon)
+
+
 class GetEligibleUsersTest(TestCase):
     """Tests para obtener usuarios elegibles para promociones"""
     
@@ -152,6 +265,35 @@ class GetEligibleUsersTest(TestCase):
         self.assertIn(self.new_user, eligible_users)
         self.assertIn(self.frequent_user, eligible_users)
         self.assertNotIn(self.premium_user, eligible_users)
+    
+    def test_get_eligible_users_excludes_users_outside_bounding_box(self):
+        """Test usuarios lejos de la tienda se descartan en la consulta"""
+        far_user = User.objects.create(
+            username='farnewuser',
+            email='farnew@test.com',
+            user_type='new',
+            latitude=41.0000,
+            longitude=-74.0000
+        )
+        no_coords_user = User.objects.create(
+            username='nocoordsnewuser',
+            email='nocoordsnew@test.com',
+            user_type='new'
+        )
+        promo = FlashPromo.objects.create(
+            product=self.product,
+            promo_price=Decimal('80.00'),
+            start_time=time(9, 0),
+            end_time=time(18, 0),
+            eligible_segments=['new_users'],
+            is_active=True
+        )
+        
+        eligible_users = get_eligible_users_for_promo(promo)
+        
+        self.assertIn(self.new_user, eligible_users)
+        self.assertNotIn(far_user, eligible_users)
+        self.assertNotIn(no_coords_user, eligible_users)
 
 
 class IsUserNearStoreTest(TestCase):
@@ -278,6 +420,9 @@ class SendSNSNotificationTest(TestCase):
             eligible_segments=['new_users'],
             is_active=True
         )
+        
+        # El cliente SNS se comparte por proceso; limpiarlo para usar el mock
+        get_sns_client.cache_clear()
     
     @patch('notifications.utils.boto3.client')
     def test_send_sns_notification_success(self, mock_boto_client):
@@ -425,6 +570,7 @@ class NotificationStatsAPITest(APITestCase):
         self.assertIn('No store found', response.json()['error'])
 
 
+@override_settings(NOTIFICATION_DELIVERY_MODE='inline')
 class SendFlashPromoNotificationTest(TestCase):
     """Tests para el flujo completo de envío de notificaciones"""
     
@@ -468,26 +614,98 @@ class SendFlashPromoNotificationTest(TestCase):
             is_active=True
         )
     
-    @patch('notifications.utils.send_sns_notification')
-    def test_send_flash_promo_notification_success(self, mock_send_sns):
+    def mock_sns_client(self, mock_get_client):
+        """Configura un cliente SNS simulado que confirma todas las entradas"""
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.side_effect = lambda **kwargs: {
+            'Successful': [{'Id': entry['Id']} for entry in kwargs['PublishBatchRequestEntries']],
+            'Failed': []
+        }
+        mock_get_client.return_value = mock_sns
+        return mock_sns
+    
+    @patch('notifications.publisher.get_sns_client')
+    def test_send_flash_promo_notification_success(self, mock_get_client):
         """Test envío exitoso de notificación de flash promo"""
+        mock_sns = self.mock_sns_client(mock_get_client)
+        
         send_flash_promo_notification(self.promo.id)
         
-        # Verificar que se llamó a send_sns_notification
-        mock_send_sns.assert_called_once_with(self.user, self.promo)
+        # Verificar que se publicó un único lote con el usuario
+        mock_sns.publish_batch.assert_called_once()
+        entries = mock_sns.publish_batch.call_args[1]['PublishBatchRequestEntries']
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(json.loads(entries[0]['Message'])['user_id'], self.user.id)
+        
+        # Verificar que se registró la entrega
+        log = NotificationLog.objects.get(user=self.user, flash_promo=self.promo)
+        self.assertEqual(log.delivery_status, 'delivered')
         
         # Verificar que se actualizó last_notification_sent
         self.user.refresh_from_db()
         self.assertEqual(self.user.last_notification_sent, timezone.now().date())
     
+    @patch('notifications.publisher.get_sns_client')
+    def test_send_flash_promo_notification_single_update_per_batch(self, mock_get_client):
+        """Test el frequency cap se actualiza con un único UPDATE por lote"""
+        self.mock_sns_client(mock_get_client)
+        for i in range(3):
+            User.objects.create(
+                username=f'flashuser{i}',
+                email=f'flash{i}@test.com',
+                user_type='new',
+                latitude=40.7831,
+                longitude=-73.9712
+            )
+        
+        with CaptureQueriesContext(connection) as queries:
+            send_flash_promo_notification(self.promo.id)
+        
+        user_updates = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith('UPDATE') and User._meta.db_table in query['sql']
+        ]
+        self.assertEqual(len(user_updates), 1)
+        self.assertIn('last_notification_sent', user_updates[0])
+        self.assertNotIn('password', user_updates[0])
+        self.assertEqual(
+            User.objects.filter(last_notification_sent=timezone.now().date()).count(),
+            4
+        )
+    
+    @override_settings(NOTIFICATION_STREAM_CHUNK_SIZE=2)
+    @patch('notifications.publisher.get_sns_client')
+    def test_send_flash_promo_notification_streams_only_needed_columns(self, mock_get_client):
+        """Test los candidatos se leen por bloques sin cargar columnas como el password"""
+        self.mock_sns_client(mock_get_client)
+        for i in range(4):
+            User.objects.create(
+                username=f'streamuser{i}', email=f'stream{i}@test.com',
+                user_type='new', latitude=40.7831, longitude=-73.9712
+            )
+        
+        with CaptureQueriesContext(connection) as queries:
+            stats = send_flash_promo_notification(self.promo.id)
+        
+        self.assertEqual(stats['sent'], 5)
+        user_selects = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith('SELECT') and f'FROM "{User._meta.db_table}"' in query['sql']
+        ]
+        self.assertTrue(user_selects)
+        for sql in user_selects:
+            self.assertNotIn('"password"', sql)
+    
     def test_send_flash_promo_notification_nonexistent_promo(self):
         """Test manejo de promo inexistente"""
         # No debería lanzar excepción
         send_flash_promo_notification(99999)
     
-    @patch('notifications.utils.send_sns_notification')
-    def test_send_flash_promo_notification_already_notified_today(self, mock_send_sns):
+    @patch('notifications.publisher.get_sns_client')
+    def test_send_flash_promo_notification_already_notified_today(self, mock_get_client):
         """Test usuario ya notificado hoy"""
+        mock_sns = self.mock_sns_client(mock_get_client)
+        
         # Marcar usuario como ya notificado hoy
         self.user.last_notification_sent = timezone.now().date()
         self.user.save()
@@ -495,11 +713,13 @@ class SendFlashPromoNotificationTest(TestCase):
         send_flash_promo_notification(self.promo.id)
         
         # No debería enviar notificación
-        mock_send_sns.assert_not_called()
+        mock_sns.publish_batch.assert_not_called()
     
-    @patch('notifications.utils.send_sns_notification')
-    def test_send_flash_promo_notification_user_far_from_store(self, mock_send_sns):
+    @patch('notifications.publisher.get_sns_client')
+    def test_send_flash_promo_notification_user_far_from_store(self, mock_get_client):
         """Test usuario lejos de la tienda"""
+        mock_sns = self.mock_sns_client(mock_get_client)
+        
         # Mover usuario lejos de la tienda
         self.user.latitude = 41.0000  # Muy lejos
         self.user.longitude = -74.0000
@@ -508,7 +728,1457 @@ class SendFlashPromoNotificationTest(TestCase):
         send_flash_promo_notification(self.promo.id)
         
         # No debería enviar notificación
-        mock_send_sns.assert_not_called()
+        mock_sns.publish_batch.assert_not_called()
+
+
+class SNSBatchPublisherTest(TestCase):
+    """Tests para la publicación por lotes en SNS"""
+    
+    def test_concurrent_publish_keeps_order_and_bounds_threads(self):
+        """Test el pool de hilos mantiene varias llamadas en vuelo sin superar max_workers"""
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+        
+        def publish_batch(**kwargs):
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            threading.Event().wait(0.01)
+            with lock:
+                in_flight.pop()
+            return {'Successful': [{'Id': entry['Id']} for entry in kwargs['PublishBatchRequestEntries']], 'Failed': []}
+        
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.side_effect = publish_batch
+        publisher = SNSBatchPublisher(client=mock_sns, topic_arn='arn:test', max_workers=4)
+        
+        result = publisher.publish([(i, {'user_id': i}) for i in range(200)])
+        
+        self.assertEqual(mock_sns.publish_batch.call_count, 20)
+        self.assertEqual(result.delivered, list(range(200)))
+        self.assertLessEqual(max(peak), 4)
+        self.assertGreater(max(peak), 1)
+    
+    def test_concurrent_publish_reuses_process_pool(self):
+        """Test las publicaciones del proceso comparten un único pool de hilos"""
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.side_effect = lambda **kwargs: {
+            'Successful': [{'Id': entry['Id']} for entry in kwargs['PublishBatchRequestEntries']], 'Failed': []
+        }
+        publisher = SNSBatchPublisher(client=mock_sns, topic_arn='arn:test', max_workers=2)
+        
+        with patch('notifications.publisher.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as mock_executor:
+            get_publish_executor.cache_clear()
+            publisher.publish([(i, {'user_id': i}) for i in range(30)])
+            publisher.publish([(i, {'user_id': i}) for i in range(30)])
+            reset_sns_client()
+            publisher.publish([(i, {'user_id': i}) for i in range(30)])
+        
+        # Uno al primer uso y otro tras el reinicio del proceso del worker
+        self.assertEqual(mock_executor.call_count, 2)
+    
+    def test_concurrent_publish_isolates_failed_batches(self):
+        """Test un lote fallido en un hilo no afecta a los demás"""
+        def publish_batch(**kwargs):
+            entries = kwargs['PublishBatchRequestEntries']
+            if json.loads(entries[0]['Message'])['user_id'] == 10:
+                raise Exception('SNS Error')
+            return {'Successful': [{'Id': entry['Id']} for entry in entries], 'Failed': []}
+        
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.side_effect = publish_batch
+        publisher = SNSBatchPublisher(client=mock_sns, topic_arn='arn:test', max_workers=3)
+        
+        result = publisher.publish([(i, {'user_id': i}) for i in range(30)])
+        
+        self.assertEqual(result.failed, list(range(10, 20)))
+        self.assertEqual(result.delivered, list(range(10)) + list(range(20, 30)))
+    
+    def test_publish_splits_in_batches_of_ten(self):
+        """Test los mensajes se agrupan en llamadas de máximo 10 entradas"""
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.side_effect = lambda **kwargs: {
+            'Successful': [{'Id': entry['Id']} for entry in kwargs['PublishBatchRequestEntries']],
+            'Failed': []
+        }
+        publisher = SNSBatchPublisher(client=mock_sns, topic_arn='arn:test')
+        
+        result = publisher.publish([(i, {'user_id': i}) for i in range(25)])
+        
+        self.assertEqual(mock_sns.publish_batch.call_count, 3)
+        self.assertEqual(result.delivered, list(range(25)))
+        self.assertEqual(result.failed, [])
+    
+    def test_publish_per_entry_failures(self):
+        """Test las entradas rechazadas por SNS se reportan como fallidas"""
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.return_value = {
+            'Successful': [{'Id': '0'}],
+            'Failed': [{'Id': '1', 'Code': 'Throttled', 'SenderFault': False}]
+        }
+        publisher = SNSBatchPublisher(client=mock_sns, topic_arn='arn:test')
+        
+        result = publisher.publish([('a', {}), ('b', {})])
+        
+        self.assertEqual(result.delivered, ['a'])
+        self.assertEqual(result.failed, ['b'])
+    
+    def test_publish_batch_error(self):
+        """Test un error en la llamada marca todo el lote como fallido"""
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.side_effect = Exception('SNS Error')
+        publisher = SNSBatchPublisher(client=mock_sns, topic_arn='arn:test')
+        
+        result = publisher.publish([('a', {}), ('b', {})])
+        
+        self.assertEqual(result.delivered, [])
+        self.assertEqual(result.failed, ['a', 'b'])
+
+
+@override_settings(
+    NOTIFICATION_PACING_MIN_RATE=50, NOTIFICATION_PACING_MAX_RATE=1000, NOTIFICATION_PACING_RATE_STEP=100,
+    NOTIFICATION_PACING_MIN_BATCH_SIZE=50, NOTIFICATION_PACING_BATCH_STEP=50, NOTIFICATION_FANOUT_BATCH_SIZE=500,
+    NOTIFICATION_PACING_DECREASE_FACTOR=0.5, NOTIFICATION_PACING_ERROR_THRESHOLD=0.05,
+    NOTIFICATION_PACING_QUEUE_THRESHOLD=1000
+)
+class AdaptivePacerTest(TestCase):
+    """Tests para el controlador AIMD del fan-out"""
+    
+    def setUp(self):
+        self.connection = MagicMock()
+        self.pipeline = self.connection.pipeline.return_value
+        self.connection.hmget.return_value = [b'600', b'300']
+        self.pacer = AdaptivePacer(self.connection)
+    
+    def test_aimd_bounds(self):
+        """Test suma en salud, divide bajo presión y respeta los límites"""
+        self.assertEqual(aimd(100, True, 10, 0.5, 1, 105), 105)
+        self.assertEqual(aimd(100, False, 10, 0.5, 60, 200), 60)
+        self.assertEqual(aimd(100, False, 10, 0.5, 1, 200), 50)
+    
+    def test_state_defaults_to_maximums(self):
+        """Test sin ajustes previos se usan los valores máximos"""
+        self.connection.hmget.return_value = [None, None]
+        self.assertEqual(self.pacer.state(), {'rate': 1000, 'batch_size': 500})
+    
+    def test_adjust_increases_when_healthy(self):
+        """Test sin errores ni cola acumulada la tasa sube de forma aditiva"""
+        self.pipeline.execute.return_value = [[b'100', b'1', None], 2]
+        
+        state = self.pacer.adjust(queue_depth=10)
+        
+        self.assertTrue(state['healthy'])
+        self.assertEqual((state['rate'], state['batch_size']), (700, 350))
+        self.connection.hset.assert_called_once_with(
+            'pacing:fanout', mapping={'rate': 700, 'batch_size': 350, 'queue_depth': 10}
+        )
+    
+    def test_adjust_decreases_on_error_rate(self):
+        """Test una tasa de error alta reduce tasa y lote a la mitad"""
+        self.pipeline.execute.return_value = [[b'90', b'10', None], 2]
+        
+        state = self.pacer.adjust(queue_depth=10)
+        
+        self.assertFalse(state['healthy'])
+        self.assertAlmostEqual(state['error_rate'], 0.1)
+        self.assertEqual((state['rate'], state['batch_size']), (300, 150))
+    
+    def test_adjust_decreases_on_growing_queue(self):
+        """Test una cola SQS por encima del umbral y creciendo frena el fan-out"""
+        self.pipeline.execute.return_value = [[None, None, b'3000'], 0]
+        
+        state = self.pacer.adjust(queue_depth=5000)
+        
+        self.assertFalse(state['healthy'])
+        self.assertTrue(state['queue_growing'])
+        self.assertEqual(state['rate'], 300)
+    
+    def test_adjust_recovers_when_queue_stops_growing(self):
+        """Test una cola alta que no crece (consumidor lento) no mantiene el fan-out frenado"""
+        self.pipeline.execute.return_value = [[None, None, b'5000'], 0]
+        
+        state = self.pacer.adjust(queue_depth=4990)
+        
+        self.assertTrue(state['healthy'])
+        self.assertEqual(state['rate'], 700)
+    
+    def test_publisher_records_results(self):
+        """Test el publicador informa entregas y fallos al controlador"""
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.return_value = {'Successful': [{'Id': '0'}], 'Failed': [{'Id': '1', 'Code': 'Throttled'}]}
+        publisher = SNSBatchPublisher(client=mock_sns, topic_arn='arn:test', rate_limiter=MagicMock())
+        publisher.pacer = self.pacer
+        
+        publisher.publish([(1, {'user_id': 1}), (2, {'user_id': 2})])
+        
+        self.pipeline.hincrby.assert_any_call('pacing:fanout', 'delivered', 1)
+        self.pipeline.hincrby.assert_any_call('pacing:fanout', 'failed', 1)
+    
+    @override_settings(SNS_PUBLISH_RATE_LIMIT=0, SNS_PUBLISH_BURST=0)
+    @patch('notifications.ratelimit.get_redis')
+    @patch('notifications.ratelimit.get_pacer')
+    def test_rate_limiter_uses_paced_rate(self, mock_get_pacer, mock_get_redis):
+        """Test el token bucket usa la tasa calculada por el controlador"""
+        mock_get_pacer.return_value = self.pacer
+        
+        limiter = get_sns_rate_limiter()
+        
+        self.assertEqual(limiter.rate, 600)
+    
+    @patch('notifications.utils.boto3.client')
+    def test_notification_queue_depth(self, mock_boto_client):
+        """Test se lee la profundidad aproximada de la cola SQS"""
+        mock_boto_client.return_value.get_queue_attributes.return_value = {
+            'Attributes': {'ApproximateNumberOfMessages': '42'}
+        }
+        self.assertEqual(get_notification_queue_depth(), 42)
+        
+        mock_boto_client.return_value.get_queue_attributes.side_effect = Exception('SQS Error')
+        self.assertIsNone(get_notification_queue_depth())
+
+
+class TokenBucketTest(TestCase):
+    """Tests para el limitador de tasa compartido de SNS"""
+    
+    def setUp(self):
+        self.connection = MagicMock()
+        self.script = self.connection.register_script.return_value
+    
+    @patch('notifications.ratelimit.time.sleep')
+    def test_acquire_waits_for_missing_tokens(self, mock_sleep):
+        """Test se espera lo indicado por el script hasta completar los tokens"""
+        self.script.side_effect = [[6, 200], [4, 0]]
+        bucket = TokenBucket(self.connection, 'ratelimit:test', rate=20, capacity=10)
+        
+        bucket.acquire(10)
+        
+        self.assertEqual(self.script.call_count, 2)
+        self.assertEqual(self.script.call_args_list[1][1]['args'], [20, 10, 4])
+        mock_sleep.assert_called_once_with(0.2)
+    
+    def test_publisher_acquires_tokens_per_batch(self):
+        """Test el publisher toma un token por mensaje antes de cada lote"""
+        limiter = MagicMock()
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.side_effect = lambda **kwargs: {
+            'Successful': [{'Id': entry['Id']} for entry in kwargs['PublishBatchRequestEntries']],
+            'Failed': []
+        }
+        publisher = SNSBatchPublisher(client=mock_sns, topic_arn='arn:test', rate_limiter=limiter)
+        
+        publisher.publish([(i, {}) for i in range(15)])
+        
+        self.assertEqual([call[0][0] for call in limiter.acquire.call_args_list], [10, 5])
+
+
+class NotificationLogBufferTest(TestCase):
+    """Tests para la escritura en bloque de NotificationLog"""
+    
+    def setUp(self):
+        self.owner = User.objects.create(username='bufferowner', email='bufferowner@test.com')
+        self.store = Store.objects.create(
+            name='Buffer Store',
+            address='123 Buffer St',
+            owner=self.owner
+        )
+        self.users = [
+            User.objects.create(username=f'bufferuser{i}', email=f'buffer{i}@test.com')
+            for i in range(5)
+        ]
+    
+    def test_buffer_flushes_in_chunks(self):
+        """Test el buffer escribe al alcanzar el tamaño de bloque"""
+        buffer = NotificationLogBuffer(chunk_size=2)
+        for user in self.users:
+            buffer.add(user=user, store=self.store, message='Test')
+        
+        self.assertEqual(NotificationLog.objects.count(), 4)
+        self.assertEqual(len(buffer.rows), 1)
+        
+        buffer.flush()
+        self.assertEqual(NotificationLog.objects.count(), 5)
+        self.assertEqual(buffer.written, 5)
+    
+    def test_buffer_flushes_on_error(self):
+        """Test las filas pendientes se escriben aunque el envío falle"""
+        with self.assertRaises(RuntimeError):
+            with NotificationLogBuffer(chunk_size=100) as buffer:
+                buffer.add(user=self.users[0], store=self.store, message='Test')
+                raise RuntimeError('Fan-out interrumpido')
+        
+        self.assertEqual(NotificationLog.objects.count(), 1)
+
+
+class DailyDedupeTest(TestCase):
+    """Tests para el registro diario de usuarios notificados"""
+    
+    def setUp(self):
+        self.day = date(2025, 9, 22)
+        self.connection = MagicMock()
+        self.pipeline = self.connection.pipeline.return_value
+    
+    def test_redis_exclude_notified(self):
+        """Test se consultan los bits de todo el lote en un pipeline"""
+        self.pipeline.execute.return_value = [1, 0, 0]
+        dedupe = RedisDailyDedupe(self.connection, self.day)
+        
+        self.assertEqual(dedupe.exclude_notified([1, 2, 3]), [2, 3])
+        self.pipeline.getbit.assert_any_call('notifications:sent:20250922', 1)
+        self.assertEqual(self.pipeline.getbit.call_count, 3)
+        self.pipeline.execute.assert_called_once()
+    
+    def test_redis_mark_notified_sets_ttl(self):
+        """Test marcar usuarios activa sus bits y renueva el TTL"""
+        dedupe = RedisDailyDedupe(self.connection, self.day)
+        
+        dedupe.mark_notified([5, 7])
+        
+        self.pipeline.setbit.assert_any_call('notifications:sent:20250922', 5, 1)
+        self.pipeline.setbit.assert_any_call('notifications:sent:20250922', 7, 1)
+        self.pipeline.expire.assert_called_once()
+        self.pipeline.execute.assert_called_once()
+    
+    def test_redis_claim_is_atomic_per_promo(self):
+        """Test solo se reclaman los usuarios cuyo bit de la promo estaba a 0"""
+        self.pipeline.execute.return_value = [0, 1, 0, True]
+        dedupe = RedisDailyDedupe(self.connection, self.day)
+        
+        self.assertEqual(dedupe.claim([1, 2, 3], 42), [1, 3])
+        self.pipeline.setbit.assert_any_call('notifications:promo:42:20250922', 2, 1)
+        self.pipeline.expire.assert_called_once()
+    
+    def test_redis_release_clears_promo_bits(self):
+        """Test liberar un lote pone a 0 los bits de la promo"""
+        dedupe = RedisDailyDedupe(self.connection, self.day)
+        
+        dedupe.release([4, 6], 42)
+        
+        self.pipeline.setbit.assert_any_call('notifications:promo:42:20250922', 4, 0)
+        self.pipeline.setbit.assert_any_call('notifications:promo:42:20250922', 6, 0)
+        self.pipeline.execute.assert_called_once()
+    
+    def test_redis_recover_readmits_claims_without_log(self):
+        """Test al reanudar se recuperan los ids reclamados que no llegaron a registrarse"""
+        owner = User.objects.create(username='recoverowner', email='recoverowner@test.com')
+        store = Store.objects.create(name='Recover Store', address='1 Recover St', owner=owner)
+        product = Product.objects.create(name='Recover Product', original_price=Decimal('10.00'), store=store)
+        promo = FlashPromo.objects.create(
+            product=product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        logged = User.objects.create(username='recoverlogged', email='recoverlogged@test.com')
+        lost = User.objects.create(username='recoverlost', email='recoverlost@test.com')
+        NotificationLog.objects.create(user=logged, store=store, flash_promo=promo)
+        self.pipeline.execute.return_value = [1, 1, True]
+        dedupe = RedisDailyDedupe(self.connection, timezone.now().date())
+        
+        self.assertEqual(dedupe.claim([logged.id, lost.id], promo.id), [])
+        self.assertEqual(dedupe.claim([logged.id, lost.id], promo.id, recover=True), [lost.id])
+    
+    def test_database_claim_skips_logged_users(self):
+        """Test sin Redis se descartan los usuarios con log de la promo en el día"""
+        owner = User.objects.create(username='claimowner', email='claimowner@test.com')
+        store = Store.objects.create(name='Claim Store', address='1 Claim St', owner=owner)
+        product = Product.objects.create(name='Claim Product', original_price=Decimal('10.00'), store=store)
+        promo = FlashPromo.objects.create(
+            product=product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        logged = User.objects.create(username='claimlogged', email='claimlogged@test.com')
+        fresh = User.objects.create(username='claimfresh', email='claimfresh@test.com')
+        NotificationLog.objects.create(user=logged, store=store, flash_promo=promo)
+        dedupe = DatabaseDailyDedupe(timezone.now().date())
+        
+        self.assertEqual(dedupe.claim([logged.id, fresh.id], promo.id), [fresh.id])
+    
+    @override_settings(NOTIFICATION_DEDUPE_BACKEND='redis')
+    @patch('notifications.dedupe.get_redis', return_value=None)
+    def test_fallback_to_database_without_redis(self, mock_get_redis):
+        """Test sin Redis se usa la columna de la tabla de usuarios"""
+        self.assertIsInstance(get_daily_dedupe(self.day), DatabaseDailyDedupe)
+    
+    @override_settings(NOTIFICATION_DEDUPE_BACKEND='redis', NOTIFICATION_DELIVERY_MODE='inline')
+    @patch('notifications.publisher.get_sns_client')
+    @patch('notifications.dedupe.get_redis')
+    def test_fanout_with_redis_does_not_write_users(self, mock_get_redis, mock_get_client):
+        """Test con Redis el fan-out no escribe en la tabla de usuarios"""
+        mock_get_redis.return_value = self.connection
+        self.pipeline.execute.return_value = [0]
+        mock_sns = MagicMock()
+        mock_sns.publish_batch.return_value = {'Successful': [{'Id': '0'}], 'Failed': []}
+        mock_get_client.return_value = mock_sns
+        
+        owner = User.objects.create(username='dedupeowner', email='dedupeowner@test.com')
+        store = Store.objects.create(
+            name='Dedupe Store', address='1 Dedupe St',
+            latitude=40.7831, longitude=-73.9712, owner=owner
+        )
+        product = Product.objects.create(name='Dedupe Product', original_price=Decimal('10.00'), store=store)
+        promo = FlashPromo.objects.create(
+            product=product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        user = User.objects.create(
+            username='dedupeuser', email='dedupeuser@test.com',
+            user_type='new', latitude=40.7831, longitude=-73.9712
+        )
+        
+        send_flash_promo_notification(promo.id)
+        
+        mock_sns.publish_batch.assert_called_once()
+        today = timezone.now().date()
+        self.pipeline.setbit.assert_any_call(f"notifications:promo:{promo.id}:{today:%Y%m%d}", user.id, 1)
+        self.pipeline.setbit.assert_any_call(f"notifications:sent:{today:%Y%m%d}", user.id, 1)
+        user.refresh_from_db()
+        self.assertIsNone(user.last_notification_sent)
+
+
+@override_settings(NOTIFICATION_DELIVERY_MODE='outbox')
+class NotificationOutboxTest(TestCase):
+    """Tests para el outbox transaccional y su relay"""
+    
+    def setUp(self):
+        self.owner = User.objects.create(username='outboxowner', email='outboxowner@test.com')
+        self.store = Store.objects.create(
+            name='Outbox Store', address='1 Outbox St',
+            latitude=40.7831, longitude=-73.9712, owner=self.owner
+        )
+        self.product = Product.objects.create(
+            name='Outbox Product', original_price=Decimal('10.00'), store=self.store
+        )
+        self.promo = FlashPromo.objects.create(
+            product=self.product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        self.users = [
+            User.objects.create(
+                username=f'outboxuser{i}', email=f'outbox{i}@test.com',
+                user_type='new', latitude=40.7831, longitude=-73.9712
+            )
+            for i in range(3)
+        ]
+    
+    @patch('notifications.publisher.get_sns_client')
+    def test_fanout_enqueues_without_publishing(self, mock_get_client):
+        """Test el fan-out escribe log y outbox sin llamar a SNS"""
+        stats = send_flash_promo_notification(self.promo.id)
+        
+        self.assertEqual(stats, {'sent': 0, 'failed': 0, 'queued': 3, 'skipped': 0})
+        mock_get_client.return_value.publish_batch.assert_not_called()
+        self.assertEqual(NotificationOutbox.objects.filter(status='pending').count(), 3)
+        self.assertEqual(NotificationLog.objects.filter(delivery_status='sent').count(), 3)
+        entry = NotificationOutbox.objects.get(notification_log__user=self.users[0])
+        self.assertEqual(entry.payload['user_id'], self.users[0].id)
+    
+    def test_relay_publishes_and_marks_entries(self):
+        """Test el relay publica los pendientes y actualiza su estado"""
+        send_flash_promo_notification(self.promo.id)
+        failed_entry = NotificationOutbox.objects.order_by('id').last()
+        
+        publisher = MagicMock()
+        publisher.publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages if key != failed_entry.id],
+            failed=[key for key, message in messages if key == failed_entry.id]
+        )
+        
+        stats = relay_outbox(publisher=publisher, batch_size=2)
+        
+        self.assertEqual(stats, {'sent': 2, 'failed': 1, 'dead': 0})
+        self.assertEqual(publisher.publish.call_count, 2)
+        self.assertEqual(NotificationOutbox.objects.filter(status='published').count(), 2)
+        failed_entry.refresh_from_db()
+        self.assertEqual(failed_entry.status, 'failed')
+        self.assertEqual(failed_entry.attempts, 1)
+        self.assertIsNotNone(failed_entry.next_attempt_at)
+        self.assertEqual(failed_entry.notification_log.delivery_status, 'failed')
+        self.assertEqual(NotificationLog.objects.filter(delivery_status='delivered').count(), 2)
+    
+    def test_relay_publishes_claimed_entries(self):
+        """Test las entradas quedan reservadas con un lease mientras se publican"""
+        send_flash_promo_notification(self.promo.id)
+        statuses = []
+        
+        def publish(messages):
+            statuses.extend(
+                NotificationOutbox.objects.filter(id__in=[key for key, message in messages])
+                .values_list('status', flat=True)
+            )
+            return MagicMock(delivered=[key for key, message in messages], failed=[])
+        
+        publisher = MagicMock()
+        publisher.publish.side_effect = publish
+        
+        self.assertEqual(relay_outbox(publisher=publisher)['sent'], 3)
+        self.assertEqual(statuses, ['processing'] * 3)
+        self.assertFalse(NotificationOutbox.objects.exclude(status='published').exists())
+        self.assertFalse(NotificationOutbox.objects.filter(next_attempt_at__isnull=False).exists())
+    
+    def test_relay_reclaims_expired_leases(self):
+        """Test una entrada de un relay caído se vuelve a publicar al vencer su lease"""
+        send_flash_promo_notification(self.promo.id)
+        expired, leased, pending = NotificationOutbox.objects.order_by('id')
+        NotificationOutbox.objects.filter(id=expired.id).update(
+            status='processing', next_attempt_at=timezone.now() - timedelta(seconds=1)
+        )
+        NotificationOutbox.objects.filter(id=leased.id).update(
+            status='processing', next_attempt_at=timezone.now() + timedelta(minutes=5)
+        )
+        publisher = MagicMock()
+        publisher.publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages], failed=[]
+        )
+        
+        relay_outbox(publisher=publisher)
+        
+        published = [key for key, message in publisher.publish.call_args[0][0]]
+        self.assertEqual(published, [expired.id, pending.id])
+        leased.refresh_from_db()
+        self.assertEqual(leased.status, 'processing')
+    
+    def test_relay_without_pending_entries(self):
+        """Test el relay no publica si el outbox está vacío"""
+        publisher = MagicMock()
+        
+        self.assertEqual(relay_outbox(publisher=publisher), {'sent': 0, 'failed': 0, 'dead': 0})
+        publisher.publish.assert_not_called()
+    
+    @override_settings(NOTIFICATION_RETRY_MAX_ATTEMPTS=2)
+    def test_failed_entries_retry_until_dead_letter(self):
+        """Test una entrega que sigue fallando se reintenta y acaba en dead letter"""
+        send_flash_promo_notification(self.promo.id)
+        publisher = MagicMock()
+        publisher.publish.side_effect = lambda messages: MagicMock(
+            delivered=[], failed=[key for key, message in messages]
+        )
+        
+        self.assertEqual(relay_outbox(publisher=publisher)['failed'], 3)
+        # El reintento aún no venció: no se reencola nada
+        self.assertEqual(requeue_due_retries(), 0)
+        
+        NotificationOutbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(requeue_due_retries(), 3)
+        stats = relay_outbox(publisher=publisher)
+        
+        self.assertEqual(stats['dead'], 3)
+        self.assertEqual(NotificationOutbox.objects.filter(status='dead', attempts=2).count(), 3)
+        self.assertEqual(requeue_due_retries(), 0)
+    
+    @override_settings(NOTIFICATION_DELIVERY_MODE='inline')
+    @patch('notifications.utils.SNSBatchPublisher')
+    def test_inline_failures_enter_retry_pipeline(self, mock_publisher_class):
+        """Test en modo inline las entregas fallidas quedan programadas para reintento"""
+        mock_publisher_class.return_value.publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages[1:]], failed=[messages[0][0]]
+        )
+        
+        send_flash_promo_notification(self.promo.id)
+        
+        entry = NotificationOutbox.objects.get()
+        self.assertEqual(entry.status, 'failed')
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.payload['user_id'], self.users[0].id)
+        self.assertEqual(entry.notification_log.delivery_status, 'failed')
+
+
+@override_settings(NOTIFICATION_DELIVERY_MODE='inline')
+class MultiPromoEngineTest(TestCase):
+    """Tests para el fan-out de varias promos en una sola pasada"""
+    
+    def setUp(self):
+        owner = User.objects.create(username='engineowner', email='engineowner@test.com')
+        self.store_a = Store.objects.create(
+            name='Engine Store A', address='1 A St', latitude=40.7831, longitude=-73.9712, owner=owner
+        )
+        self.store_b = Store.objects.create(
+            name='Engine Store B', address='1 B St', latitude=40.7931, longitude=-73.9712, owner=owner
+        )
+        self.promo_a = self.create_promo(self.store_a, Decimal('80.00'), ['new_users'])
+        self.promo_b = self.create_promo(self.store_b, Decimal('50.00'), ['new_users', 'frequent_buyers'])
+        
+        self.near_a = self.create_user('enginenear_a', 'new', 40.7731, -73.9712)
+        self.near_b = self.create_user('enginenear_b', 'frequent', 40.8031, -73.9712)
+        self.near_both = self.create_user('enginenear_both', 'new', 40.7881, -73.9712)
+        self.frequent_near_a = self.create_user('enginefrequent_a', 'frequent', 40.7731, -73.9712)
+        self.far = self.create_user('enginefar', 'new', 41.5000, -73.9712)
+    
+    def create_promo(self, store, promo_price, segments):
+        product = Product.objects.create(
+            name=f'Engine Product {store.name}', original_price=Decimal('100.00'), store=store
+        )
+        return FlashPromo.objects.create(
+            product=product, promo_price=promo_price,
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=segments, is_active=True
+        )
+    
+    def create_user(self, username, user_type, latitude, longitude):
+        return User.objects.create(
+            username=username, email=f'{username}@test.com',
+            user_type=user_type, latitude=latitude, longitude=longitude
+        )
+    
+    def test_best_promo_indexes(self):
+        """Test cada usuario recibe la promo elegible con mayor descuento"""
+        promo_set = ActivePromoSet([self.promo_a, self.promo_b])
+        
+        best = promo_set.best_promo_indexes(
+            np.array([40.7731, 40.7881, 40.7731, 41.5, np.nan]),
+            np.array([-73.9712, -73.9712, -73.9712, -73.9712, np.nan]),
+            ['new', 'new', 'regular', 'new', 'new']
+        )
+        
+        self.assertEqual(best.tolist(), [0, 1, -1, -1, -1])
+    
+    @patch('notifications.engine.SNSBatchPublisher')
+    def test_single_pass_assigns_one_promo_per_user(self, mock_publisher_class):
+        """Test los usuarios se leen una vez y cada uno recibe una sola promo"""
+        mock_publisher_class.return_value.publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages], failed=[]
+        )
+        
+        with CaptureQueriesContext(connection) as queries:
+            stats = send_multi_promo_notification([self.promo_a.id, self.promo_b.id])
+        
+        candidate_scans = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith('SELECT') and '"latitude"' in query['sql']
+            and f'FROM "{User._meta.db_table}"' in query['sql']
+        ]
+        self.assertEqual(len(candidate_scans), 1)
+        self.assertEqual(stats[self.promo_a.id]['sent'], 1)
+        self.assertEqual(stats[self.promo_b.id]['sent'], 2)
+        logs = NotificationLog.objects.filter(delivery_status='delivered')
+        self.assertEqual(
+            set(logs.values_list('user_id', 'flash_promo_id')),
+            {
+                (self.near_a.id, self.promo_a.id),
+                (self.near_b.id, self.promo_b.id),
+                (self.near_both.id, self.promo_b.id),
+            }
+        )
+    
+    def test_best_promo_indexes_skip_processed_pairs(self):
+        """Test una promo no vuelve a evaluar los usuarios que ya procesó"""
+        promo_set = ActivePromoSet([self.promo_a, self.promo_b])
+        promo_set.resume_after({self.promo_b.id: 20})
+        
+        best = promo_set.best_promo_indexes(
+            np.array([40.7881, 40.7881]), np.array([-73.9712, -73.9712]), ['new', 'new'], [15, 25]
+        )
+        
+        self.assertEqual(best.tolist(), [0, 1])
+    
+    @patch('notifications.engine.SNSBatchPublisher')
+    def test_single_pass_checkpoints_each_promo(self, mock_publisher_class):
+        """Test el fan-out conjunto guarda un checkpoint por promo con sus propios contadores"""
+        mock_publisher_class.return_value.publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages], failed=[]
+        )
+        
+        send_multi_promo_notification([self.promo_a.id, self.promo_b.id])
+        
+        checkpoint_a = FanoutCheckpoint.objects.get(flash_promo=self.promo_a)
+        checkpoint_b = FanoutCheckpoint.objects.get(flash_promo=self.promo_b)
+        self.assertEqual((checkpoint_a.status, checkpoint_a.sent), ('completed', 1))
+        self.assertEqual((checkpoint_b.status, checkpoint_b.sent), ('completed', 2))
+        self.assertEqual(checkpoint_a.last_user_id, checkpoint_b.last_user_id)
+        progress = get_fanout_progress(self.promo_b, timezone.now().date())
+        self.assertEqual((progress['status'], progress['sent']), ('completed', 2))
+    
+    @patch('notifications.engine.SNSBatchPublisher')
+    def test_single_pass_resumes_from_checkpoints(self, mock_publisher_class):
+        """Test un fan-out conjunto interrumpido se reanuda tras el último usuario procesado"""
+        mock_publisher_class.return_value.publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages], failed=[]
+        )
+        for promo in (self.promo_a, self.promo_b):
+            FanoutCheckpoint.objects.create(
+                flash_promo=promo, run_date=timezone.now().date(), shard_key=':',
+                last_user_id=self.near_a.id
+            )
+        FanoutCheckpoint.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        
+        stats = send_multi_promo_notification([self.promo_a.id, self.promo_b.id])
+        
+        self.assertEqual(stats[self.promo_a.id]['sent'], 0)
+        self.assertEqual(stats[self.promo_b.id]['sent'], 2)
+        self.assertFalse(NotificationLog.objects.filter(user=self.near_a).exists())
+        self.assertEqual(
+            set(FanoutCheckpoint.objects.values_list('status', flat=True)), {'completed'}
+        )
+    
+    @patch('notifications.engine.SNSBatchPublisher')
+    def test_single_pass_respects_segments(self, mock_publisher_class):
+        """Test una promo solo llega a sus segmentos aunque sea la única cercana"""
+        mock_publisher_class.return_value.publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages], failed=[]
+        )
+        
+        stats = send_multi_promo_notification([self.promo_a.id])
+        
+        self.assertEqual(stats, {self.promo_a.id: {'sent': 2, 'failed': 0, 'queued': 0, 'skipped': 0}})
+        notified = set(NotificationLog.objects.values_list('user_id', flat=True))
+        self.assertEqual(notified, {self.near_a.id, self.near_both.id})
+    
+    @override_settings(NOTIFICATION_DIGEST_MODE=True)
+    @patch('notifications.engine.SNSBatchPublisher')
+    def test_digest_coalesces_overlapping_promos(self, mock_publisher_class):
+        """Test en modo digest un usuario con varias promos recibe un solo mensaje"""
+        published = []
+        
+        def publish(messages):
+            published.extend(message for key, message in messages)
+            return MagicMock(delivered=[key for key, message in messages], failed=[])
+        mock_publisher_class.return_value.publish.side_effect = publish
+        
+        stats = send_multi_promo_notification([self.promo_a.id, self.promo_b.id])
+        
+        self.assertEqual(len(published), 3)
+        digest = next(message for message in published if message['user_id'] == self.near_both.id)
+        self.assertEqual(digest['promo_ids'], [self.promo_b.id, self.promo_a.id])
+        self.assertEqual(digest['promo_id'], self.promo_b.id)
+        self.assertTrue(digest['message'].startswith('2 Flash Promos available'))
+        
+        logs = NotificationLog.objects.filter(user=self.near_both)
+        self.assertEqual(logs.count(), 1)
+        self.assertEqual(logs.get().notification_type, 'flash_promo_digest')
+        self.assertEqual(logs.get().flash_promo, self.promo_b)
+        self.assertEqual(
+            NotificationLog.objects.get(user=self.near_a).notification_type, 'flash_promo'
+        )
+        self.assertEqual(stats[self.promo_b.id]['sent'] + stats[self.promo_a.id]['sent'], 3)
+    
+    def test_multi_promo_shards_cover_joint_audience(self):
+        """Test los shards se calculan sobre la audiencia conjunta"""
+        shards = get_multi_promo_shards([self.promo_a.id, self.promo_b.id], 2)
+        
+        self.assertEqual(len(shards), 2)
+        self.assertIsNone(shards[0][0])
+        self.assertIsNone(shards[-1][1])
+
+
+class DryRunFanoutTest(TestCase):
+    """Tests para el dry-run del fan-out"""
+    
+    def setUp(self):
+        owner = User.objects.create(username='dryrunowner', email='dryrunowner@test.com')
+        store = Store.objects.create(
+            name='Dry Run Store', address='1 Dry St', latitude=40.7831, longitude=-73.9712, owner=owner
+        )
+        product = Product.objects.create(name='Dry Run Product', original_price=Decimal('10.00'), store=store)
+        self.promo = FlashPromo.objects.create(
+            product=product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        self.users = [
+            User.objects.create(
+                username=f'dryrunuser{i}', email=f'dryrun{i}@test.com',
+                user_type='new', latitude=40.7831, longitude=-73.9712
+            )
+            for i in range(12)
+        ]
+        # Dentro del bounding box pero fuera del radio
+        User.objects.create(
+            username='dryrunfar', email='dryrunfar@test.com',
+            user_type='new', latitude=40.7831 + 0.0175, longitude=-73.9712 + 0.023
+        )
+        self.users[0].last_notification_sent = timezone.now().date()
+        self.users[0].save()
+    
+    @override_settings(
+        NOTIFICATION_FANOUT_BATCH_SIZE=5, NOTIFICATION_FANOUT_ENGINE='per_promo', NOTIFICATION_DELIVERY_MODE='inline'
+    )
+    @patch('notifications.publisher.get_sns_client')
+    def test_dry_run_reports_without_side_effects(self, mock_get_client):
+        """Test el dry-run recorre el pipeline sin enviar ni escribir"""
+        report = send_flash_promo_notification(self.promo.id, dry_run=True)
+        
+        mock_get_client.return_value.publish_batch.assert_not_called()
+        self.assertEqual(NotificationLog.objects.count(), 0)
+        self.assertEqual(NotificationOutbox.objects.count(), 0)
+        self.assertEqual(FanoutCheckpoint.objects.count(), 0)
+        self.assertEqual(User.objects.filter(last_notification_sent__isnull=False).count(), 1)
+        
+        self.assertEqual(report['engine'], 'per_promo')
+        self.assertEqual(report['audience'], 12)
+        self.assertEqual(report['already_notified'], 1)
+        self.assertEqual(report['would_send'], 11)
+        self.assertEqual(report['batches'], 3)
+        self.assertEqual(report['publish_calls'], 3)
+        self.assertGreater(report['queries'], 0)
+        self.assertTrue({'eligibility', 'scan', 'geo', 'dedupe', 'publish', 'total'} <= set(report['timings']))
+    
+    @override_settings(
+        NOTIFICATION_FANOUT_BATCH_SIZE=5, NOTIFICATION_FANOUT_ENGINE='per_promo', NOTIFICATION_DELIVERY_MODE='outbox'
+    )
+    def test_dry_run_outbox_mode_measures_publish_batches(self):
+        """Test en modo outbox el dry-run mide los PublishBatch que haría el relay"""
+        report = dry_run_flash_promo_notification(self.promo.id)
+        
+        self.assertEqual(report['delivery_mode'], 'outbox')
+        self.assertEqual(report['would_send'], 11)
+        self.assertEqual(report['publish_calls'], 3)
+        self.assertIn('publish', report['timings'])
+        self.assertEqual(NotificationOutbox.objects.count(), 0)
+    
+    @override_settings(NOTIFICATION_FANOUT_BATCH_SIZE=5, NOTIFICATION_FANOUT_ENGINE='single_pass')
+    @patch('notifications.engine.has_audience', return_value=False)
+    @patch('notifications.publisher.get_sns_client')
+    def test_dry_run_follows_single_pass_engine(self, mock_get_client, mock_has_audience):
+        """Test el dry-run recorre el motor de una sola pasada si es el configurado"""
+        report = dry_run_flash_promo_notification(self.promo.id)
+        
+        mock_get_client.return_value.publish_batch.assert_not_called()
+        self.assertEqual(report['engine'], 'single_pass')
+        self.assertTrue({'eligibility', 'scan', 'geo', 'dedupe', 'publish'} <= set(report['timings']))
+        self.assertEqual(report['already_notified'], 1)
+        self.assertEqual(report['would_send'], 11)
+        self.assertEqual(NotificationLog.objects.count(), 0)
+        self.assertEqual(FanoutCheckpoint.objects.count(), 0)
+    
+    @override_settings(NOTIFICATION_DEDUPE_BACKEND='redis')
+    def test_dry_run_does_not_claim_users(self):
+        """Test con Redis el dry-run solo lee las claves de la promo"""
+        connection = MagicMock()
+        pipeline = connection.pipeline.return_value
+        pipeline.execute.return_value = [0] * 100
+        with patch('notifications.dedupe.get_redis', return_value=connection), \
+                patch('notifications.audience.get_redis', return_value=None):
+            report = dry_run_flash_promo_notification(self.promo.id)
+        
+        pipeline.setbit.assert_not_called()
+        self.assertGreater(report['would_send'], 0)
+    
+    def test_dry_run_projects_publish_rates(self):
+        """Test el tiempo proyectado depende de la tasa de publicación"""
+        report = dry_run_flash_promo_notification(self.promo.id, rates=[1, 1000])
+        
+        self.assertEqual(report['projections'][0], {'rate': 1, 'seconds': 11.0})
+        self.assertLess(report['projections'][1]['seconds'], 11.0)
+    
+    def test_dry_run_command(self):
+        """Test el comando muestra el informe"""
+        out = StringIO()
+        call_command('dry_run_fanout', self.promo.id, '--rates', '100', stdout=out)
+        
+        self.assertIn('Would send: 11 messages', out.getvalue())
+        self.assertIn('at 100 msg/s', out.getvalue())
+    
+    def test_dry_run_nonexistent_promo(self):
+        """Test el informe indica el error si la promo no existe"""
+        self.assertIn('error', dry_run_flash_promo_notification(99999))
+
+
+class AudiencePrewarmTest(TestCase):
+    """Tests para la audiencia precalculada antes del inicio de la promo"""
+    
+    def setUp(self):
+        owner = User.objects.create(username='prewarmowner', email='prewarmowner@test.com')
+        store = Store.objects.create(
+            name='Prewarm Store', address='1 Prewarm St', latitude=40.7831, longitude=-73.9712, owner=owner
+        )
+        product = Product.objects.create(name='Prewarm Product', original_price=Decimal('10.00'), store=store)
+        self.promo = FlashPromo.objects.create(
+            product=product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        self.users = [
+            User.objects.create(
+                username=f'prewarmuser{i}', email=f'prewarm{i}@test.com',
+                user_type='new', latitude=40.7831, longitude=-73.9712
+            )
+            for i in range(4)
+        ]
+        # Dentro del bounding box pero fuera del radio
+        User.objects.create(
+            username='prewarmfar', email='prewarmfar@test.com',
+            user_type='new', latitude=40.7831 + 0.0175, longitude=-73.9712 + 0.023
+        )
+        self.today = timezone.now().date()
+        self.blobs = {}
+    
+    def fake_redis(self):
+        """Conexión simulada que guarda los blobs en un diccionario"""
+        connection = MagicMock()
+        connection.set.side_effect = lambda key, value, ex=None: self.blobs.__setitem__(key, value)
+        connection.get.side_effect = self.blobs.get
+        connection.exists.side_effect = lambda key: int(key in self.blobs)
+        connection.delete.side_effect = lambda key: self.blobs.pop(key, None)
+        return connection
+    
+    def test_compute_audience_sorted_within_radius(self):
+        """Test la audiencia son los ids ordenados de los usuarios dentro del radio"""
+        audience = compute_audience(self.promo)
+        
+        self.assertEqual(audience.dtype, np.int64)
+        self.assertEqual(audience.tolist(), [user.id for user in self.users])
+    
+    def test_prewarm_stores_compact_blob(self):
+        """Test la audiencia se guarda como int64 con expiración y se lee por rangos"""
+        ids = [user.id for user in self.users]
+        with patch('notifications.audience.get_redis', return_value=self.fake_redis()):
+            self.assertEqual(prewarm_audience(self.promo, self.today), 4)
+            self.assertEqual(len(self.blobs[audience_key(self.promo.id, self.today)]), 4 * 8)
+            self.assertEqual(load_audience(self.promo.id, self.today).tolist(), ids)
+            self.assertEqual(load_audience(self.promo.id, self.today, ids[0], ids[2]).tolist(), ids[1:3])
+    
+    @patch('notifications.audience.get_redis', return_value=None)
+    def test_without_redis_no_audience(self, mock_get_redis):
+        """Test sin Redis no se precalcula y el fan-out calcula la audiencia"""
+        self.assertIsNone(prewarm_audience(self.promo, self.today))
+        self.assertIsNone(load_audience(self.promo.id, self.today))
+    
+    def test_audience_shards(self):
+        """Test los shards de una audiencia ordenada cubren todos los ids"""
+        self.assertEqual(audience_shards(np.array([3, 5, 8, 13, 21]), 2), [(None, 5), (5, 13), (13, None)])
+        self.assertEqual(audience_shards(np.array([8, 13, 21]), 2, after_id=5), [(5, 13), (13, None)])
+        self.assertEqual(audience_shards(np.array([3, 5]), 2), [(None, None)])
+        self.assertEqual(audience_shards(np.array([], dtype=np.int64), 2), [])
+    
+    @patch('notifications.utils.SNSBatchPublisher')
+    def test_fanout_publishes_precomputed_audience(self, mock_publisher_class):
+        """Test con audiencia precalculada el fan-out no consulta la tabla de usuarios"""
+        with patch('notifications.audience.get_redis', return_value=self.fake_redis()):
+            prewarm_audience(self.promo, self.today)
+            # Un usuario que aparece después del precálculo no se incluye
+            User.objects.create(
+                username='prewarmlate', email='prewarmlate@test.com',
+                user_type='new', latitude=40.7831, longitude=-73.9712
+            )
+            with CaptureQueriesContext(connection) as queries:
+                stats = send_flash_promo_notification(self.promo.id)
+        
+        self.assertEqual(stats['queued'], 4)
+        self.assertFalse(any('"users_user"."latitude"' in query['sql'] for query in queries.captured_queries))
+        self.assertEqual(
+            set(NotificationLog.objects.values_list('user_id', flat=True)),
+            {user.id for user in self.users}
+        )
+
+
+    @patch('notifications.utils.SNSBatchPublisher')
+    def test_newcomers_after_first_pass_use_live_query(self, mock_publisher_class):
+        """Test tras la primera pasada la audiencia precalculada se descarta y los nuevos usuarios se incluyen"""
+        with patch('notifications.audience.get_redis', return_value=self.fake_redis()):
+            prewarm_audience(self.promo, self.today)
+            send_flash_promo_notification(self.promo.id)
+            newcomer = User.objects.create(
+                username='prewarmnewcomer', email='prewarmnewcomer@test.com',
+                user_type='new', latitude=40.7831, longitude=-73.9712
+            )
+            frontier = get_fanout_frontier(self.promo, self.today)
+            
+            self.assertEqual(get_fanout_shards(self.promo, 100, frontier), [(frontier, None)])
+            self.assertFalse(has_audience(self.promo.id, self.today))
+            stats = send_flash_promo_notification(self.promo.id, after_id=frontier)
+        
+        self.assertEqual(stats['queued'], 1)
+        self.assertTrue(NotificationLog.objects.filter(user=newcomer).exists())
+
+
+@override_settings(NOTIFICATION_PROXIMITY_TABLE_ENABLED=True, NOTIFICATION_AUDIENCE_SOURCE='proximity')
+class UserStoreProximityTest(TestCase):
+    """Tests para la tabla materializada de proximidad usuario-tienda"""
+    
+    def setUp(self):
+        owner = User.objects.create(username='proxowner', email='proxowner@test.com')
+        self.store = Store.objects.create(
+            name='Prox Store', address='1 Prox St', latitude=40.7831, longitude=-73.9712, owner=owner
+        )
+        product = Product.objects.create(name='Prox Product', original_price=Decimal('10.00'), store=self.store)
+        self.promo = FlashPromo.objects.create(
+            product=product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        self.near = User.objects.create(
+            username='proxnear', email='proxnear@test.com', user_type='new', latitude=40.7900, longitude=-73.9712
+        )
+        # Dentro del bounding box pero fuera del radio
+        self.far = User.objects.create(
+            username='proxfar', email='proxfar@test.com',
+            user_type='new', latitude=40.7831 + 0.0175, longitude=-73.9712 + 0.023
+        )
+    
+    def pairs(self):
+        return set(UserStoreProximity.objects.values_list('user_id', 'store_id'))
+    
+    def test_new_users_and_stores_are_materialized(self):
+        """Test al crear usuarios y tiendas se guardan solo los pares dentro del radio"""
+        self.assertEqual(self.pairs(), {(self.near.id, self.store.id)})
+        proximity = UserStoreProximity.objects.get()
+        self.assertAlmostEqual(
+            proximity.distance_km, haversine_distance(40.7900, -73.9712, 40.7831, -73.9712), places=6
+        )
+    
+    def test_user_moves_update_only_that_user(self):
+        """Test mover un usuario (save o update masivo) recalcula sus filas"""
+        self.far.latitude, self.far.longitude = 40.7831, -73.9712
+        self.far.save()
+        self.assertEqual(self.pairs(), {(self.near.id, self.store.id), (self.far.id, self.store.id)})
+        
+        User.objects.filter(id=self.near.id).update(latitude=41.5, longitude=-73.9712)
+        self.assertEqual(self.pairs(), {(self.far.id, self.store.id)})
+    
+    def test_bulk_users_load_stores_once_per_cell(self):
+        """Test un alta masiva consulta las tiendas por celda y no por usuario"""
+        other_store = Store.objects.create(
+            name='Prox Store 2', address='2 Prox St', latitude=40.7840, longitude=-73.9700, owner=self.store.owner
+        )
+        with CaptureQueriesContext(connection) as queries:
+            users = User.objects.bulk_create([
+                User(
+                    username=f'proxbulk{i}', email=f'proxbulk{i}@test.com',
+                    user_type='new', latitude=40.7831 + i * 0.0001, longitude=-73.9712
+                )
+                for i in range(20)
+            ])
+        
+        store_queries = [query for query in queries.captured_queries if 'FROM "stores_store"' in query['sql']]
+        self.assertLessEqual(len(store_queries), 2)
+        for user in users:
+            self.assertEqual(
+                set(UserStoreProximity.objects.filter(user=user).values_list('store_id', flat=True)),
+                {self.store.id, other_store.id}
+            )
+    
+    def test_user_refresh_matches_brute_force(self):
+        """Test las filas por celda coinciden con comparar cada usuario con cada tienda"""
+        rng = random.Random(11)
+        owner = self.store.owner
+        for i in range(15):
+            Store.objects.create(
+                name=f'Prox Random {i}', address='x', owner=owner,
+                latitude=40.7831 + rng.uniform(-0.05, 0.05), longitude=-73.9712 + rng.uniform(-0.05, 0.05)
+            )
+        users = User.objects.bulk_create([
+            User(
+                username=f'proxrandom{i}', email=f'proxrandom{i}@test.com', user_type='new',
+                latitude=40.7831 + rng.uniform(-0.05, 0.05), longitude=-73.9712 + rng.uniform(-0.05, 0.05)
+            )
+            for i in range(60)
+        ])
+        stores = list(Store.objects.filter(is_active=True))
+        radius_km = settings.NOTIFICATION_PROXIMITY_RADIUS_KM
+        expected = {
+            (user.id, store.id)
+            for user in users for store in stores
+            if haversine_distance(user.latitude, user.longitude, store.latitude, store.longitude) <= radius_km
+        }
+        
+        self.assertEqual(
+            set(UserStoreProximity.objects.filter(user__in=users).values_list('user_id', 'store_id')), expected
+        )
+    
+    @patch('notifications.signals.refresh_user_proximity')
+    def test_save_without_moving_skips_refresh(self, mock_refresh):
+        """Test guardar un usuario sin cambiar su ubicación no recalcula nada"""
+        user = User.objects.get(id=self.near.id)
+        user.first_name = 'Near'
+        user.save()
+        
+        mock_refresh.assert_not_called()
+    
+    def test_store_move_and_deactivation(self):
+        """Test mover o desactivar una tienda recalcula solo sus filas"""
+        self.store.latitude, self.store.longitude = 40.7831 + 0.0175, -73.9712 + 0.023
+        self.store.save()
+        self.assertEqual(self.pairs(), {(self.far.id, self.store.id)})
+        
+        self.store.is_active = False
+        self.store.save()
+        self.assertEqual(self.pairs(), set())
+    
+    @patch('notifications.signals.refresh_store_proximity')
+    def test_store_save_without_changes_skips_refresh(self, mock_refresh):
+        """Test renombrar una tienda no recalcula sus filas; reactivarla sí"""
+        store = Store.objects.get(id=self.store.id)
+        store.name = 'Renamed Prox Store'
+        store.save()
+        mock_refresh.assert_not_called()
+        
+        store.is_active = False
+        store.save(update_fields=['is_active'])
+        mock_refresh.assert_called_once_with([store.id])
+    
+    @patch('notifications.utils.SNSBatchPublisher')
+    def test_audience_is_an_indexed_join(self, mock_publisher_class):
+        """Test la audiencia se lee de la tabla de proximidad sin filtro geográfico"""
+        audience = get_eligible_users_for_promo(self.promo)
+        self.assertIn('notifications_userstoreproximity', str(audience.query))
+        self.assertNotIn('latitude', str(audience.query).split('WHERE', 1)[1])
+        self.assertEqual(list(audience), [self.near])
+        
+        with patch('notifications.utils.iter_users_within_radius') as mock_geo:
+            stats = send_flash_promo_notification(self.promo.id)
+        
+        mock_geo.assert_not_called()
+        self.assertEqual(stats['queued'], 1)
+    
+    def test_rebuild_command(self):
+        """Test la reconstrucción completa reproduce la tabla"""
+        UserStoreProximity.objects.all().delete()
+        out = StringIO()
+        
+        call_command('rebuild_store_proximity', stdout=out)
+        
+        self.assertIn('Stored 1 user-store pairs', out.getvalue())
+        self.assertEqual(self.pairs(), {(self.near.id, self.store.id)})
+        self.assertEqual(rebuild_proximity(), 1)
+
+
+class PostGISGeoPathTest(TestCase):
+    """Tests para las consultas de radio con ST_DWithin en PostGIS"""
+    
+    def setUp(self):
+        owner = User.objects.create(username='gisowner', email='gisowner@test.com')
+        store = Store.objects.create(
+            name='GIS Store', address='1 GIS St', latitude=40.7831, longitude=-73.9712, owner=owner
+        )
+        product = Product.objects.create(name='GIS Product', original_price=Decimal('10.00'), store=store)
+        self.promo = FlashPromo.objects.create(
+            product=product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        self.near = User.objects.create(
+            username='gisnear', email='gisnear@test.com', user_type='new', latitude=40.7900, longitude=-73.9712
+        )
+    
+    def postgis_schema_editor(self):
+        schema_editor = MagicMock()
+        schema_editor.connection.vendor = 'postgresql'
+        schema_editor.connection.settings_dict = {'ENGINE': 'django.contrib.gis.db.backends.postgis'}
+        return schema_editor
+    
+    def test_fallback_without_postgis(self):
+        """Test en otros backends se usa el bounding box y el geohash"""
+        self.assertFalse(uses_postgis(User))
+        self.assertFalse(has_location_column('users_user'))
+        
+        sql = str(get_eligible_users_for_promo(self.promo).query)
+        self.assertNotIn('ST_DWithin', sql)
+        self.assertIn('"geohash"', sql)
+        self.assertEqual(list(get_eligible_users_for_promo(self.promo)), [self.near])
+    
+    @patch('notifications.utils.uses_postgis', return_value=True)
+    def test_postgis_uses_dwithin(self, mock_uses_postgis):
+        """Test en PostGIS el área es un ST_DWithin sobre la columna geography"""
+        sql, params = get_eligible_users_for_promo(self.promo).query.sql_with_params()
+        
+        self.assertIn('ST_DWithin(location, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s, false)', sql)
+        self.assertNotIn('"latitude" >=', sql)
+        self.assertIn(2000, params)
+        
+        store_sql = str(Store.objects.filter(area_filter(40.7831, -73.9712, 2, model=Store)).query)
+        self.assertIn('SELECT id FROM stores_store WHERE ST_DWithin', store_sql)
+    
+    def test_migration_adds_generated_column_and_gist_index(self):
+        """Test la migración crea la columna generada y el índice GiST solo en PostGIS"""
+        schema_editor = self.postgis_schema_editor()
+        add_location_column(schema_editor, 'users_user')
+        statements = [call.args[0] for call in schema_editor.execute.call_args_list]
+        
+        self.assertTrue(any('GENERATED ALWAYS AS' in sql and 'geography(Point, 4326)' in sql for sql in statements))
+        self.assertTrue(any('USING GIST (location)' in sql for sql in statements))
+        
+        drop_location_column(schema_editor, 'users_user')
+        self.assertIn('ALTER TABLE users_user DROP COLUMN IF EXISTS location', schema_editor.execute.call_args[0][0])
+        
+        sqlite_editor = MagicMock()
+        sqlite_editor.connection = connection
+        add_location_column(sqlite_editor, 'users_user')
+        sqlite_editor.execute.assert_not_called()
+
+
+@skipUnless(is_postgis(connection), 'Requiere una base de datos PostGIS')
+@override_settings(GEO_POSTGIS_ENABLED=True, NOTIFICATION_PROXIMITY_TABLE_ENABLED=True)
+class PostGISDWithinTest(TestCase):
+    """Tests de ST_DWithin contra la columna generada real (settings_test no aplica migraciones)"""
+    
+    def setUp(self):
+        # El DDL de PostgreSQL es transaccional: la columna desaparece con
+        # el rollback del test
+        with connection.schema_editor() as schema_editor:
+            add_location_column(schema_editor, 'users_user')
+            add_location_column(schema_editor, 'stores_store')
+        has_location_column.cache_clear()
+        self.addCleanup(has_location_column.cache_clear)
+        
+        owner = User.objects.create(username='dwithinowner', email='dwithinowner@test.com')
+        self.store = Store.objects.create(
+            name='DWithin Store', address='1 DWithin St', latitude=40.7831, longitude=-73.9712, owner=owner
+        )
+        product = Product.objects.create(name='DWithin Product', original_price=Decimal('10.00'), store=self.store)
+        self.promo = FlashPromo.objects.create(
+            product=product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        self.near = User.objects.create(
+            username='dwithinnear', email='dwithinnear@test.com', user_type='new', latitude=40.7900, longitude=-73.9712
+        )
+        # Dentro del bounding box pero fuera del radio
+        self.far = User.objects.create(
+            username='dwithinfar', email='dwithinfar@test.com',
+            user_type='new', latitude=40.7831 + 0.0175, longitude=-73.9712 + 0.023
+        )
+    
+    def test_eligible_users_within_radius(self):
+        """Test ST_DWithin devuelve el usuario cercano y descarta el de la esquina del bounding box"""
+        self.assertTrue(uses_postgis(User))
+        audience = get_eligible_users_for_promo(self.promo)
+        
+        self.assertIn('ST_DWithin', str(audience.query))
+        self.assertEqual(list(audience), [self.near])
+    
+    def test_proximity_refresh_within_radius(self):
+        """Test la tabla de proximidad se recalcula con ST_DWithin sobre usuarios y tiendas"""
+        UserStoreProximity.objects.all().delete()
+        
+        refresh_store_proximity([self.store.id])
+        self.assertEqual(
+            set(UserStoreProximity.objects.values_list('user_id', 'store_id')), {(self.near.id, self.store.id)}
+        )
+        
+        UserStoreProximity.objects.all().delete()
+        refresh_user_proximity([self.near.id, self.far.id])
+        self.assertEqual(
+            set(UserStoreProximity.objects.values_list('user_id', 'store_id')), {(self.near.id, self.store.id)}
+        )
+
+
+class RetryBackoffTest(TestCase):
+    """Tests para el backoff exponencial con jitter"""
+    
+    @override_settings(NOTIFICATION_RETRY_BASE_DELAY=10, NOTIFICATION_RETRY_MAX_DELAY=60)
+    def test_backoff_delay_is_bounded(self):
+        """Test la espera crece exponencialmente sin superar el tope"""
+        with patch('notifications.retry.random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual([backoff_delay(n) for n in range(1, 6)], [10, 20, 40, 60, 60])
+    
+    @override_settings(NOTIFICATION_RETRY_MAX_ATTEMPTS=3)
+    def test_failed_delivery_fields(self):
+        """Test se programa un reintento hasta agotar los intentos"""
+        now = timezone.now()
+        retry = failed_delivery_fields(2, now)
+        
+        self.assertEqual(retry['status'], 'failed')
+        self.assertGreaterEqual(retry['next_attempt_at'], now)
+        self.assertEqual(
+            failed_delivery_fields(3, now),
+            {'status': 'dead', 'attempts': 3, 'next_attempt_at': None}
+        )
+
+
+@override_settings(NOTIFICATION_DELIVERY_MODE='outbox', NOTIFICATION_FANOUT_BATCH_SIZE=2)
+class FanoutCheckpointTest(TestCase):
+    """Tests para los checkpoints reanudables del fan-out"""
+    
+    def setUp(self):
+        self.owner = User.objects.create(username='checkpointowner', email='checkpointowner@test.com')
+        self.store = Store.objects.create(
+            name='Checkpoint Store', address='1 Checkpoint St',
+            latitude=40.7831, longitude=-73.9712, owner=self.owner
+        )
+        self.product = Product.objects.create(
+            name='Checkpoint Product', original_price=Decimal('10.00'), store=self.store
+        )
+        self.promo = FlashPromo.objects.create(
+            product=self.product, promo_price=Decimal('8.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        self.users = [
+            User.objects.create(
+                username=f'checkpointuser{i}', email=f'checkpoint{i}@test.com',
+                user_type='new', latitude=40.7831, longitude=-73.9712
+            )
+            for i in range(5)
+        ]
+    
+    def test_checkpoint_records_progress(self):
+        """Test el checkpoint avanza por lotes y queda completado"""
+        send_flash_promo_notification(self.promo.id)
+        
+        checkpoint = FanoutCheckpoint.objects.get(flash_promo=self.promo)
+        self.assertEqual(checkpoint.status, 'completed')
+        self.assertEqual(checkpoint.last_user_id, self.users[-1].id)
+        self.assertEqual(checkpoint.queued, 5)
+        self.assertIsNotNone(checkpoint.finished_at)
+    
+    def test_resume_from_interrupted_checkpoint(self):
+        """Test un envío interrumpido se reanuda tras el último usuario procesado"""
+        FanoutCheckpoint.objects.create(
+            flash_promo=self.promo,
+            run_date=timezone.now().date(),
+            shard_key=':',
+            last_user_id=self.users[2].id,
+            queued=3
+        )
+        # Sin avances desde hace más que el timeout del lock: el envío murió
+        FanoutCheckpoint.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        
+        stats = send_flash_promo_notification(self.promo.id)
+        
+        self.assertEqual(stats['queued'], 2)
+        notified = set(NotificationLog.objects.values_list('user_id', flat=True))
+        self.assertEqual(notified, {self.users[3].id, self.users[4].id})
+        checkpoint = FanoutCheckpoint.objects.get(flash_promo=self.promo)
+        self.assertEqual(checkpoint.queued, 5)
+        self.assertEqual(checkpoint.status, 'completed')
+    
+    @override_settings(NOTIFICATION_DEDUPE_BACKEND='redis')
+    @patch('notifications.dedupe.get_redis')
+    def test_resume_recovers_users_claimed_before_a_crash(self, mock_get_redis):
+        """Test los usuarios reclamados sin log por un envío caído no se pierden al reanudar"""
+        pipeline = mock_get_redis.return_value.pipeline.return_value
+        # exclude_notified, claim (ya reclamados por el envío caído) y mark_notified
+        pipeline.execute.side_effect = [[0, 0], [1, 1, True], [True, True, True]]
+        FanoutCheckpoint.objects.create(
+            flash_promo=self.promo,
+            run_date=timezone.now().date(),
+            shard_key=':',
+            last_user_id=self.users[2].id
+        )
+        FanoutCheckpoint.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        
+        stats = send_flash_promo_notification(self.promo.id)
+        
+        self.assertEqual(stats['queued'], 2)
+        self.assertEqual(stats['skipped'], 0)
+    
+    @patch('notifications.utils.get_daily_dedupe')
+    def test_live_checkpoint_is_not_resumed(self, mock_get_dedupe):
+        """Test un shard que otro worker sigue procesando no se reanuda ni recupera reclamaciones"""
+        FanoutCheckpoint.objects.create(
+            flash_promo=self.promo,
+            run_date=timezone.now().date(),
+            shard_key=':',
+            last_user_id=self.users[2].id
+        )
+        
+        stats = send_flash_promo_notification(self.promo.id)
+        
+        self.assertEqual(stats, {'sent': 0, 'failed': 0, 'queued': 0, 'skipped': 0})
+        mock_get_dedupe.return_value.claim.assert_not_called()
+        self.assertFalse(NotificationLog.objects.exists())
+        self.assertEqual(FanoutCheckpoint.objects.get().last_user_id, self.users[2].id)
+    
+    @patch('notifications.utils.extend_fanout_lock')
+    def test_each_batch_extends_the_lock(self, mock_extend):
+        """Test cada lote guardado renueva el lock del fan-out"""
+        send_flash_promo_notification(self.promo.id, lock_token='token')
+        
+        # Lotes de 2 sobre 5 usuarios
+        self.assertEqual(mock_extend.call_count, 3)
+        mock_extend.assert_called_with(self.promo.id, 'token')
+    
+    @patch('notifications.utils.notify_users_batch', side_effect=RuntimeError('flush failed'))
+    def test_failed_batch_releases_claims(self, mock_notify):
+        """Test si el lote falla antes de escribir sus logs se liberan sus claves"""
+        dedupe = MagicMock()
+        dedupe.exclude_notified.side_effect = lambda user_ids: user_ids
+        dedupe.claim.side_effect = lambda user_ids, promo_id, recover=False: user_ids
+        
+        with patch('notifications.utils.get_daily_dedupe', return_value=dedupe):
+            with self.assertRaises(RuntimeError):
+                send_flash_promo_notification(self.promo.id)
+        
+        # Lotes de 2: falla el primero y no se llega a reclamar el resto
+        dedupe.release.assert_called_once_with([self.users[0].id, self.users[1].id], self.promo.id)
+        self.assertFalse(NotificationLog.objects.exists())
+        checkpoint = FanoutCheckpoint.objects.get(flash_promo=self.promo)
+        self.assertIsNone(checkpoint.last_user_id)
+    
+    def test_new_pass_after_completed_run(self):
+        """Test una nueva pasada solo recorre los usuarios posteriores al último procesado"""
+        send_flash_promo_notification(self.promo.id)
+        newcomer = User.objects.create(
+            username='checkpointnewcomer', email='checkpointnewcomer@test.com',
+            user_type='new', latitude=40.7831, longitude=-73.9712
+        )
+        
+        stats = send_flash_promo_notification(self.promo.id)
+        
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['skipped'], 0)
+        self.assertEqual(NotificationLog.objects.count(), 6)
+        checkpoint = FanoutCheckpoint.objects.get(flash_promo=self.promo)
+        self.assertEqual(checkpoint.last_user_id, newcomer.id)
+        self.assertEqual(checkpoint.status, 'completed')
+    
+    def test_fanout_frontier(self):
+        """Test la frontera solo existe cuando todos los shards del día terminaron"""
+        today = timezone.now().date()
+        self.assertIsNone(get_fanout_frontier(self.promo, today))
+        
+        FanoutCheckpoint.objects.create(
+            flash_promo=self.promo, run_date=today, shard_key=f':{self.users[1].id}',
+            until_id=self.users[1].id, last_user_id=self.users[0].id, status='completed'
+        )
+        running = FanoutCheckpoint.objects.create(
+            flash_promo=self.promo, run_date=today, shard_key=f'{self.users[1].id}:',
+            after_id=self.users[1].id, last_user_id=self.users[3].id
+        )
+        self.assertIsNone(get_fanout_frontier(self.promo, today))
+        
+        running.status = 'completed'
+        running.save()
+        self.assertEqual(get_fanout_frontier(self.promo, today), self.users[3].id)
+
+
+class FanoutLockTest(TestCase):
+    """Tests para el lock distribuido del fan-out"""
+    
+    @patch('notifications.locks.get_redis')
+    def test_acquire_uses_set_nx_with_expiry(self, mock_get_redis):
+        """Test el lock se toma con SET NX y expiración"""
+        connection = mock_get_redis.return_value
+        connection.set.return_value = True
+        
+        token = acquire_fanout_lock(7, timeout=30)
+        
+        self.assertTrue(token)
+        connection.set.assert_called_once_with('locks:fanout:promo:7', token, nx=True, ex=30)
+    
+    @patch('notifications.locks.get_redis')
+    def test_acquire_returns_none_when_held(self, mock_get_redis):
+        """Test si otro proceso tiene el lock no se obtiene token"""
+        mock_get_redis.return_value.set.return_value = None
+        self.assertIsNone(acquire_fanout_lock(7))
+    
+    @patch('notifications.locks.get_redis')
+    def test_release_checks_token(self, mock_get_redis):
+        """Test la liberación compara el token en un script atómico"""
+        release = mock_get_redis.return_value.register_script.return_value
+        release.return_value = 1
+        
+        self.assertTrue(release_fanout_lock(7, 'abc'))
+        release.assert_called_once_with(keys=['locks:fanout:promo:7'], args=['abc'])
+    
+    @patch('notifications.locks.get_redis')
+    def test_extend_checks_token(self, mock_get_redis):
+        """Test la renovación solo amplía la expiración si el token sigue siendo el propietario"""
+        extend = mock_get_redis.return_value.register_script.return_value
+        extend.return_value = 1
+        
+        self.assertTrue(extend_fanout_lock(7, 'abc', timeout=30))
+        extend.assert_called_once_with(keys=['locks:fanout:promo:7'], args=['abc', 30])
+        self.assertFalse(extend_fanout_lock(7, UNLOCKED_TOKEN))
+    
+    @patch('notifications.locks.get_redis', return_value=None)
+    def test_without_redis_runs_unlocked(self, mock_get_redis):
+        """Test sin Redis el fan-out continúa sin exclusión"""
+        self.assertEqual(acquire_fanout_lock(7), UNLOCKED_TOKEN)
+        self.assertFalse(release_fanout_lock(7, UNLOCKED_TOKEN))
 
 
 class ProcessSQSMessagesTest(TestCase):
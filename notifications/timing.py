@@ -0,0 +1,51 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class StageTimer:
+    """
+    Acumula el tiempo propio de cada etapa del pipeline: el tiempo de una
+    etapa anidada (p. ej. leer filas mientras se aplica el filtro
+    geográfico) se imputa solo a ella.
+    """
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self._nested = []
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.timings[name] += elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def timed_iter(self, name, iterable):
+        """Itera imputando a la etapa el tiempo de obtener cada elemento"""
+        iterator = iter(iterable)
+        done = object()
+        while True:
+            with self.stage(name):
+                item = next(iterator, done)
+            if item is done:
+                return
+            yield item
+
+
+class NullStageTimer:
+    """Timer del envío real: no mide nada"""
+
+    def stage(self, name):
+        return nullcontext()
+
+    def timed_iter(self, name, iterable):
+        return iterable
+
+
+NULL_TIMER = NullStageTimer()
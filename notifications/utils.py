@@ -1,12 +1,37 @@
 import boto3
 import json
+from datetime import timedelta
 from django.conf import settings
 from django.db.models import Q
 from django.utils import timezone
+from marketplace.geohash import covering_cells, geohash_filter
+from marketplace.postgis import dwithin_filter, uses_postgis
 from users.models import User
 from promotions.models import FlashPromo
-from .models import NotificationLog
+from .models import FanoutCheckpoint, NotificationLog
+from .buffers import NotificationLogBuffer
+from .dedupe import get_daily_dedupe
+from .locks import extend_fanout_lock
+from .pacing import get_fanout_batch_size
+from .publisher import SNSBatchPublisher, build_digest_message, build_promo_message, get_sns_client
+from .retry import failed_delivery_fields
+from .store_proximity import near_store_filter, uses_proximity_table
+from .timing import NULL_TIMER
+from .proximity import EARTH_RADIUS_KM, chunked, iter_users_within_radius
 import math
+
+# Distancia máxima (km) entre usuario y tienda para recibir una promo
+MAX_DISTANCE_KM = 2
+
+# Cola SQS suscrita al tópico de flash promos
+NOTIFICATION_QUEUE_URL_TEMPLATE = "{endpoint}/000000000000/flash-promo-notifications"
+
+# Segmento de FlashPromo.eligible_segments -> User.user_type
+SEGMENT_USER_TYPES = {
+    'new_users': 'new',
+    'frequent_buyers': 'frequent',
+}
+
 def haversine_distance(lat1, lon1, lat2, lon2):
     """
     Calculate the great circle distance between two points 
@@ -21,43 +46,449 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
     c = 2 * math.asin(math.sqrt(a)) 
     
-    # Radius of earth in kilometers
-    r = 6371
-    return c * r
+    return c * EARTH_RADIUS_KM
+
+def bounding_box(lat, lon, distance_km):
+    """
+    Calcula el bounding box (min_lat, max_lat, min_lon, max_lon) que
+    contiene el círculo de radio distance_km alrededor del punto.
+    Cerca de los polos no se puede acotar la longitud y se devuelve
+    None para min_lon/max_lon.
+    """
+    lat_delta = math.degrees(distance_km / EARTH_RADIUS_KM)
+    min_lat = max(lat - lat_delta, -90.0)
+    max_lat = min(lat + lat_delta, 90.0)
+    
+    ratio = None
+    if min_lat > -90.0 and max_lat < 90.0:
+        ratio = math.sin(distance_km / EARTH_RADIUS_KM) / math.cos(math.radians(lat))
+    if ratio is None or ratio >= 1.0:
+        return min_lat, max_lat, None, None
+    
+    lon_delta = math.degrees(math.asin(ratio))
+    min_lon = lon - lon_delta
+    max_lon = lon + lon_delta
+    if min_lon < -180.0:
+        min_lon += 360.0
+    if max_lon > 180.0:
+        max_lon -= 360.0
+    return min_lat, max_lat, min_lon, max_lon
 
-def send_flash_promo_notification(promo_id):
+def send_flash_promo_notification(promo_id, after_id=None, until_id=None, dry_run=False,
+                                  publisher=None, dedupe=None, log_buffer=None, record_progress=True,
+                                  lock_token=None, timer=None):
+    """
+    Envía la promo a los usuarios elegibles cercanos a la tienda. Con
+    after_id/until_id se limita a un shard de ids (after_id, until_id].
+    Con dry_run=True no se envía ni se escribe nada y se devuelve el
+    informe de dry_run_flash_promo_notification.
+    
+    El progreso se guarda en un FanoutCheckpoint tras cada lote; si un
+    envío anterior del mismo día quedó a medias se reanuda desde el
+    último usuario procesado, y si otro worker sigue procesando el shard
+    no se hace nada. Con lock_token cada lote renueva el lock del
+    fan-out. Devuelve un diccionario con los contadores de esta ejecución.
+    
+    publisher, dedupe y log_buffer sustituyen a los componentes de envío
+    y registro, y con record_progress=False el checkpoint solo vive en
+    memoria: el dry-run recorre así este mismo pipeline sin efectos y
+    mide sus etapas con timer (un StageTimer).
+    """
+    if dry_run:
+        from .dryrun import dry_run_flash_promo_notification
+        return dry_run_flash_promo_notification(promo_id, after_id, until_id)
+    
+    from .audience import load_audience
+    
+    stats = {'sent': 0, 'failed': 0, 'queued': 0, 'skipped': 0}
+    timer = timer or NULL_TIMER
     try:
-        promo = FlashPromo.objects.get(id=promo_id)
+        with timer.stage('eligibility'):
+            promo = FlashPromo.objects.select_related('product__store').get(id=promo_id)
+            store = promo.product.store
+            today = timezone.now().date()
+            checkpoint = start_fanout_checkpoint(promo, today, after_id, until_id, record_progress, lock_token)
+            if checkpoint is None:
+                print(f"Shard ({after_id}, {until_id}] of promo {promo_id} is already being processed")
+                return stats
+            
+            # Los usuarios se recorren en orden de id para poder reanudar
+            start_after = checkpoint.last_user_id if checkpoint.last_user_id is not None else after_id
+            
+            # Si la audiencia se precalculó antes del inicio de la promo solo
+            # queda publicar; si no, se calcula ahora
+            audience = load_audience(promo.id, today, start_after, until_id)
+        if audience is not None:
+            nearby_user_ids = (int(user_id) for user_id in audience)
+        else:
+            eligible_users = get_eligible_users_for_promo(promo)
+            if start_after is not None:
+                eligible_users = eligible_users.filter(id__gt=start_after)
+            if until_id is not None:
+                eligible_users = eligible_users.filter(id__lte=until_id)
+            
+            # Solo se leen las columnas necesarias, en streaming con un cursor
+            # del lado del servidor, y el filtro geográfico vectorizado se
+            # aplica por bloques: la memoria no crece con el número de usuarios
+            chunk_size = settings.NOTIFICATION_STREAM_CHUNK_SIZE
+            if uses_proximity_table(MAX_DISTANCE_KM):
+                # La tabla de proximidad ya garantiza la distancia
+                nearby_user_ids = timer.timed_iter('scan', (
+                    eligible_users.order_by('id')
+                    .values_list('id', flat=True)
+                    .iterator(chunk_size=chunk_size)
+                ))
+            else:
+                rows = timer.timed_iter('scan', (
+                    eligible_users.order_by('id')
+                    .values_list('id', 'latitude', 'longitude')
+                    .iterator(chunk_size=chunk_size)
+                ))
+                nearby_user_ids = (
+                    user_id
+                    for chunk_ids in timer.timed_iter('geo', iter_users_within_radius(
+                        rows, [(store.latitude, store.longitude)], MAX_DISTANCE_KM, chunk_size
+                    ))
+                    for user_id in chunk_ids
+                )
         
-        # Obtener usuarios elegibles
-        eligible_users = get_eligible_users_for_promo(promo)
+        # Registro de usuarios que ya recibieron notificación hoy
+        dedupe = dedupe or get_daily_dedupe(today)
         
-        # Filtrar usuarios que ya recibieron notificación hoy
-        today = timezone.now().date()
-        users_to_notify = eligible_users.exclude(last_notification_sent=today)
+        # Enviar notificaciones en lotes con un único publisher compartido
+        # (en modo outbox la publicación la hace el relay)
+        if publisher is None and settings.NOTIFICATION_DELIVERY_MODE == 'inline':
+            publisher = SNSBatchPublisher()
+        batch_size = get_fanout_batch_size()
+        with log_buffer or NotificationLogBuffer() as log_buffer:
+            for batch in chunked(nearby_user_ids, batch_size):
+                user_ids = dedupe.claim(
+                    dedupe.exclude_notified(batch), promo.id, recover=checkpoint.resumed
+                )
+                batch_stats = {'skipped': len(batch) - len(user_ids)}
+                if user_ids:
+                    # Persiste los logs del lote antes de avanzar el checkpoint
+                    batch_stats.update(
+                        notify_claimed_batch(user_ids, promo, publisher, log_buffer, dedupe)
+                    )
+                save_fanout_checkpoint(checkpoint, batch[-1], batch_stats)
+                for key, value in batch_stats.items():
+                    stats[key] += value
         
-        # Enviar notificaciones
-        for user in users_to_notify:
-            if is_user_near_store(user, promo.product.store):
-                send_sns_notification(user, promo)
-                user.last_notification_sent = today
-                user.save()
+        finish_fanout_checkpoint(checkpoint)
                 
     except FlashPromo.DoesNotExist:
         print(f"Promo with id {promo_id} does not exist")
+    
+    return stats
+
+def start_fanout_checkpoint(promo, run_date, after_id, until_id, record_progress=True, lock_token=None):
+    """
+    Obtiene el checkpoint del día para el shard. En ambos casos se
+    conserva last_user_id: si la pasada anterior terminó, la nueva solo
+    recorre los ids posteriores (usuarios dados de alta después); si
+    quedó a medias se reanuda y checkpoint.resumed indica que hay que
+    recuperar los usuarios que reclamó sin llegar a registrarlos.
+    
+    Un checkpoint 'running' solo se da por caído cuando no avanza desde
+    hace más de NOTIFICATION_FANOUT_LOCK_TIMEOUT (el shard vivo lo guarda
+    y renueva el lock en cada lote); mientras tanto se devuelve None y el
+    shard no se procesa. La toma del checkpoint compara updated_at para
+    que solo una ejecución lo reanude.
+    
+    Con record_progress=False se devuelve un checkpoint sin guardar que
+    solo acumula los contadores en memoria.
+    """
+    if not record_progress:
+        checkpoint = FanoutCheckpoint(flash_promo=promo, run_date=run_date, after_id=after_id, until_id=until_id)
+        checkpoint.resumed = False
+        return checkpoint
+    
+    checkpoint, created = FanoutCheckpoint.objects.get_or_create(
+        flash_promo=promo,
+        run_date=run_date,
+        shard_key=f"{after_id or ''}:{until_id or ''}",
+        defaults={'after_id': after_id, 'until_id': until_id}
+    )
+    checkpoint.lock_token = lock_token
+    checkpoint.resumed = False
+    if created:
+        return checkpoint
+    
+    now = timezone.now()
+    if checkpoint.status == 'running':
+        if checkpoint.updated_at > now - timedelta(seconds=settings.NOTIFICATION_FANOUT_LOCK_TIMEOUT):
+            return None
+        checkpoint.resumed = True
+    taken = FanoutCheckpoint.objects.filter(
+        pk=checkpoint.pk, status=checkpoint.status, updated_at=checkpoint.updated_at
+    ).update(status='running', finished_at=None, updated_at=now)
+    if not taken:
+        return None
+    checkpoint.status = 'running'
+    checkpoint.finished_at = None
+    checkpoint.updated_at = now
+    return checkpoint
+
+def save_fanout_checkpoint(checkpoint, last_user_id, batch_stats):
+    """Avanza el checkpoint hasta last_user_id y acumula los contadores del lote"""
+    checkpoint.last_user_id = last_user_id
+    for key, value in batch_stats.items():
+        setattr(checkpoint, key, getattr(checkpoint, key) + value)
+    if checkpoint.pk is not None:
+        checkpoint.save(update_fields=['last_user_id', 'sent', 'failed', 'queued', 'skipped', 'updated_at'])
+        extend_fanout_lock(checkpoint.flash_promo_id, getattr(checkpoint, 'lock_token', None))
+
+def finish_fanout_checkpoint(checkpoint):
+    checkpoint.status = 'completed'
+    checkpoint.finished_at = timezone.now()
+    if checkpoint.pk is not None:
+        checkpoint.save(update_fields=['status', 'finished_at', 'updated_at'])
+
+def get_fanout_frontier(promo, run_date):
+    """
+    Último id cubierto por los fan-outs de la promo en el día si todos
+    sus shards terminaron, o None si no hay ninguno o alguno quedó a
+    medias (hay que volver a despacharlos para reanudarlos). Los ticks
+    siguientes solo tienen que recorrer los ids posteriores.
+    """
+    checkpoints = list(FanoutCheckpoint.objects.filter(flash_promo=promo, run_date=run_date))
+    if not checkpoints or any(checkpoint.status != 'completed' for checkpoint in checkpoints):
+        return None
+    covered = [
+        user_id
+        for checkpoint in checkpoints
+        for user_id in (checkpoint.after_id, checkpoint.until_id, checkpoint.last_user_id)
+        if user_id is not None
+    ]
+    return max(covered, default=None)
+
+def get_fanout_progress(promo, run_date):
+    """Resumen del progreso de los fan-outs de una promo en un día"""
+    checkpoints = list(FanoutCheckpoint.objects.filter(flash_promo=promo, run_date=run_date))
+    totals = {
+        key: sum(getattr(checkpoint, key) for checkpoint in checkpoints)
+        for key in ('sent', 'failed', 'queued', 'skipped')
+    }
+    completed = sum(1 for checkpoint in checkpoints if checkpoint.status == 'completed')
+    
+    if not checkpoints:
+        status = 'not_started'
+    elif completed == len(checkpoints):
+        status = 'completed'
+    else:
+        status = 'running'
+    
+    return {
+        'promo_id': promo.id,
+        'run_date': run_date,
+        'status': status,
+        'shards_total': len(checkpoints),
+        'shards_completed': completed,
+        **totals,
+        'shards': [
+            {
+                'after_id': checkpoint.after_id,
+                'until_id': checkpoint.until_id,
+                'last_user_id': checkpoint.last_user_id,
+                'status': checkpoint.status,
+                'sent': checkpoint.sent,
+                'failed': checkpoint.failed,
+                'queued': checkpoint.queued,
+                'skipped': checkpoint.skipped,
+                'updated_at': checkpoint.updated_at,
+            }
+            for checkpoint in checkpoints
+        ]
+    }
+
+def get_fanout_shards(promo, shard_size, after_id=None):
+    """
+    Divide los candidatos de la promo con id mayor que after_id en
+    shards de hasta shard_size usuarios usando keyset sobre el id.
+    Devuelve una lista de tuplas (after_id, until_id) con el rango
+    (after_id, until_id]; None indica un extremo abierto. Si hay una
+    audiencia precalculada para hoy los shards de la primera pasada se
+    calculan sobre ella sin consultar la base de datos.
+    
+    Con after_id (la frontera de una pasada completada) la audiencia
+    precalculada ya no sirve: no incluye a los usuarios dados de alta
+    después del precálculo. Se descarta y los recorridos siguientes del
+    día usan la consulta en vivo.
+    """
+    from .audience import audience_shards, discard_audience, load_audience
+    
+    today = timezone.now().date()
+    if after_id is not None:
+        discard_audience(promo.id, today)
+    else:
+        audience = load_audience(promo.id, today)
+        if audience is not None:
+            return audience_shards(audience, shard_size)
+    return get_id_shards(get_eligible_users_for_promo(promo), shard_size, after_id)
+
+def get_id_shards(queryset, shard_size, after_id=None):
+    """Rangos de ids (after_id, until_id] de hasta shard_size filas del queryset con id mayor que after_id"""
+    candidate_ids = queryset.order_by('id').values_list('id', flat=True)
+    shards = []
+    while True:
+        remaining = candidate_ids if after_id is None else candidate_ids.filter(id__gt=after_id)
+        boundary = list(remaining[shard_size - 1:shard_size])
+        if not boundary:
+            if remaining.exists():
+                shards.append((after_id, None))
+            return shards
+        shards.append((after_id, boundary[0]))
+        after_id = boundary[0]
+
+def notify_users_batch(user_ids, promo, publisher, log_buffer, dedupe, digest_promos=None):
+    """
+    Envía la promo a un lote de ids de usuario y marca a los usuarios
+    como notificados hoy en el registro dedupe.
+    
+    En modo 'outbox' los mensajes se encolan en NotificationOutbox junto
+    con su NotificationLog y los publica el relay; en modo 'inline' se
+    publican directamente y se registra el resultado de cada entrega.
+    Con digest_promos (varias promos, la principal primero) cada usuario
+    recibe un único mensaje y un único log de tipo 'flash_promo_digest'.
+    Devuelve un diccionario con los contadores del lote.
+    """
+    notification_type = 'flash_promo'
+    if digest_promos and len(digest_promos) > 1:
+        notification_type = 'flash_promo_digest'
+    
+    messages = []
+    message_texts = {}
+    for user_id in user_ids:
+        if notification_type == 'flash_promo_digest':
+            message_text, message = build_digest_message(user_id, digest_promos)
+        else:
+            message_text, message = build_promo_message(user_id, promo)
+        messages.append((user_id, message))
+        message_texts[user_id] = message_text
+    
+    if settings.NOTIFICATION_DELIVERY_MODE == 'outbox':
+        for user_id, message in messages:
+            log_buffer.add(
+                outbox_payload=message,
+                user_id=user_id,
+                store=promo.product.store,
+                flash_promo=promo,
+                notification_type=notification_type,
+                message=message_texts[user_id],
+                delivery_status='sent'
+            )
+        # Persistir el outbox del lote antes de marcar a los usuarios
+        log_buffer.flush()
+        dedupe.mark_notified(user_ids)
+        return {'sent': 0, 'failed': 0, 'queued': len(messages)}
+    
+    result = publisher.publish(messages)
+    delivered = set(result.delivered)
+    
+    for user_id, message in messages:
+        # Registrar la notificación en el log (escritura diferida en bloque);
+        # las entregas fallidas entran al outbox con un reintento programado
+        if user_id in delivered:
+            log_buffer.add(
+                user_id=user_id,
+                store=promo.product.store,
+                flash_promo=promo,
+                notification_type=notification_type,
+                message=message_texts[user_id],
+                delivery_status='delivered'
+            )
+        else:
+            log_buffer.add(
+                outbox_payload=message,
+                outbox_fields=failed_delivery_fields(1),
+                user_id=user_id,
+                store=promo.product.store,
+                flash_promo=promo,
+                notification_type=notification_type,
+                message=message_texts[user_id],
+                delivery_status='failed'
+            )
+    
+    dedupe.mark_notified(user_ids)
+    
+    return {'sent': len(result.delivered), 'failed': len(result.failed), 'queued': 0}
 
-def get_eligible_users_for_promo(promo):
-    segments = promo.eligible_segments
+def notify_claimed_batch(user_ids, promo, publisher, log_buffer, dedupe, digest_promos=None):
+    """
+    Envía un lote de usuarios ya reclamados y escribe sus logs. Si algo
+    falla antes de que se escriban, se descartan las filas pendientes y
+    se liberan las claves de los usuarios sin log para que un reintento
+    o la reanudación del checkpoint los vuelva a procesar.
+    """
+    written = log_buffer.written
+    try:
+        batch_stats = notify_users_batch(
+            user_ids, promo, publisher, log_buffer, dedupe, digest_promos=digest_promos
+        )
+        log_buffer.flush()
+    except BaseException:
+        # Las filas se escriben en el orden de user_ids
+        log_buffer.discard()
+        dedupe.release(user_ids[log_buffer.written - written:], promo.id)
+        raise
+    return batch_stats
+
+def get_eligible_users_for_promo(promo, max_distance_km=MAX_DISTANCE_KM):
+    store = promo.product.store
+    if store.latitude is None or store.longitude is None:
+        return User.objects.none()
+    
+    return User.objects.filter(promo_audience_filter(promo, max_distance_km))
+
+def promo_segment_user_types(promo):
+    """Tipos de usuario que corresponden a los segmentos elegibles de la promo"""
+    return [
+        user_type for segment, user_type in SEGMENT_USER_TYPES.items()
+        if segment in promo.eligible_segments
+    ]
+
+def promo_audience_filter(promo, max_distance_km=MAX_DISTANCE_KM):
+    """
+    Q con el segmento de la promo y el área alrededor de su tienda, que
+    debe tener coordenadas.
+    """
     query = Q()
+    for user_type in promo_segment_user_types(promo):
+        query |= Q(user_type=user_type)
     
-    if 'new_users' in segments:
-        query |= Q(user_type='new')
-    if 'frequent_buyers' in segments:
-        query |= Q(user_type='frequent')
+    store = promo.product.store
+    if uses_proximity_table(max_distance_km):
+        # Audiencia materializada: lectura del índice (store, user)
+        return query & near_store_filter(store, max_distance_km)
     
-    return User.objects.filter(query)
+    # Prefiltro en base de datos: solo candidatos dentro del área de la
+    # tienda; la distancia exacta se verifica después con haversine
+    return query & area_filter(store.latitude, store.longitude, max_distance_km)
 
-def is_user_near_store(user, store, max_distance_km=2):
+def area_filter(lat, lon, distance_km, model=User):
+    """
+    Q que acota el círculo de radio distance_km alrededor del punto. En
+    PostGIS es exacta (ST_DWithin con el índice GiST); en otros backends
+    usa el bounding box y los rangos del índice de geohash que lo cubren.
+    """
+    if uses_postgis(model):
+        return dwithin_filter(model, lat, lon, distance_km)
+    
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, distance_km)
+    area = Q(latitude__gte=min_lat, latitude__lte=max_lat)
+    if min_lon is not None:
+        if min_lon <= max_lon:
+            area &= Q(longitude__gte=min_lon, longitude__lte=max_lon)
+        else:
+            # El bounding box cruza el antimeridiano
+            area &= Q(longitude__gte=min_lon) | Q(longitude__lte=max_lon)
+    
+    # Rangos del índice de geohash que cubren el bounding box: la base de
+    # datos resuelve el área con unas pocas lecturas de índice
+    return area & geohash_filter(covering_cells(min_lat, max_lat, min_lon, max_lon))
+
+def is_user_near_store(user, store, max_distance_km=MAX_DISTANCE_KM):
     """
     Check if user is within max_distance_km of the store
     using latitude and longitude coordinates
@@ -75,20 +506,8 @@ def is_user_near_store(user, store, max_distance_km=2):
     return distance <= max_distance_km
 
 def send_sns_notification(user, promo):
-    sns_client = boto3.client(
-        'sns',
-        endpoint_url=settings.AWS_SNS_ENDPOINT_URL,
-        region_name=settings.AWS_DEFAULT_REGION,
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
-    )
-    
-    message_text = f"Flash Promo available: {promo.product.name} at {promo.promo_price}"
-    message = {
-        'user_id': user.id,
-        'promo_id': promo.id,
-        'message': message_text
-    }
+    sns_client = get_sns_client()
+    message_text, message = build_promo_message(user.id, promo)
     
     delivery_status = 'sent'
     try:
@@ -112,6 +531,29 @@ def send_sns_notification(user, promo):
         delivery_status=delivery_status
     )
 
+def get_notification_queue_depth():
+    """
+    Mensajes aproximados en la cola SQS de notificaciones, o None si no
+    se puede consultar.
+    """
+    sqs_client = boto3.client(
+        'sqs',
+        endpoint_url=settings.AWS_SQS_ENDPOINT_URL,
+        region_name=settings.AWS_DEFAULT_REGION,
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
+    )
+    
+    try:
+        response = sqs_client.get_queue_attributes(
+            QueueUrl=NOTIFICATION_QUEUE_URL_TEMPLATE.format(endpoint=settings.AWS_SQS_ENDPOINT_URL),
+            AttributeNames=['ApproximateNumberOfMessages']
+        )
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+    except Exception as e:
+        print(f"Error reading SQS queue depth: {e}")
+        return None
+
 # Función adicional para procesar mensajes de la cola SQS (si necesitas consumirlos)
 def process_sqs_messages():
     """
@@ -125,7 +567,7 @@ def process_sqs_messages():
         aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
     )
     
-    queue_url = f"{settings.AWS_SQS_ENDPOINT_URL}/000000000000/flash-promo-notifications"
+    queue_url = NOTIFICATION_QUEUE_URL_TEMPLATE.format(endpoint=settings.AWS_SQS_ENDPOINT_URL)
     
     try:
         response = sqs_client.receive_message(
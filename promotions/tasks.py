@@ -1,7 +1,27 @@
-from celery import shared_task
+from datetime import timedelta
+from celery import chord, shared_task
+from django.conf import settings
+from django.db.models import Q
 from django.utils import timezone
 from .models import FlashPromo
-from notifications.utils import send_flash_promo_notification, process_sqs_messages
+from notifications.audience import has_audience, prewarm_audience
+from notifications.engine import (
+    get_multi_promo_frontier,
+    get_multi_promo_shards,
+    send_multi_promo_notification,
+    uses_single_pass,
+)
+from notifications.locks import acquire_fanout_lock, release_fanout_lock
+from notifications.outbox import relay_outbox
+from notifications.pacing import get_pacer
+from notifications.retry import requeue_due_retries
+from notifications.utils import (
+    get_fanout_frontier,
+    get_fanout_shards,
+    get_notification_queue_depth,
+    send_flash_promo_notification,
+    process_sqs_messages
+)
 from users.models import User
 
 
@@ -19,14 +39,52 @@ def check_active_promos():
             is_active=True
         )
         
-        for promo in active_promos:
-            send_flash_promo_notification(promo.id)
+        promo_ids = list(active_promos.values_list('id', flat=True))
+        today = timezone.now().date()
+        single_pass_ids = [promo_id for promo_id in promo_ids if uses_single_pass(promo_id, today)]
+        if single_pass_ids:
+            # Una sola pasada sobre los usuarios para esas promos activas
+            send_active_promos_notification.delay(single_pass_ids)
+        for promo_id in promo_ids:
+            if promo_id not in single_pass_ids:
+                send_promo_notification.delay(promo_id)
             
-        return f"Processed {active_promos.count()} active promos"
+        return f"Processed {len(promo_ids)} active promos"
     except Exception as e:
         return f"Error checking active promos: {str(e)}"
 
 
+@shared_task
+def prewarm_promo_audiences():
+    """
+    Precalcula la audiencia de las promos activas que empiezan en los
+    próximos NOTIFICATION_AUDIENCE_PREWARM_MINUTES minutos, para que el
+    fan-out del inicio solo tenga que publicar. Las promos que ya tienen
+    audiencia guardada para ese día no se recalculan.
+    """
+    try:
+        now = timezone.now()
+        window_end = now + timedelta(minutes=settings.NOTIFICATION_AUDIENCE_PREWARM_MINUTES)
+        starts_soon = Q(start_time__gt=now.time()) & Q(start_time__lte=window_end.time())
+        if window_end.date() != now.date():
+            # La ventana cruza la medianoche
+            starts_soon = Q(start_time__gt=now.time()) | Q(start_time__lte=window_end.time())
+        
+        promos = FlashPromo.objects.select_related('product__store').filter(starts_soon, is_active=True)
+        prewarmed = 0
+        for promo in promos:
+            run_date = now.date() if promo.start_time > now.time() else window_end.date()
+            if has_audience(promo.id, run_date):
+                continue
+            if prewarm_audience(promo, run_date) is None:
+                return "Audience prewarm unavailable without Redis"
+            prewarmed += 1
+        
+        return f"Prewarmed audiences for {prewarmed} promos"
+    except Exception as e:
+        return f"Error prewarming promo audiences: {str(e)}"
+
+
 @shared_task
 def process_notification_queue():
     """
@@ -40,17 +98,228 @@ def process_notification_queue():
 
 
 @shared_task
-def send_promo_notification(promo_id):
+def send_promo_notification(promo_id, dry_run=False):
     """
-    Envía notificación para una promoción específica.
+    Envía notificación para una promoción específica. La audiencia se
+    divide en shards de ids que se procesan en paralelo como un chord.
+    Un lock distribuido por promo convierte en no-op las ejecuciones que
+    se solapan con un fan-out en curso; el callback del chord lo libera.
+    Si el fan-out del día ya terminó solo se despachan los usuarios con
+    id posterior al último cubierto.
+    
+    Con dry_run=True se recorre el pipeline completo sin enviar ni
+    escribir y se devuelve el informe de rendimiento.
     """
+    if dry_run:
+        try:
+            return send_flash_promo_notification(promo_id, dry_run=True)
+        except Exception as e:
+            return f"Error running dry-run for promo {promo_id}: {str(e)}"
+    
+    lock_token = acquire_fanout_lock(promo_id)
+    if lock_token is None:
+        return f"Fan-out already running for promo {promo_id}"
+    
     try:
-        send_flash_promo_notification(promo_id)
-        return f"Notification sent for promo {promo_id}"
+        promo = FlashPromo.objects.select_related('product__store').get(id=promo_id)
+        frontier = get_fanout_frontier(promo, timezone.now().date())
+        shards = get_fanout_shards(promo, settings.NOTIFICATION_SHARD_SIZE, frontier)
+        if not shards:
+            release_fanout_lock(promo_id, lock_token)
+            return f"No eligible users for promo {promo_id}"
+        
+        chord(
+            send_promo_notification_shard.s(promo_id, after_id, until_id, lock_token)
+            for after_id, until_id in shards
+        )(record_fanout_totals.s(promo_id, lock_token))
+        
+        return f"Dispatched {len(shards)} shards for promo {promo_id}"
+    except FlashPromo.DoesNotExist:
+        release_fanout_lock(promo_id, lock_token)
+        return f"Promo with id {promo_id} does not exist"
     except Exception as e:
+        release_fanout_lock(promo_id, lock_token)
         return f"Error sending notification for promo {promo_id}: {str(e)}"
 
 
+@shared_task
+def send_promo_notification_shard(promo_id, after_id, until_id, lock_token=None):
+    """
+    Procesa un shard de usuarios (after_id, until_id] de una promoción:
+    elegibilidad, filtro geográfico, publicación y registro. Cada lote
+    renueva el lock del fan-out.
+    """
+    try:
+        return send_flash_promo_notification(
+            promo_id, after_id=after_id, until_id=until_id, lock_token=lock_token
+        )
+    except Exception as e:
+        print(f"Error in shard ({after_id}, {until_id}] of promo {promo_id}: {e}")
+        return {'sent': 0, 'failed': 0, 'queued': 0, 'error': str(e)}
+
+
+@shared_task
+def record_fanout_totals(shard_results, promo_id, lock_token=None):
+    """
+    Callback del chord: agrega los contadores de todos los shards y
+    libera el lock del fan-out de la promo.
+    """
+    release_fanout_lock(promo_id, lock_token)
+    
+    sent = sum(result.get('sent', 0) for result in shard_results)
+    failed = sum(result.get('failed', 0) for result in shard_results)
+    queued = sum(result.get('queued', 0) for result in shard_results)
+    errors = sum(1 for result in shard_results if result.get('error'))
+    
+    summary = (
+        f"Promo {promo_id} fan-out finished: {sent} sent, {failed} failed, "
+        f"{queued} queued, {errors} shard errors across {len(shard_results)} shards"
+    )
+    print(summary)
+    
+    # Publicar cuanto antes lo encolado sin esperar al siguiente tick del relay
+    if queued:
+        relay_notification_outbox.delay()
+    return summary
+
+
+@shared_task
+def send_active_promos_notification(promo_ids):
+    """
+    Fan-out conjunto de varias promos: la audiencia combinada se divide
+    en shards de ids y cada shard evalúa todas las promos en una sola
+    pasada. Las promos cuyo lock ya está tomado por otro fan-out se
+    excluyen; el callback libera los locks del resto. Si todas las promos
+    terminaron su fan-out del día solo se despachan los usuarios con id
+    posterior al último cubierto.
+    """
+    locks = []
+    for promo_id in promo_ids:
+        lock_token = acquire_fanout_lock(promo_id)
+        if lock_token is not None:
+            locks.append((promo_id, lock_token))
+    if not locks:
+        return f"Fan-out already running for promos {promo_ids}"
+    
+    locked_ids = [promo_id for promo_id, lock_token in locks]
+    try:
+        frontier = get_multi_promo_frontier(locked_ids, timezone.now().date())
+        shards = get_multi_promo_shards(locked_ids, settings.NOTIFICATION_SHARD_SIZE, frontier)
+        if not shards:
+            release_fanout_locks(locks)
+            return f"No eligible users for promos {locked_ids}"
+        
+        chord(
+            send_active_promos_shard.s(locked_ids, after_id, until_id, locks)
+            for after_id, until_id in shards
+        )(record_multi_promo_totals.s(locks))
+        
+        return f"Dispatched {len(shards)} shards for promos {locked_ids}"
+    except Exception as e:
+        release_fanout_locks(locks)
+        return f"Error sending notifications for promos {locked_ids}: {str(e)}"
+
+
+@shared_task
+def send_active_promos_shard(promo_ids, after_id=None, until_id=None, locks=None):
+    """
+    Procesa un shard (after_id, until_id] del fan-out conjunto y devuelve
+    los contadores agregados de todas sus promos. Cada avance renueva los
+    locks (promo_id, token) de sus promos.
+    """
+    try:
+        promo_stats = send_multi_promo_notification(
+            promo_ids, after_id, until_id, lock_tokens=dict(locks or [])
+        )
+        totals = {'sent': 0, 'failed': 0, 'queued': 0, 'skipped': 0}
+        for stats in promo_stats.values():
+            for key, value in stats.items():
+                totals[key] += value
+        return totals
+    except Exception as e:
+        print(f"Error in multi-promo shard ({after_id}, {until_id}]: {str(e)}")
+        return {'sent': 0, 'failed': 0, 'queued': 0, 'skipped': 0, 'error': str(e)}
+
+
+@shared_task
+def record_multi_promo_totals(shard_results, locks):
+    """
+    Callback del fan-out conjunto: libera los locks de las promos y
+    agrega los contadores de los shards.
+    """
+    release_fanout_locks(locks)
+    
+    sent = sum(result.get('sent', 0) for result in shard_results)
+    failed = sum(result.get('failed', 0) for result in shard_results)
+    queued = sum(result.get('queued', 0) for result in shard_results)
+    errors = sum(1 for result in shard_results if result.get('error'))
+    
+    promo_ids = [promo_id for promo_id, lock_token in locks]
+    summary = (
+        f"Promos {promo_ids} fan-out finished: {sent} sent, {failed} failed, "
+        f"{queued} queued, {errors} shard errors across {len(shard_results)} shards"
+    )
+    print(summary)
+    
+    if queued:
+        relay_notification_outbox.delay()
+    return summary
+
+
+def release_fanout_locks(locks):
+    for promo_id, lock_token in locks:
+        release_fanout_lock(promo_id, lock_token)
+
+
+@shared_task
+def adjust_fanout_pacing():
+    """
+    Lazo de control del fan-out: combina la profundidad de la cola SQS
+    con la tasa de error de la última ventana y ajusta (AIMD) la tasa de
+    publicación y el tamaño de lote compartidos.
+    """
+    try:
+        pacer = get_pacer()
+        if pacer is None:
+            return "Adaptive pacing disabled"
+        state = pacer.adjust(get_notification_queue_depth())
+        return (
+            f"Pacing {'increased' if state['healthy'] else 'decreased'}: "
+            f"{state['rate']:.0f} msg/s, batch {state['batch_size']} "
+            f"(error rate {state['error_rate']:.2%}, queue depth {state['queue_depth']})"
+        )
+    except Exception as e:
+        return f"Error adjusting fan-out pacing: {str(e)}"
+
+
+@shared_task
+def relay_notification_outbox():
+    """
+    Publica en SNS los mensajes pendientes del outbox de notificaciones
+    en lotes grandes y actualiza su estado.
+    """
+    try:
+        stats = relay_outbox()
+        return f"Relayed outbox: {stats['sent']} sent, {stats['failed']} failed, {stats['dead']} dead-lettered"
+    except Exception as e:
+        return f"Error relaying notification outbox: {str(e)}"
+
+
+@shared_task
+def retry_failed_notifications():
+    """
+    Reencola en lotes las entregas fallidas cuyo backoff ya venció y
+    lanza el relay para publicarlas.
+    """
+    try:
+        requeued = requeue_due_retries()
+        if requeued:
+            relay_notification_outbox.delay()
+        return f"Requeued {requeued} failed notifications"
+    except Exception as e:
+        return f"Error retrying failed notifications: {str(e)}"
+
+
 @shared_task
 def cleanup_expired_promos():
     """
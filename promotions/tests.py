@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from datetime import datetime, timedelta, time
@@ -9,6 +9,15 @@ from django.contrib.auth import get_user_model
 from stores.models import Store, Product
 from .models import FlashPromo, ProductReservation
 from .serializers import FlashPromoSerializer, ProductReservationSerializer
+from .tasks import (
+    adjust_fanout_pacing, check_active_promos, prewarm_promo_audiences, send_active_promos_notification,
+    send_active_promos_shard,
+    send_promo_notification, send_promo_notification_shard, record_fanout_totals, retry_failed_notifications
+)
+from notifications.models import FanoutCheckpoint
+from notifications.utils import get_fanout_shards
+from unittest.mock import patch, MagicMock
+from marketplace.celery import app as celery_app
 
 User = get_user_model()
 
@@ -431,6 +440,38 @@ class PromotionsAPITest(APITestCase):
         }
         response = self.client.post('/api/product-reservations/', data)
         # Nota: Este test asume que existe un endpoint de reservas
+    
+    def test_fanout_progress_api(self):
+        """Test consulta del progreso del envío de notificaciones"""
+        FanoutCheckpoint.objects.create(
+            flash_promo=self.flash_promo,
+            run_date=timezone.now().date(),
+            shard_key=':100',
+            until_id=100,
+            last_user_id=40,
+            sent=30,
+            skipped=5
+        )
+        self.client.force_authenticate(user=self.user)
+        
+        response = self.client.get(f'/api/flash-promos/{self.flash_promo.id}/fanout_progress/')
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['status'], 'running')
+        self.assertEqual(data['sent'], 30)
+        self.assertEqual(data['skipped'], 5)
+        self.assertEqual(data['shards'][0]['last_user_id'], 40)
+    
+    def test_fanout_progress_api_invalid_date(self):
+        """Test fecha inválida en la consulta de progreso"""
+        self.client.force_authenticate(user=self.user)
+        
+        response = self.client.get(
+            f'/api/flash-promos/{self.flash_promo.id}/fanout_progress/', {'date': '2025-02-30'}
+        )
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
 class PromotionsIntegrationTest(TestCase):
@@ -623,3 +664,316 @@ class PromotionsIntegrationTest(TestCase):
         for i, flash_promo in enumerate(flash_promos):
             expected_price = products[i].original_price * Decimal('0.8')
             self.assertEqual(flash_promo.promo_price, expected_price)
+
+
+class PromoFanoutTasksTest(TestCase):
+    """Tests para el fan-out paralelo por shards"""
+    
+    def setUp(self):
+        self.owner = User.objects.create(username='fanoutowner', email='fanoutowner@example.com')
+        self.store = Store.objects.create(
+            name='Fanout Store',
+            address='1 Fanout St',
+            latitude=40.7831,
+            longitude=-73.9712,
+            owner=self.owner
+        )
+        self.product = Product.objects.create(
+            name='Fanout Product',
+            original_price=Decimal('100.00'),
+            store=self.store
+        )
+        self.promo = FlashPromo.objects.create(
+            product=self.product,
+            promo_price=Decimal('80.00'),
+            start_time=time(9, 0),
+            end_time=time(18, 0),
+            eligible_segments=['new_users'],
+            is_active=True
+        )
+        self.users = [
+            User.objects.create(
+                username=f'fanoutuser{i}',
+                email=f'fanout{i}@example.com',
+                user_type='new',
+                latitude=40.7831,
+                longitude=-73.9712
+            )
+            for i in range(5)
+        ]
+    
+    def test_get_fanout_shards_keyset_ranges(self):
+        """Test los shards cubren todos los candidatos sin solaparse"""
+        shards = get_fanout_shards(self.promo, 2)
+        ids = [user.id for user in self.users]
+        
+        self.assertEqual(shards, [(None, ids[1]), (ids[1], ids[3]), (ids[3], None)])
+    
+    @override_settings(NOTIFICATION_SHARD_SIZE=2)
+    @patch('promotions.tasks.chord')
+    def test_send_promo_notification_dispatches_shards(self, mock_chord):
+        """Test la promo se reparte en un chord con un shard por rango"""
+        result = send_promo_notification(self.promo.id)
+        
+        shard_signatures = list(mock_chord.call_args[0][0])
+        self.assertEqual(len(shard_signatures), 3)
+        self.assertEqual(shard_signatures[0].args[:3], (self.promo.id, None, self.users[1].id))
+        # Los shards reciben el token para renovar el lock
+        self.assertTrue(shard_signatures[0].args[3])
+        callback = mock_chord.return_value.call_args[0][0]
+        self.assertEqual(callback.task, 'promotions.tasks.record_fanout_totals')
+        self.assertIn('3 shards', result)
+    
+    @override_settings(NOTIFICATION_SHARD_SIZE=2)
+    @patch('promotions.tasks.chord')
+    def test_send_promo_notification_after_completed_fanout(self, mock_chord):
+        """Test tras un fan-out completado solo se despachan los usuarios nuevos"""
+        FanoutCheckpoint.objects.create(
+            flash_promo=self.promo, run_date=timezone.now().date(), shard_key=':',
+            last_user_id=self.users[-1].id, status='completed'
+        )
+        
+        result = send_promo_notification(self.promo.id)
+        
+        self.assertIn('No eligible users', result)
+        mock_chord.assert_not_called()
+        
+        User.objects.create(
+            username='fanoutnewcomer', email='fanoutnewcomer@example.com',
+            user_type='new', latitude=40.7831, longitude=-73.9712
+        )
+        send_promo_notification(self.promo.id)
+        
+        shard_signatures = list(mock_chord.call_args[0][0])
+        self.assertEqual([signature.args[:3] for signature in shard_signatures], [(self.promo.id, self.users[-1].id, None)])
+    
+    @override_settings(NOTIFICATION_DELIVERY_MODE='inline')
+    @patch('notifications.utils.SNSBatchPublisher.publish')
+    def test_send_promo_notification_shard_limits_range(self, mock_publish):
+        """Test un shard solo notifica a los usuarios de su rango"""
+        mock_publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages], failed=[]
+        )
+        
+        stats = send_promo_notification_shard(self.promo.id, self.users[0].id, self.users[2].id)
+        
+        self.assertEqual(stats, {'sent': 2, 'failed': 0, 'queued': 0, 'skipped': 0})
+        notified = User.objects.filter(last_notification_sent=timezone.now().date())
+        self.assertEqual(set(notified), {self.users[1], self.users[2]})
+    
+    @patch('promotions.tasks.relay_notification_outbox.delay')
+    def test_record_fanout_totals(self, mock_relay):
+        """Test el callback agrega los contadores de los shards"""
+        summary = record_fanout_totals(
+            [{'sent': 3, 'failed': 1, 'queued': 2}, {'sent': 0, 'failed': 0, 'queued': 0, 'error': 'boom'}],
+            self.promo.id
+        )
+        
+        self.assertIn('3 sent', summary)
+        self.assertIn('1 failed', summary)
+        self.assertIn('2 queued', summary)
+        self.assertIn('1 shard errors', summary)
+        mock_relay.assert_called_once()
+    
+    def test_tasks_are_routed_to_dedicated_queues(self):
+        """Test el fan-out y el mantenimiento no comparten cola con las tareas cortas"""
+        router = celery_app.amqp.router
+        
+        def route(name):
+            return router.route({}, name)
+        
+        self.assertEqual(route('promotions.tasks.check_active_promos')['queue'].name, 'default')
+        self.assertEqual(route('promotions.tasks.send_promo_notification_shard')['queue'].name, 'fanout')
+        self.assertEqual(route('promotions.tasks.process_notification_queue')['queue'].name, 'sqs')
+        self.assertEqual(route('promotions.tasks.cleanup_expired_promos')['queue'].name, 'maintenance')
+        self.assertLess(
+            route('promotions.tasks.check_active_promos')['priority'],
+            route('promotions.tasks.send_promo_notification_shard')['priority']
+        )
+        # El precálculo de audiencias no espera detrás de los shards
+        self.assertEqual(route('promotions.tasks.prewarm_promo_audiences')['queue'].name, 'default')
+        self.assertLess(
+            route('promotions.tasks.prewarm_promo_audiences')['priority'],
+            route('promotions.tasks.send_promo_notification_shard')['priority']
+        )
+    
+    @patch('promotions.tasks.chord')
+    @patch('promotions.tasks.acquire_fanout_lock', return_value=None)
+    def test_overlapping_fanout_is_noop(self, mock_acquire, mock_chord):
+        """Test si el fan-out de la promo ya está en curso no se despacha otro"""
+        result = send_promo_notification(self.promo.id)
+        
+        self.assertIn('already running', result)
+        mock_chord.assert_not_called()
+    
+    @patch('promotions.tasks.chord')
+    @patch('promotions.tasks.acquire_fanout_lock', return_value='token')
+    def test_lock_token_passed_to_callback(self, mock_acquire, mock_chord):
+        """Test el token del lock viaja al callback del chord"""
+        send_promo_notification(self.promo.id)
+        
+        callback = mock_chord.return_value.call_args[0][0]
+        self.assertEqual(callback.args, (self.promo.id, 'token'))
+    
+    @override_settings(NOTIFICATION_FANOUT_ENGINE='single_pass')
+    @patch('promotions.tasks.send_promo_notification.delay')
+    @patch('promotions.tasks.send_active_promos_notification.delay')
+    def test_check_active_promos_single_pass(self, mock_multi_delay, mock_single_delay):
+        """Test con el motor single_pass todas las promos activas van en una tarea"""
+        FlashPromo.objects.filter(id=self.promo.id).update(start_time=time(0, 0), end_time=time(23, 59, 59))
+        
+        check_active_promos()
+        
+        mock_multi_delay.assert_called_once_with([self.promo.id])
+        mock_single_delay.assert_not_called()
+    
+    @override_settings(NOTIFICATION_FANOUT_ENGINE='single_pass')
+    @patch('notifications.engine.has_audience')
+    @patch('promotions.tasks.send_promo_notification.delay')
+    @patch('promotions.tasks.send_active_promos_notification.delay')
+    def test_check_active_promos_prewarmed_promo_only_publishes(self, mock_multi_delay, mock_single_delay, mock_has_audience):
+        """Test las promos con audiencia precalculada se despachan por separado"""
+        other_promo = FlashPromo.objects.create(
+            product=self.product, promo_price=Decimal('70.00'),
+            start_time=time(0, 0), end_time=time(23, 59, 59),
+            eligible_segments=['new_users'], is_active=True
+        )
+        FlashPromo.objects.filter(id=self.promo.id).update(start_time=time(0, 0), end_time=time(23, 59, 59))
+        mock_has_audience.side_effect = lambda promo_id, day: promo_id == self.promo.id
+        
+        check_active_promos()
+        
+        mock_single_delay.assert_called_once_with(self.promo.id)
+        mock_multi_delay.assert_called_once_with([other_promo.id])
+    
+    @override_settings(NOTIFICATION_AUDIENCE_PREWARM_MINUTES=10)
+    @patch('promotions.tasks.prewarm_audience', return_value=5)
+    @patch('promotions.tasks.has_audience', return_value=False)
+    @patch('promotions.tasks.timezone.now')
+    def test_prewarm_promo_audiences_upcoming_only(self, mock_now, mock_has_audience, mock_prewarm):
+        """Test solo se precalculan las promos que empiezan dentro de la ventana"""
+        mock_now.return_value = datetime(2024, 5, 1, 8, 55, tzinfo=timezone.get_current_timezone())
+        FlashPromo.objects.create(
+            product=self.product, promo_price=Decimal('70.00'),
+            start_time=time(12, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        
+        result = prewarm_promo_audiences()
+        
+        self.assertEqual(result, "Prewarmed audiences for 1 promos")
+        mock_prewarm.assert_called_once()
+        self.assertEqual(mock_prewarm.call_args[0][0].id, self.promo.id)
+        self.assertEqual(mock_prewarm.call_args[0][1], datetime(2024, 5, 1).date())
+    
+    @override_settings(NOTIFICATION_AUDIENCE_PREWARM_MINUTES=10)
+    @patch('promotions.tasks.prewarm_audience', return_value=5)
+    @patch('promotions.tasks.has_audience', return_value=False)
+    @patch('promotions.tasks.timezone.now')
+    def test_prewarm_promo_audiences_across_midnight(self, mock_now, mock_has_audience, mock_prewarm):
+        """Test una promo que empieza tras la medianoche se precalcula para el día siguiente"""
+        mock_now.return_value = datetime(2024, 5, 1, 23, 55, tzinfo=timezone.get_current_timezone())
+        FlashPromo.objects.filter(id=self.promo.id).update(start_time=time(0, 2))
+        
+        prewarm_promo_audiences()
+        
+        mock_prewarm.assert_called_once()
+        self.assertEqual(mock_prewarm.call_args[0][1], datetime(2024, 5, 2).date())
+    
+    @override_settings(NOTIFICATION_FANOUT_ENGINE='per_promo')
+    @patch('promotions.tasks.send_promo_notification.delay')
+    @patch('promotions.tasks.send_active_promos_notification.delay')
+    def test_check_active_promos_per_promo(self, mock_multi_delay, mock_single_delay):
+        """Test con el motor per_promo cada promo tiene su propio fan-out"""
+        FlashPromo.objects.filter(id=self.promo.id).update(start_time=time(0, 0), end_time=time(23, 59, 59))
+        
+        check_active_promos()
+        
+        mock_single_delay.assert_called_once_with(self.promo.id)
+        mock_multi_delay.assert_not_called()
+    
+    @override_settings(NOTIFICATION_SHARD_SIZE=2)
+    @patch('promotions.tasks.chord')
+    @patch('promotions.tasks.acquire_fanout_lock')
+    def test_send_active_promos_skips_locked_promos(self, mock_acquire, mock_chord):
+        """Test las promos con un fan-out en curso se excluyen del fan-out conjunto"""
+        other_promo = FlashPromo.objects.create(
+            product=self.product, promo_price=Decimal('70.00'),
+            start_time=time(9, 0), end_time=time(18, 0),
+            eligible_segments=['new_users'], is_active=True
+        )
+        mock_acquire.side_effect = lambda promo_id: None if promo_id == self.promo.id else 'token'
+        
+        send_active_promos_notification([self.promo.id, other_promo.id])
+        
+        shard_signatures = list(mock_chord.call_args[0][0])
+        self.assertEqual(len(shard_signatures), 3)
+        self.assertEqual(shard_signatures[0].args[0], [other_promo.id])
+        callback = mock_chord.return_value.call_args[0][0]
+        self.assertEqual(callback.args, ([(other_promo.id, 'token')],))
+    
+    @patch('promotions.tasks.chord')
+    def test_send_active_promos_after_completed_fanout(self, mock_chord):
+        """Test el fan-out conjunto no vuelve a recorrer la audiencia de promos completadas"""
+        FanoutCheckpoint.objects.create(
+            flash_promo=self.promo, run_date=timezone.now().date(), shard_key=':',
+            last_user_id=self.users[-1].id, status='completed'
+        )
+        
+        result = send_active_promos_notification([self.promo.id])
+        
+        self.assertIn('No eligible users', result)
+        mock_chord.assert_not_called()
+    
+    @override_settings(NOTIFICATION_DELIVERY_MODE='inline')
+    @patch('notifications.engine.SNSBatchPublisher')
+    def test_send_active_promos_shard_totals(self, mock_publisher_class):
+        """Test un shard conjunto devuelve los contadores agregados"""
+        mock_publisher_class.return_value.publish.side_effect = lambda messages: MagicMock(
+            delivered=[key for key, message in messages], failed=[]
+        )
+        
+        totals = send_active_promos_shard([self.promo.id], None, self.users[2].id)
+        
+        self.assertEqual(totals, {'sent': 3, 'failed': 0, 'queued': 0, 'skipped': 0})
+    
+    @patch('promotions.tasks.get_notification_queue_depth', return_value=12)
+    @patch('promotions.tasks.get_pacer')
+    def test_adjust_fanout_pacing(self, mock_get_pacer, mock_depth):
+        """Test el lazo de control pasa la profundidad de la cola al controlador"""
+        mock_get_pacer.return_value.adjust.return_value = {
+            'rate': 250, 'batch_size': 100, 'error_rate': 0.2, 'queue_depth': 12, 'healthy': False
+        }
+        
+        result = adjust_fanout_pacing()
+        
+        mock_get_pacer.return_value.adjust.assert_called_once_with(12)
+        self.assertIn('decreased', result)
+        self.assertIn('250 msg/s', result)
+    
+    @patch('promotions.tasks.chord')
+    def test_send_promo_notification_dry_run(self, mock_chord):
+        """Test el dry-run devuelve el informe sin despachar shards"""
+        report = send_promo_notification(self.promo.id, dry_run=True)
+        
+        mock_chord.assert_not_called()
+        self.assertTrue(report['dry_run'])
+        self.assertEqual(report['would_send'], 5)
+        self.assertFalse(FanoutCheckpoint.objects.exists())
+    
+    @patch('promotions.tasks.relay_notification_outbox.delay')
+    @patch('promotions.tasks.requeue_due_retries', return_value=4)
+    def test_retry_failed_notifications_triggers_relay(self, mock_requeue, mock_relay):
+        """Test los reintentos vencidos se reencolan y se lanza el relay"""
+        result = retry_failed_notifications()
+        
+        self.assertIn('Requeued 4', result)
+        mock_relay.assert_called_once()
+    
+    @patch('promotions.tasks.release_fanout_lock')
+    @patch('promotions.tasks.relay_notification_outbox.delay')
+    def test_record_fanout_totals_releases_lock(self, mock_relay, mock_release):
+        """Test el callback libera el lock del fan-out"""
+        record_fanout_totals([{'sent': 1, 'failed': 0, 'queued': 0}], self.promo.id, 'token')
+        
+        mock_release.assert_called_once_with(self.promo.id, 'token')
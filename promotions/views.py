@@ -5,7 +5,8 @@ from rest_framework.permissions import IsAuthenticated
 from django.utils import timezone
 from .models import FlashPromo, ProductReservation
 from .serializers import FlashPromoSerializer, ProductReservationSerializer
-from notifications.utils import is_user_near_store
+from django.utils.dateparse import parse_date
+from notifications.utils import get_fanout_progress, is_user_near_store
 
 class FlashPromoViewSet(viewsets.ModelViewSet):
     queryset = FlashPromo.objects.all()
@@ -64,6 +65,25 @@ class FlashPromoViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
     
+    @action(detail=True, methods=['get'])
+    def fanout_progress(self, request, pk=None):
+        """Progreso del envío de notificaciones de la promo (por defecto, hoy)"""
+        promo = self.get_object()
+        
+        run_date = timezone.now().date()
+        if 'date' in request.query_params:
+            try:
+                run_date = parse_date(request.query_params['date'])
+            except ValueError:
+                run_date = None
+            if run_date is None:
+                return Response(
+                    {'error': 'Invalid date, expected YYYY-MM-DD'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        
+        return Response(get_fanout_progress(promo, run_date))
+    
     def is_user_eligible(self, user, promo):
         segments = promo.eligible_segments
         user_type = user.user_type
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-17 00:32
+
+from django.db import migrations, models
+from marketplace.geohash import encode
+
+BATCH_SIZE = 2000
+
+
+def backfill_geohash(apps, schema_editor):
+    """Calcula el geohash de las filas existentes en lotes por id"""
+    Store = apps.get_model('stores', 'Store')
+    last_id = 0
+    while True:
+        rows = list(
+            Store.objects.filter(id__gt=last_id, latitude__isnull=False, longitude__isnull=False)
+            .order_by('id').values_list('id', 'latitude', 'longitude')[:BATCH_SIZE]
+        )
+        if not rows:
+            return
+        Store.objects.bulk_update(
+            [Store(id=row_id, geohash=encode(lat, lon)) for row_id, lat, lon in rows],
+            ['geohash']
+        )
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    # Cada lote del backfill se confirma por separado en tablas grandes
+    atomic = False
+
+    dependencies = [
+        ('stores', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=12),
+        ),
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,10 @@
 from django.db import models
 from django.contrib.auth import get_user_model
+from marketplace.geohash import GeohashModel, GeohashQuerySet
 
 User = get_user_model()
 
-class Store(models.Model):
+class Store(GeohashModel):
     name = models.CharField(max_length=255)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='owned_stores')
     latitude = models.FloatField(null=True, blank=True)  # Cambiar de PointField
@@ -12,6 +13,26 @@ class Store(models.Model):
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = GeohashQuerySet.as_manager()
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_is_active = instance.__dict__.get('is_active')
+        return instance
+    
+    def save(self, *args, **kwargs):
+        # Igual que coordinates_changed: los receptores de post_save
+        # consultan is_active_changed para saber si la tienda se activó o
+        # desactivó con este save
+        update_fields = kwargs.get('update_fields')
+        self.is_active_changed = self._state.adding or (
+            (update_fields is None or 'is_active' in update_fields)
+            and self.is_active != getattr(self, '_saved_is_active', None)
+        )
+        super().save(*args, **kwargs)
+        self._saved_is_active = self.is_active
+    
     def is_owner(self, user):
         """Verifica si el usuario es el propietario de la tienda"""
         return self.owner == user
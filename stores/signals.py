@@ -0,0 +1,15 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Store
+from .spatial import forget_store, sync_store
+
+
+@receiver(post_save, sender=Store)
+def update_store_index(sender, instance, **kwargs):
+    """Mantiene el índice espacial del proceso al crear o modificar tiendas"""
+    sync_store(instance)
+
+
+@receiver(post_delete, sender=Store)
+def remove_store_from_index(sender, instance, **kwargs):
+    forget_store(instance.id)
@@ -0,0 +1,195 @@
+import math
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from notifications.proximity import EARTH_RADIUS_KM, haversine_matrix
+
+# Kilómetros por grado de latitud
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Mitad de la circunferencia: ninguna distancia en la esfera la supera
+MAX_SPHERE_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+
+class StoreGridIndex:
+    """
+    Índice espacial en memoria de tiendas sobre una rejilla uniforme de
+    latitud/longitud con celdas de cell_degrees grados. Una consulta por
+    radio solo evalúa las tiendas de las celdas que cubren su bounding
+    box, y la distancia exacta se calcula con haversine vectorizado.
+    """
+
+    def __init__(self, cell_degrees=None):
+        self.cell_degrees = cell_degrees or settings.STORE_INDEX_CELL_DEGREES
+        self.lat_cells = math.ceil(180 / self.cell_degrees)
+        self.lon_cells = math.ceil(360 / self.cell_degrees)
+        self.cells = {}
+        self.stores = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.stores)
+
+    def cell(self, lat, lon):
+        row = min(int((lat + 90) // self.cell_degrees), self.lat_cells - 1)
+        col = int((lon + 180) // self.cell_degrees) % self.lon_cells
+        return row, col
+
+    def _column(self, lon):
+        """Columna de una longitud en [-180, 180], sin dar la vuelta en 180"""
+        return min(int((lon + 180) // self.cell_degrees), self.lon_cells - 1)
+
+    def add(self, store_id, lat, lon):
+        """Inserta o mueve una tienda"""
+        with self._lock:
+            self._discard(store_id)
+            if lat is None or lon is None:
+                return
+            cell = self.cell(lat, lon)
+            self.stores[store_id] = (lat, lon, cell)
+            self.cells.setdefault(cell, set()).add(store_id)
+
+    def remove(self, store_id):
+        with self._lock:
+            self._discard(store_id)
+
+    def _discard(self, store_id):
+        entry = self.stores.pop(store_id, None)
+        if entry is None:
+            return
+        cell_ids = self.cells[entry[2]]
+        cell_ids.discard(store_id)
+        if not cell_ids:
+            del self.cells[entry[2]]
+
+    def _candidates(self, lat, lon, radius_km):
+        """Ids de las tiendas en las celdas que cubren el bounding box del radio"""
+        lat_delta = radius_km / KM_PER_DEGREE
+        min_row = self.cell(max(lat - lat_delta, -90), lon)[0]
+        max_row = self.cell(min(lat + lat_delta, 90), lon)[0]
+
+        cos_lat = math.cos(math.radians(min(abs(lat) + lat_delta, 90)))
+        lon_delta = radius_km / (KM_PER_DEGREE * cos_lat) if cos_lat > 1e-9 else 360
+        if lon_delta >= 180:
+            # El radio alcanza un polo o abarca todas las longitudes
+            cols = None
+        else:
+            # El rango se parte en el antimeridiano: si cell_degrees no divide
+            # 360 la última columna es más estrecha y las columnas no se
+            # repiten con periodo lon_cells fuera de [-180, 180)
+            west, east = lon - lon_delta, lon + lon_delta
+            if west < -180:
+                spans = [(west + 360, 180), (-180, east)]
+            elif east >= 180:
+                spans = [(west, 180), (-180, east - 360)]
+            else:
+                spans = [(west, east)]
+            cols = {
+                col
+                for span_west, span_east in spans
+                for col in range(self._column(span_west), self._column(span_east) + 1)
+            }
+
+        rows = max_row - min_row + 1
+        if cols is None or rows * len(cols) > len(self.cells):
+            # Más celdas en el rango que celdas ocupadas: se filtran las ocupadas
+            return [
+                store_id
+                for (row, col), cell_ids in self.cells.items()
+                if min_row <= row <= max_row and (cols is None or col in cols)
+                for store_id in cell_ids
+            ]
+        return [
+            store_id
+            for row in range(min_row, max_row + 1)
+            for col in cols
+            for store_id in self.cells.get((row, col), ())
+        ]
+
+    def within_radius(self, lat, lon, radius_km, limit=None):
+        """
+        Tiendas a radius_km o menos del punto como lista de tuplas
+        (store_id, distancia_km) ordenada por distancia.
+        """
+        with self._lock:
+            candidates = self._candidates(lat, lon, radius_km)
+            coords = np.array([self.stores[store_id][:2] for store_id in candidates], dtype=float)
+        if not candidates:
+            return []
+
+        distances = haversine_matrix(coords[:, 0], coords[:, 1], [lat], [lon])[:, 0]
+        within = np.flatnonzero(distances <= radius_km)
+        order = within[np.argsort(distances[within], kind='stable')]
+        if limit is not None:
+            order = order[:limit]
+        return [(candidates[index], float(distances[index])) for index in order]
+
+    def nearest(self, lat, lon, k=1, max_distance_km=None):
+        """
+        Las k tiendas más cercanas al punto, opcionalmente limitadas a
+        max_distance_km. Busca con radios crecientes (el doble cada vez)
+        empezando por el tamaño de una celda.
+        """
+        max_distance_km = min(max_distance_km or MAX_SPHERE_DISTANCE_KM, MAX_SPHERE_DISTANCE_KM)
+        radius_km = min(self.cell_degrees * KM_PER_DEGREE, max_distance_km)
+        while True:
+            results = self.within_radius(lat, lon, radius_km, limit=k)
+            if len(results) >= k or radius_km >= max_distance_km:
+                return results
+            radius_km = min(radius_km * 2, max_distance_km)
+
+
+def build_store_index(cell_degrees=None):
+    """Construye el índice con las tiendas activas que tienen coordenadas"""
+    from .models import Store
+
+    index = StoreGridIndex(cell_degrees)
+    rows = (
+        Store.objects.filter(is_active=True, latitude__isnull=False, longitude__isnull=False)
+        .values_list('id', 'latitude', 'longitude')
+        .iterator(chunk_size=settings.NOTIFICATION_STREAM_CHUNK_SIZE)
+    )
+    for store_id, lat, lon in rows:
+        index.add(store_id, lat, lon)
+    index.built_at = time.monotonic()
+    return index
+
+
+_store_index = None
+
+
+def get_store_index():
+    """
+    Índice del proceso. Se construye en la primera consulta, las señales
+    de Store lo mantienen al día con los cambios hechos en este proceso
+    y se reconstruye tras STORE_INDEX_MAX_AGE segundos para recoger los
+    hechos en otros procesos.
+    """
+    global _store_index
+    index = _store_index
+    if index is None or time.monotonic() - index.built_at > settings.STORE_INDEX_MAX_AGE:
+        index = _store_index = build_store_index()
+    return index
+
+
+def reset_store_index():
+    global _store_index
+    _store_index = None
+
+
+def sync_store(store):
+    """Refleja en el índice (si ya está construido) el alta, cambio o baja de una tienda"""
+    index = _store_index
+    if index is None:
+        return
+    if store.is_active:
+        index.add(store.id, store.latitude, store.longitude)
+    else:
+        index.remove(store.id)
+
+
+def forget_store(store_id):
+    index = _store_index
+    if index is not None:
+        index.remove(store_id)
@@ -5,6 +5,11 @@ from rest_framework import status
 from decimal import Decimal
 from .models import Store, Product
 from .serializers import StoreSerializer, ProductSerializer
+from .spatial import StoreGridIndex, get_store_index, reset_store_index
+from marketplace.geohash import covering_cells, encode, geohash_filter, prefix_successor
+from notifications.utils import bounding_box, haversine_distance
+from django.db.models import F
+import random
 
 User = get_user_model()
 
@@ -70,6 +75,163 @@ class StoreModelTest(TestCase):
             store.full_clean()  # Validar antes de guardar
 
 
+class StoreGridIndexTest(TestCase):
+    """Tests para el índice espacial en memoria de tiendas"""
+    
+    def setUp(self):
+        reset_store_index()
+        self.addCleanup(reset_store_index)
+        self.user = User.objects.create_user(username='gridowner', email='grid@test.com', password='testpass123')
+    
+    def random_index(self, count=500):
+        rng = random.Random(7)
+        points = {
+            store_id: (rng.uniform(-89, 89), rng.uniform(-180, 180))
+            for store_id in range(count)
+        }
+        index = StoreGridIndex(cell_degrees=5)
+        for store_id, (lat, lon) in points.items():
+            index.add(store_id, lat, lon)
+        return index, points
+    
+    def test_within_radius_matches_brute_force(self):
+        """Test el radio devuelve lo mismo que recorrer todas las tiendas"""
+        index, points = self.random_index()
+        for lat, lon, radius in [(0, 0, 1500), (60, 179, 900), (-85, -10, 700), (10, -179.5, 2500), (89, 0, 400)]:
+            expected = sorted(
+                store_id for store_id, (store_lat, store_lon) in points.items()
+                if haversine_distance(lat, lon, store_lat, store_lon) <= radius
+            )
+            results = index.within_radius(lat, lon, radius)
+            self.assertEqual(sorted(store_id for store_id, distance in results), expected)
+            distances = [distance for store_id, distance in results]
+            self.assertEqual(distances, sorted(distances))
+    
+    def test_within_radius_across_antimeridian_with_partial_column(self):
+        """Test con celdas que no dividen 360 se encuentran tiendas al otro lado del antimeridiano"""
+        index = StoreGridIndex(cell_degrees=0.7)
+        index.add(1, 0, -179.99)
+        index.add(2, 0, 179.99)
+        
+        self.assertEqual(sorted(store_id for store_id, distance in index.within_radius(0, 179.995, 5)), [1, 2])
+        self.assertEqual(sorted(store_id for store_id, distance in index.within_radius(0, -179.995, 5)), [1, 2])
+    
+    def test_nearest_matches_brute_force(self):
+        """Test los k vecinos más cercanos coinciden con la búsqueda exhaustiva"""
+        index, points = self.random_index()
+        for lat, lon in [(0, 0), (45, 179.9), (-70, -120)]:
+            expected = sorted(
+                points, key=lambda store_id: haversine_distance(lat, lon, *points[store_id])
+            )[:5]
+            self.assertEqual([store_id for store_id, distance in index.nearest(lat, lon, k=5)], expected)
+    
+    def test_nearest_respects_max_distance(self):
+        """Test sin tiendas dentro de la distancia máxima no hay resultados"""
+        index = StoreGridIndex(cell_degrees=0.02)
+        index.add(1, 6.2442, -75.5812)
+        
+        self.assertEqual(index.nearest(6.30, -75.5812, k=1, max_distance_km=2), [])
+        self.assertEqual(index.nearest(6.30, -75.5812, k=1)[0][0], 1)
+    
+    def test_move_and_remove(self):
+        """Test mover una tienda la cambia de celda y eliminarla la quita"""
+        index = StoreGridIndex(cell_degrees=0.02)
+        index.add(1, 6.2442, -75.5812)
+        index.add(1, 40.7831, -73.9712)
+        
+        self.assertEqual(index.within_radius(6.2442, -75.5812, 2), [])
+        self.assertEqual(index.within_radius(40.7831, -73.9712, 2)[0][0], 1)
+        self.assertEqual(len(index.cells), 1)
+        index.remove(1)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.cells, {})
+    
+    def test_signals_keep_index_in_sync(self):
+        """Test las señales de Store actualizan el índice ya construido"""
+        store = Store.objects.create(
+            name='Grid Store', owner=self.user, latitude=6.2442, longitude=-75.5812, address='Grid 1'
+        )
+        index = get_store_index()
+        self.assertEqual(index.within_radius(6.2442, -75.5812, 1)[0][0], store.id)
+        
+        other = Store.objects.create(
+            name='Grid Store 2', owner=self.user, latitude=6.2450, longitude=-75.5812, address='Grid 2'
+        )
+        self.assertEqual([store_id for store_id, distance in index.within_radius(6.2442, -75.5812, 1)], [store.id, other.id])
+        
+        store.is_active = False
+        store.save()
+        other.delete()
+        self.assertEqual(index.within_radius(6.2442, -75.5812, 1), [])
+        self.assertIs(get_store_index(), index)
+
+
+class GeohashTest(TestCase):
+    """Tests para la columna geohash indexada"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username='geoowner', email='geo@test.com', password='testpass123')
+    
+    def test_encode_known_values(self):
+        """Test la codificación coincide con la del geohash estándar"""
+        self.assertEqual(encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(encode(-25.382708, -49.265506, 8), '6gkzwgjz')
+        self.assertEqual(encode(None, 10.0), '')
+    
+    def test_prefix_successor(self):
+        """Test el sucesor acota todos los geohashes con ese prefijo"""
+        self.assertEqual(prefix_successor('d2b'), 'd2c')
+        self.assertEqual(prefix_successor('d2z'), 'd3')
+        self.assertIsNone(prefix_successor('zz'))
+    
+    def test_covering_cells_contain_every_point_in_radius(self):
+        """Test las celdas del cubrimiento contienen todos los puntos del radio"""
+        rng = random.Random(3)
+        for lat, lon, radius in [(6.2442, -75.5812, 2), (40.7831, -73.9712, 25), (10.0, 179.999, 5), (89.99, 0, 3)]:
+            cells = covering_cells(*bounding_box(lat, lon, radius))
+            self.assertTrue(0 < len(cells) <= 16)
+            for _ in range(300):
+                point_lat = max(min(lat + rng.uniform(-1, 1) * radius / 111, 90), -90)
+                point_lon = (lon + rng.uniform(-1, 1) * radius / 111 + 180) % 360 - 180
+                if haversine_distance(lat, lon, point_lat, point_lon) <= radius:
+                    geohash = encode(point_lat, point_lon)
+                    self.assertTrue(any(geohash.startswith(cell) for cell in cells), (lat, lon, point_lat, point_lon))
+    
+    def test_geohash_maintained_on_save_and_bulk_operations(self):
+        """Test el geohash se recalcula en save, bulk_create, bulk_update y update"""
+        store = Store.objects.create(name='Geo', owner=self.user, latitude=6.2442, longitude=-75.5812, address='Geo 1')
+        self.assertEqual(store.geohash, encode(6.2442, -75.5812))
+        
+        store.latitude = 6.25
+        store.save(update_fields=['latitude'])
+        store.refresh_from_db()
+        self.assertEqual(store.geohash, encode(6.25, -75.5812))
+        
+        created = Store.objects.bulk_create([
+            Store(name='Bulk', owner=self.user, latitude=40.7831, longitude=-73.9712, address='Bulk 1')
+        ])
+        self.assertEqual(Store.objects.get(name='Bulk').geohash, encode(40.7831, -73.9712))
+        
+        created[0].longitude = -74.0
+        Store.objects.bulk_update(created, ['longitude'])
+        self.assertEqual(Store.objects.get(name='Bulk').geohash, encode(40.7831, -74.0))
+        
+        Store.objects.filter(name='Bulk').update(latitude=41.0, longitude=-74.5)
+        self.assertEqual(Store.objects.get(name='Bulk').geohash, encode(41.0, -74.5))
+        
+        Store.objects.update(latitude=F('latitude') + 1)
+        self.assertEqual(Store.objects.get(name='Bulk').geohash, encode(42.0, -74.5))
+        self.assertEqual(Store.objects.get(name='Geo').geohash, encode(7.25, -75.5812))
+    
+    def test_geohash_filter_finds_nearby_stores(self):
+        """Test el filtro por rangos de geohash encuentra las tiendas del área"""
+        near = Store.objects.create(name='Near', owner=self.user, latitude=6.2442, longitude=-75.5812, address='N')
+        Store.objects.create(name='Far', owner=self.user, latitude=4.711, longitude=-74.0721, address='F')
+        
+        cells = covering_cells(*bounding_box(6.245, -75.58, 2))
+        self.assertEqual(list(Store.objects.filter(geohash_filter(cells))), [near])
+
+
 class ProductModelTest(TestCase):
     """Tests para el modelo Product"""
     
@@ -489,6 +651,67 @@ class ProductAPITest(APITestCase):
         self.assertIn(response.status_code, [status.HTTP_200_OK, status.HTTP_401_UNAUTHORIZED])
 
 
+class StoreNearbyAPITest(APITestCase):
+    """Tests para el endpoint de tiendas cercanas"""
+    
+    def setUp(self):
+        reset_store_index()
+        self.addCleanup(reset_store_index)
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='nearbyowner', email='nearby@test.com', password='testpass123')
+        self.close = Store.objects.create(
+            name='Close', owner=self.user, latitude=6.2442, longitude=-75.5812, address='Close 1'
+        )
+        self.closer = Store.objects.create(
+            name='Closer', owner=self.user, latitude=6.2450, longitude=-75.5800, address='Closer 1'
+        )
+        Store.objects.create(name='Bogota', owner=self.user, latitude=4.711, longitude=-74.0721, address='Far 1')
+        Store.objects.create(
+            name='Closed', owner=self.user, latitude=6.2451, longitude=-75.5801, address='Closed 1', is_active=False
+        )
+        self.url = '/api/stores/nearby/'
+    
+    def test_nearby_sorted_by_distance(self):
+        """Test devuelve las tiendas activas del radio ordenadas por distancia"""
+        response = self.client.get(self.url, {'lat': 6.2452, 'lng': -75.5798, 'radius': 2})
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([store['id'] for store in response.data['results']], [self.closer.id, self.close.id])
+        distances = [store['distance_km'] for store in response.data['results']]
+        self.assertEqual(distances, sorted(distances))
+    
+    def test_nearby_limit(self):
+        """Test limit acota el número de resultados a las más cercanas"""
+        response = self.client.get(self.url, {'lat': 6.2452, 'lng': -75.5798, 'limit': 1})
+        
+        self.assertEqual([store['id'] for store in response.data['results']], [self.closer.id])
+    
+    def test_nearby_reflects_changes(self):
+        """Test las tiendas creadas o desactivadas se reflejan sin reconstruir el índice"""
+        self.client.get(self.url, {'lat': 6.2452, 'lng': -75.5798})
+        self.closer.is_active = False
+        self.closer.save()
+        
+        response = self.client.get(self.url, {'lat': 6.2452, 'lng': -75.5798})
+        
+        self.assertEqual([store['id'] for store in response.data['results']], [self.close.id])
+    
+    def test_nearby_validation(self):
+        """Test los parámetros ausentes o fuera de rango devuelven 400"""
+        for params in [
+            {'lat': 6.2},
+            {'lat': 'north', 'lng': -75.5},
+            {'lat': 91, 'lng': -75.5},
+            {'lat': 6.2, 'lng': -75.5, 'radius': 0},
+            {'lat': 6.2, 'lng': -75.5, 'radius': 500},
+            {'lat': 6.2, 'lng': -75.5, 'limit': 1000},
+        ]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+            self.assertIn('error', response.data)
+
+
 class StoreProductIntegrationTest(TestCase):
     """Tests de integración entre Store y Product"""
     
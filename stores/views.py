@@ -1,12 +1,70 @@
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from .models import Store, Product
 from .serializers import StoreSerializer, ProductSerializer
+from .spatial import get_store_index
+
+# Radio (km) y número de resultados de /stores/nearby/
+DEFAULT_NEARBY_RADIUS_KM = 5
+MAX_NEARBY_RADIUS_KM = 50
+DEFAULT_NEARBY_LIMIT = 20
+MAX_NEARBY_LIMIT = 100
 
 class StoreViewSet(viewsets.ModelViewSet):
     queryset = Store.objects.all()
     serializer_class = StoreSerializer
+    
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """
+        Tiendas activas a radius km o menos de (lat, lng), ordenadas por
+        distancia, usando el índice espacial en memoria del proceso.
+        """
+        try:
+            lat = float(request.query_params['lat'])
+            lng = float(request.query_params['lng'])
+            radius = float(request.query_params.get('radius', DEFAULT_NEARBY_RADIUS_KM))
+            limit = int(request.query_params.get('limit', DEFAULT_NEARBY_LIMIT))
+        except KeyError:
+            return Response(
+                {'error': 'lat and lng are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except ValueError:
+            return Response(
+                {'error': 'lat, lng, radius and limit must be numbers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            return Response(
+                {'error': 'lat must be between -90 and 90 and lng between -180 and 180'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not (0 < radius <= MAX_NEARBY_RADIUS_KM):
+            return Response(
+                {'error': f'radius must be greater than 0 and at most {MAX_NEARBY_RADIUS_KM} km'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not (0 < limit <= MAX_NEARBY_LIMIT):
+            return Response(
+                {'error': f'limit must be between 1 and {MAX_NEARBY_LIMIT}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        nearest = get_store_index().within_radius(lat, lng, radius, limit=limit)
+        # El índice puede ir por detrás de cambios hechos en otros procesos
+        stores = Store.objects.filter(id__in=[store_id for store_id, distance in nearest], is_active=True).in_bulk()
+        results = []
+        for store_id, distance in nearest:
+            if store_id in stores:
+                data = StoreSerializer(stores[store_id]).data
+                data['distance_km'] = round(distance, 3)
+                results.append(data)
+        
+        return Response({'count': len(results), 'results': results})
 
 class ProductViewSet(viewsets.ModelViewSet):
     queryset = Product.objects.all()
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-16 23:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['user_type', 'latitude', 'longitude'], name='users_user_user_ty_e24e7b_idx'),
+        ),
+    ]
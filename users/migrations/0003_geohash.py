@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-17 00:32
+
+import users.models
+from django.db import migrations, models
+from marketplace.geohash import encode
+
+BATCH_SIZE = 2000
+
+
+def backfill_geohash(apps, schema_editor):
+    """Calcula el geohash de las filas existentes en lotes por id"""
+    User = apps.get_model('users', 'User')
+    last_id = 0
+    while True:
+        rows = list(
+            User.objects.filter(id__gt=last_id, latitude__isnull=False, longitude__isnull=False)
+            .order_by('id').values_list('id', 'latitude', 'longitude')[:BATCH_SIZE]
+        )
+        if not rows:
+            return
+        User.objects.bulk_update(
+            [User(id=row_id, geohash=encode(lat, lon)) for row_id, lat, lon in rows],
+            ['geohash']
+        )
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    # Cada lote del backfill se confirma por separado en tablas grandes
+    atomic = False
+
+    dependencies = [
+        ('users', '0002_user_type_location_index'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', users.models.UserManager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=12),
+        ),
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+    ]
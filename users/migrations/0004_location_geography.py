@@ -0,0 +1,22 @@
+from django.db import migrations
+from marketplace.postgis import add_location_column, drop_location_column
+
+
+def add_location(apps, schema_editor):
+    add_location_column(schema_editor, 'users_user')
+
+
+def drop_location(apps, schema_editor):
+    drop_location_column(schema_editor, 'users_user')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_geohash'),
+    ]
+
+    # Solo en PostGIS: columna geography generada desde latitude/longitude con índice GiST
+    operations = [
+        migrations.RunPython(add_location, drop_location),
+    ]
@@ -1,7 +1,11 @@
 from django.db import models
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
+from marketplace.geohash import GeohashModel, GeohashQuerySet
 
-class User(AbstractUser):
+class UserManager(BaseUserManager.from_queryset(GeohashQuerySet)):
+    """UserManager cuyas operaciones masivas mantienen el geohash"""
+
+class User(GeohashModel, AbstractUser):
     USER_TYPE_CHOICES = (
         ('new', 'New User'),
         ('frequent', 'Frequent Buyer'),
@@ -15,5 +19,12 @@ class User(AbstractUser):
     latitude = models.FloatField(null=True, blank=True)
     longitude = models.FloatField(null=True, blank=True)
 
+    objects = UserManager()
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(fields=['user_type', 'latitude', 'longitude']),
+        ]
+
     def __str__(self):
         return self.username
\ No newline at end of file